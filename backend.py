@@ -1,40 +1,105 @@
-import gui
+import os
+import threading
+import textbuffer
+import ot
+from cursorindex import CursorIndex
+
+class NullView:
+    """ What the editor tells its view about changes to the document. A view implements these methods, and
+        reads lines back through editor_state.line_count and line_view. This one ignores them all, for
+        documents that nobody looks at, such as those hosted by a server. """
+    def change_line( self, line ):
+        pass
+
+    def add_line( self, prev_pos ):
+        pass
+
+    def delete_line( self, line ):
+        pass
+
+    def refresh( self ):
+        pass
+
+    def launch( self ):
+        pass
 
 class editor_state:
-    def __init__(self, filename=''):
+    def __init__(self, filename='', engine=textbuffer.DEFAULT_ENGINE, view=None):
+        """ view, if given, is called with the editor and returns the view to show the document in.
+            Without one the document is not shown. """
         self.fname = filename
+        self.engine = textbuffer.ENGINES[engine]
 
-        self.cursors = {}
+        self.cursors = CursorIndex()
         self.my_cursor = 0;
+        # Guards rows and cursors when several threads edit the document
+        self.lock = threading.RLock()
 
         try:
-            with open(filename) as f:
-                self.rows = f.read().split('\n')
+            self.rows = self.engine.open( filename )
         except FileNotFoundError:
-            self.rows = []
+            self.rows = self.engine()
         self.numrows = len(self.rows)
-        self.G = gui.MultiCursorGui( self.rows, self.insert_my_char, self.move_my_cursor, self.interrupt )
-        for i in range(self.numrows - 1):
-            self.rows[i] += '\n'
+        self.viewed = view is not None
+        self.G = view( self ) if self.viewed else NullView()
+
+    def line_count( self ):
+        return len( self.rows )
+
+    def line_view( self, line ):
+        """ Returns the contents of a line and the columns of the cursors on it, for the GUI """
+        with self.lock:
+            return (self.rows.line(line), self.cursors.columns(line))
 
     def interrupt( self ):
         pass
 
+    def view( self, first, last ):
+        """ Called with the range of lines on screen whenever it changes """
+        pass
+
     def update_line( self, line ):
-        self.G.change_line( line, self.rows[line][:-1], [self.cursors[key]["cx"] for key in self.cursors if self.cursors[key]["cy"] == line])
+        if self.viewed:
+            self.G.change_line( line )
 
     def create_cursor( self, cid, x=0, y=0):
-        self.cursors[cid] = {"cx": x, "cy": y};
-        self.update_line( self.cursors[cid]["cy"] )
+        self.cursors.add( cid, x, y )
+        self.update_line( y )
 
     def remove_cursor( self, cid ):
-        line = self.cursors[cid]["cy"]
-        del self.cursors[cid]
+        line = self.cursors.row( cid )
+        self.cursors.remove( cid )
         self.update_line( line )
 
     def move_cursor_in_row( self, cid, x ):
-        self.cursors[cid]["cx"] = x;
-        self.update_line( self.cursors[cid]["cy"] )
+        row = self.cursors.row( cid )
+        self.cursors.move( cid, x, row )
+        self.update_line( row )
+
+    def place_cursor( self, cid, x, y ):
+        """ Places a cursor at the given column and row, creating it if need be """
+        if cid not in self.cursors:
+            self.create_cursor( cid, x, y )
+            return
+        old_row = self.cursors.row( cid )
+        self.cursors.move( cid, x, y )
+        if y != old_row:
+            self.update_line( old_row )
+        self.update_line( y )
+
+    def cursor_offset( self, cid ):
+        """ Returns the absolute offset of the given cursor within the document """
+        col, row = self.cursors.get( cid )
+        return self.rows.offset( row, col )
+
+    def move_cursor_to_offset( self, cid, offset ):
+        """ Places the given cursor at an absolute offset within the document """
+        old_row = self.cursors.row( cid )
+        row, col = self.rows.position( min( offset, self.rows.size() ) )
+        self.cursors.move( cid, col, row )
+        if row != old_row:
+            self.update_line( old_row )
+        self.update_line( row )
 
     def insert_my_char( self, char ):
         self.insert_char( self.my_cursor, char )
@@ -42,54 +107,55 @@ class editor_state:
     def move_my_cursor( self, direction ):
         self.move_cursor( self.my_cursor, direction )
 
+    def walk_cursor( self, cid, directions ):
+        """ Moves a cursor in each of the given directions in turn """
+        for direction in directions:
+            self.move_cursor( cid, direction )
+
     def move_cursor(self, cid, direction):
         """ Move the cursor sanely, handling all bounds checking. """
 
-        cursor = self.cursors[cid];
+        cx, cy = self.cursors.get( cid )
 
         # Move left unless at beginning of line
-        if direction == 'left' and cursor["cx"] != 0:
-            self.move_cursor_in_row( cid, cursor["cx"] - 1 );
+        if direction == 'left' and cx != 0:
+            self.move_cursor_in_row( cid, cx - 1 );
         # Move right unless at end of line
-        elif direction == 'right' and self.rows[cursor["cy"]][cursor["cx"]] != '\n':
-            self.move_cursor_in_row( cid, cursor["cx"] + 1 );
+        elif direction == 'right' and self.rows[cy][cx] != '\n':
+            self.move_cursor_in_row( cid, cx + 1 );
         # Move down, accounting for line length differences
         # and never moving beyond the last line of the file
-        elif direction == 'down' and cursor["cy"] < len(self.rows) - 2:
-            curr_line_len = len(self.rows[cursor["cy"]])
-            self.cursors[cid]["cy"] += 1
-            next_line_len = len(self.rows[cursor["cy"]])
-            if next_line_len < curr_line_len and next_line_len - 1 < cursor["cx"]: 
-                self.cursors[cid]["cx"] = next_line_len - 1
-            self.update_line( cursor["cy"] - 1 )
-            self.update_line( cursor["cy"] )
+        elif direction == 'down' and cy < len(self.rows) - 2:
+            curr_line_len = len(self.rows[cy])
+            next_line_len = len(self.rows[cy + 1])
+            if next_line_len < curr_line_len and next_line_len - 1 < cx: 
+                cx = next_line_len - 1
+            self.cursors.move( cid, cx, cy + 1 )
+            self.update_line( cy )
+            self.update_line( cy + 1 )
         # Move up, accounting for line length differences
         # and never moving before the first line of the file
-        elif direction == 'up' and cursor["cy"] > 0:
-            curr_line_len = len(self.rows[cursor["cy"]])
-            self.cursors[cid]["cy"] -= 1
-            next_line_len = len(self.rows[cursor["cy"]])
-            if next_line_len < curr_line_len and next_line_len - 1 < cursor["cx"]: 
-                self.cursors[cid]["cx"] = next_line_len - 1
-            self.update_line( cursor["cy"] + 1 )
-            self.update_line( cursor["cy"] )
+        elif direction == 'up' and cy > 0:
+            curr_line_len = len(self.rows[cy])
+            next_line_len = len(self.rows[cy - 1])
+            if next_line_len < curr_line_len and next_line_len - 1 < cx: 
+                cx = next_line_len - 1
+            self.cursors.move( cid, cx, cy - 1 )
+            self.update_line( cy )
+            self.update_line( cy - 1 )
         # delete character in front of cursor
         elif direction == 'backspace':
-            if cursor["cx"] > 0:
+            if cx > 0:
                 self.move_cursor( cid, 'left' )
                 self.remove_char( cid )
-            elif cursor["cy"] != 0:
+            elif cy != 0:
                 self.move_cursor( cid, 'up' )
-                self.move_cursor_in_row( cid, len(self.rows[cursor["cy"]]) - 1)
-                self.rows[cursor["cy"]] = self.rows[cursor["cy"]][:-1]
-                self.rows[cursor["cy"]] += self.rows[cursor["cy"]+1]
-                self.rows.pop( cursor["cy"] + 1 )
-                self.G.delete_line( cursor["cy"] + 1 )
-                self.update_line( cursor["cy"] )
+                self.move_cursor_in_row( cid, len(self.rows[cy - 1]) - 1)
+                self.remove_char( cid )
         # delete character under cursor
         elif direction == 'delete':
-            if cursor["cy"] == self.numrows - 2:
-                if self.rows[cursor["cy"]][cursor["cx"]] != '\n':
+            if cy == len(self.rows) - 2:
+                if self.rows[cy][cx] != '\n':
                     self.remove_char( cid )
             else:
                 self.remove_char( cid )
@@ -99,41 +165,126 @@ class editor_state:
 
     def insert_char(self, cid, c):
         """ inserts one character at a time, at the position of the given cursor """
-        row = self.cursors[cid]["cy"]
-        col = self.cursors[cid]["cx"]
-        r = self.rows[row]
+        col, row = self.cursors.get( cid )
 
+        self.rows.insert(row, col, c)
         if c == '\n':
-            self.rows[row] = r[:col] + c
-            self.rows.insert(row + 1, r[col:])
-            self.G.add_line(row, r[col:], [])
+            self.G.add_line(row)
+            # Cursors below the split keep their rows' widgets, which moved
+            # down along with them, so only the two halves need redrawing
+            self.cursors.shift( row + 1, 1 )
+            for key, x in self.cursors.on_row( row ):
+                if x >= col:
+                    self.cursors.move( key, x - col, row + 1 )
             self.update_line( row )
-            for key in self.cursors:
-                if self.cursors[key]["cy"] > row:
-                    self.move_cursor( key, 'down' )
-                elif self.cursors[key]["cy"] == row and self.cursors[key]["cx"] >= col:
-                    tmp = self.cursors[key]["cx"]
-                    self.move_cursor( key, 'down' )
-                    self.move_cursor_in_row( key, tmp - col )
+            self.update_line( row + 1 )
         else:
-            self.rows[row] = r[:col] + c + r[col:]
             self.update_line( row )
             self.move_cursor(cid, 'right')
 
+    def insert_text( self, cid, text ):
+        """ Inserts a string, which may hold several lines, at the position of the given cursor in one
+            buffer operation. Cursors end up where inserting it one character at a time would leave them. """
+        if not text:
+            return
+        col, row = self.cursors.get( cid )
+        lines = text.split( '\n' )
+
+        self.rows.insert( row, col, text )
+        if len( lines ) > 1:
+            self.cursors.shift( row + 1, len( lines ) - 1 )
+            # Each line break carries the other cursors at or after it down to the next row
+            x = col
+            for i, line in enumerate( lines[:-1] ):
+                x += len( line )
+                for key, cx in self.cursors.on_row( row + i ):
+                    if key != cid and cx >= x:
+                        self.cursors.move( key, cx - x, row + i + 1 )
+                self.G.add_line( row + i )
+                x = 0
+            self.cursors.move( cid, len( lines[-1] ), row + len( lines ) - 1 )
+        else:
+            self.cursors.move( cid, col + len( text ), row )
+        for line in range( row, row + len( lines ) ):
+            self.update_line( line )
+
+    def delete_range( self, cid, count ):
+        """ Deletes count characters from the position of the given cursor onwards in one buffer
+            operation, as that many presses of delete would. A negative count deletes the characters before
+            the cursor instead, as presses of backspace would. The newline before the last row is kept. """
+        if count < 0:
+            end = self.cursor_offset( cid )
+            self.move_cursor_to_offset( cid, max( 0, end + count ) )
+            count = end - self.cursor_offset( cid )
+        col, row = self.cursors.get( cid )
+        start = self.rows.offset( row, col )
+        count = min( count, self.deletable_end( row ) - start )
+        if count <= 0:
+            return
+        joined = self.rows.position( start + count )[0] - row
+
+        self.rows.delete( row, col, count )
+        # The rows joined onto this one bring their cursors with them
+        for i in range( 1, joined + 1 ):
+            for key, x in self.cursors.on_row( row + i ):
+                self.cursors.move( key, x + col, row )
+            self.G.delete_line( row + 1 )
+        self.cursors.shift( row + joined + 1, -joined )
+        self.update_line( row )
+
+    def deletable_end( self, row ):
+        """ Returns the offset up to which text can be deleted from the given row on. The newline before the
+            last row is kept. """
+        last = len( self.rows ) - 1
+        return self.rows.size() if row == last else self.rows.offset( last, 0 ) - 1
+
+    def applies_in_full( self, operation ):
+        """ Returns whether apply_operation would make every delete of the operation in full, which it does
+            unless one of them reaches the newline that deletable_end keeps. That newline is followed through
+            the edits before each delete, as they move it or insert a later one. """
+        last = len( self.rows ) - 1
+        kept = self.rows.offset( last, 0 ) - 1 if last else None
+        for offset, text, count in ot.edits( operation ):
+            if kept is not None and offset <= kept:
+                if offset + count > kept:
+                    return False
+                kept += len( text ) - count
+            elif '\n' in text:
+                kept = offset + text.rindex( '\n' )
+        return True
+
+    def apply_operation( self, cid, operation, cursor=None ):
+        """ Applies an operation (see ot.py) as the edits of the given cursor, creating it if need be, then
+            places it at the offset cursor if one is given. Every other cursor keeps its place in the text.
+            Deletes are clamped as delete_range clamps them, so check applies_in_full first. """
+        if cid not in self.cursors:
+            self.create_cursor( cid )
+        others = [(key, self.cursor_offset( key )) for key in self.cursors if key != cid]
+        for offset, text, count in ot.edits( operation ):
+            self.move_cursor_to_offset( cid, offset )
+            if count:
+                self.delete_range( cid, count )
+            if text:
+                self.insert_text( cid, text )
+        for key, offset in others:
+            self.move_cursor_to_offset( key, ot.transform_index( offset, operation ) )
+        if cursor is not None:
+            self.move_cursor_to_offset( cid, cursor )
+
     def remove_char(self, cid):
         """ removes a character at the position of the given cursor """
-        row = self.cursors[cid]["cy"]
-        col = self.cursors[cid]["cx"]
-        r = self.rows[row]
+        col, row = self.cursors.get( cid )
+        joined = self.rows[row][col] == '\n'
 
-        if r[col] == '\n':
-            self.rows[row] = r[:col] + self.rows[row + 1]
-            self.rows.pop(row + 1)
+        self.rows.delete(row, col)
+        if joined:
             self.G.delete_line(row + 1)
-            self.update_line( row )
-        else:
-            self.rows[row] = r[:col] + r[col + 1:]
-            self.update_line( row )
+            # The row below is appended to this one, so its cursors follow it
+            # and every cursor further down moves up a row
+            for key, x in self.cursors.on_row( row + 1 ):
+                self.cursors.move( key, x + col, row )
+            self.cursors.shift( row + 2, -1 )
+        self.update_line( row )
 
     def write(self, filename=''):
         """ saves to disk """
@@ -141,7 +292,10 @@ class editor_state:
             filename = self.fname
         try:
             if filename != '':
-                with open(filename, 'w') as f:
-                    f.write(''.join(self.rows))
+                # Replace the file rather than rewriting it, since the buffer may be reading from it
+                with open(filename + '.tmp', 'w') as f:
+                    for chunk in self.rows.chunks():
+                        f.write(chunk)
+                os.replace(filename + '.tmp', filename)
         except FileNotFoundError:
             pass
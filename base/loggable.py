@@ -13,11 +13,19 @@ class Loggable:
             raise IsNone("Logger must not be None")
         self.logger = logger
 
-    def info    (self, m): self.logger.info    (m)
-    def debug   (self, m): self.logger.debug   (m)
-    def warn    (self, m): self.logger.warn    (m)
-    def error   (self, m): self.logger.error   (m)
-    def critical(self, m): self.logger.critical(m)
+    def info    (self, m, *args): self.log(logging.INFO,     m, args)
+    def debug   (self, m, *args): self.log(logging.DEBUG,    m, args)
+    def warn    (self, m, *args): self.log(logging.WARNING,  m, args)
+    def error   (self, m, *args): self.log(logging.ERROR,    m, args)
+    def critical(self, m, *args): self.log(logging.CRITICAL, m, args)
+
+    def log(self, level, m, args):
+        """
+        Messages are str.format templates, filled in with args only
+        if the level is enabled, so disabled levels cost nothing
+        """
+        if self.logger.isEnabledFor(level):
+            self.logger.log(level, m.format(*args) if args else m)
 
 class Bitbucket(Loggable):
     """
@@ -25,11 +33,11 @@ class Bitbucket(Loggable):
     """
     def __init__(self, logger = None): pass
 
-    def info    (self, m): pass
-    def debug   (self, m): pass
-    def warn    (self, m): pass
-    def error   (self, m): pass
-    def critical(self, m): pass
+    def info    (self, m, *args): pass
+    def debug   (self, m, *args): pass
+    def warn    (self, m, *args): pass
+    def error   (self, m, *args): pass
+    def critical(self, m, *args): pass
 
 BitBucket = Bitbucket()
 
@@ -64,25 +72,27 @@ class AdHoc:
         }
         self.prefixes.update(kwargs)
 
-    def log(self, message, level):
-        message = str(message)
-        if self.level <= level:
-            self.sink.write(message + "\n")
+    def isEnabledFor(self, level):
+        return self.level <= level
+
+    def log(self, level, message):
+        if self.isEnabledFor(level):
+            self.sink.write(str(message) + "\n")
 
     def info(self, m):
-        self.log(self.prefixes["info"] + str(m), logging.INFO)
+        self.log(logging.INFO, self.prefixes["info"] + str(m))
 
     def debug(self, m):
-        self.log(self.prefixes["debug"] + str(m), logging.DEBUG)
+        self.log(logging.DEBUG, self.prefixes["debug"] + str(m))
 
     def warn(self, m):
-        self.log(self.prefixes["warn"] + str(m), logging.WARNING)
+        self.log(logging.WARNING, self.prefixes["warn"] + str(m))
 
     def error(self, m):
-        self.log(self.prefixes["error"] + str(m), logging.ERROR)
+        self.log(logging.ERROR, self.prefixes["error"] + str(m))
 
     def critical(self, m):
-        self.log(self.prefixes["critical"] + str(m), logging.CRITICAL)
+        self.log(logging.CRITICAL, self.prefixes["critical"] + str(m))
 
 import sys
 StdErr = AdHoc(sys.stderr, name = "stderr")
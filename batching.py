@@ -0,0 +1,172 @@
+import math
+import time
+import threading
+from collections import deque
+
+class IngestBuffer:
+    """ The edits waiting to be batched, queued by many threads and taken by one.
+
+        Queueing an edit is a single deque.append, which needs no lock of ours, and drain hands the consumer
+        everything queued so far in one go. Edits queued while a drain is under way wait for the next one.
+        Every edit is queued with the time it arrived, so that the scheduler can time its batch from the
+        oldest one.
+    """
+    def __init__( self ):
+        self.items = deque()
+
+    def __len__( self ):
+        return len( self.items )
+
+    def put( self, item ):
+        self.items.append( (time.monotonic(), item) )
+
+    def oldest( self ):
+        """ Returns the time.monotonic() at which the oldest queued edit arrived, or None if none is queued """
+        try:
+            return self.items[0][0]
+        except IndexError:
+            return None
+
+    def drain( self ):
+        """ Removes and returns every edit queued so far, oldest first. Only one thread may drain. """
+        items = self.items
+        return [items.popleft()[1] for _ in range( len( items ) )]
+
+class BatchScheduler:
+    """ Decides when the server flushes the edits it has queued up as one broadcast batch.
+
+        A batch is flushed once it holds max_size edits or once its oldest edit has waited delay() seconds,
+        whichever comes first. The delay follows the given percentile of the clients' round trip times, plus
+        a margin, rather than the slowest client's, so one user on a bad link no longer holds everyone up.
+
+        Edits that are older than their client's tolerance when they arrive are dropped. Without tiers every
+        client is tolerated for the shared delay. With tiers, a sorted list of round trip times, each client
+        is tolerated for the smallest tier its own round trip time fits in, plus the margin, so slow clients
+        are not cut off by a delay tuned for everyone else.
+
+        Any object with the same methods can stand in for this one.
+    """
+    def __init__( self, max_size=64, percentile=90, margin=.05, min_delay=.01, max_delay=1.0, initial_delay=.25,
+                  tiers=None ):
+        self.max_size = max_size
+        self.percentile = percentile
+        self.margin = margin
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.tiers = sorted( tiers ) if tiers else None
+        self.rtts = {}
+        self.current = initial_delay
+        self.initial_delay = initial_delay
+
+        self.cond = threading.Condition()
+        # Whether the flusher is asleep with nothing queued, and when it first saw the edits it waits on if
+        # the queue cannot say when they arrived
+        self.idle = False
+        self.first = None
+
+        self.batches = 0
+        self.edits = 0
+        self.largest = 0
+        self.reasons = {"size": 0, "deadline": 0}
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def observe( self, uuid, rtt ):
+        """ Records the latest average round trip time measured for a client """
+        with self.cond:
+            self.rtts[uuid] = rtt
+            self._update()
+
+    def forget( self, uuid ):
+        with self.cond:
+            self.rtts.pop( uuid, None )
+            self._update()
+
+    def latencies( self ):
+        """ Returns the latest average round trip time of each client """
+        with self.cond:
+            return dict( self.rtts )
+
+    def delay( self ):
+        """ Returns how long the oldest edit in a batch may wait before the batch is flushed """
+        return self.current
+
+    def tolerance( self, uuid ):
+        """ Returns how old an edit from the given client may be when it arrives """
+        rtt = self.rtts.get( uuid )
+        if not self.tiers or rtt is None:
+            return self.current
+        tier = next( (bound for bound in self.tiers if rtt <= bound), self.tiers[-1] )
+        return max( tier + self.margin, self.current )
+
+    def arrived( self, queued ):
+        """ Notes that an edit was queued, leaving queued edits waiting in all. This takes no lock unless
+            the flusher has to be woken, to start the deadline or because the batch is full. """
+        if self.idle or queued >= self.max_size:
+            with self.cond:
+                self.idle = False
+                self.cond.notify_all()
+
+    def wait( self, queued, arrival=None ):
+        """ Blocks until the edits counted by queued() are due to be flushed and returns why, "size" or
+            "deadline". arrival(), if given, returns when the oldest of them arrived, such as
+            IngestBuffer.oldest; without it they are timed from when this first sees them. Only one thread
+            may wait. """
+        first = None
+        with self.cond:
+            while True:
+                pending = queued()
+                if pending >= self.max_size:
+                    reason = "size"
+                    break
+                if not pending:
+                    self.idle = True
+                    # An edit queued before idle was set did not wake us, so look again before sleeping
+                    if not queued():
+                        self.cond.wait()
+                    continue
+                self.idle = False
+                first = arrival() if arrival else None
+                if first is None:
+                    if self.first is None:
+                        self.first = time.monotonic()
+                    first = self.first
+                remaining = first + self.current - time.monotonic()
+                if remaining <= 0:
+                    reason = "deadline"
+                    break
+                self.cond.wait( remaining )
+            if first is None:
+                first = arrival() if arrival else self.first
+            waited = time.monotonic() - first if first is not None else 0.0
+            self.first = None
+            self.reasons[reason] += 1
+            self.wait_total += waited
+            self.wait_max = max( self.wait_max, waited )
+            return reason
+
+    def flushed( self, size ):
+        """ Notes how many edits the flush that wait allowed actually took """
+        with self.cond:
+            self.batches += 1
+            self.edits += size
+            self.largest = max( self.largest, size )
+
+    def stats( self ):
+        with self.cond:
+            flushes = sum( self.reasons.values() )
+            return {"delay": self.current, "clients": len( self.rtts ), "batches": self.batches,
+                    "edits": self.edits, "largest": self.largest,
+                    "mean_size": self.edits / self.batches if self.batches else 0.0,
+                    "reasons": dict( self.reasons ),
+                    "wait_mean": self.wait_total / flushes if flushes else 0.0, "wait_max": self.wait_max}
+
+    def _update( self ):
+        if not self.rtts:
+            self.current = self.initial_delay
+            return
+        rtts = sorted( self.rtts.values() )
+        rank = max( 0, math.ceil( self.percentile / 100 * len( rtts ) ) - 1 )
+        self.current = min( self.max_delay, max( self.min_delay, rtts[rank] + self.margin ) )
+        # A flush that is already waiting may now be due sooner
+        self.cond.notify_all()
@@ -5,14 +5,24 @@ import zmq
 from base.exceptions import GenericError
 from base.loggable import Loggable, BitBucket
 
-from threading import Thread, Lock
+from threading import Thread, Lock, Semaphore
 from queue import Queue
+from concurrent.futures import Future
+from itertools import count
+
+def asBytes(message):
+    """
+    Frames go out as bytes; text is encoded as UTF-8
+    """
+    return message.encode() if isinstance(message, str) else message
 
 class Subscription(Loggable):
-    def __init__(self, remoteAddress, zmqCxt, logger):
+    def __init__(self, remoteAddress, zmqCxt, logger, topic = b""):
         """
-        Subscription.__init__(self, remoteAddress, zmqCxt, logger)
+        Subscription.__init__(self, remoteAddress, zmqCxt, logger, topic = b"")
         Subscription to a publishing endpoint at remoteAddress
+        Only broadcasts starting with topic are received; the default
+        receives everything.
         Requires a zmq context.
         """
         super(Subscription, self).__init__(logger)
@@ -22,21 +32,26 @@ class Subscription(Loggable):
         # Subscription to remote broadcasts
         self.addr = remoteAddress
         self.sock = self.cxt.socket(zmq.SUB)
-        self.sock.setsockopt_string(zmq.SUBSCRIBE, "")
+        self.topics = [asBytes(topic)]
+        self.sock.setsockopt(zmq.SUBSCRIBE, self.topics[0])
         self.sock.connect(self.addr)
 
         self.backlog = Queue(1024)
         self.lock = Lock()
+        # Topics asked for by other threads, applied by whichever receives next
+        self.wanted = None
+        self.topicLock = Lock()
 
     def recv(self, pollTimeout = 500):
         """
         Subscription.recv(self, pollTimeout = 500)
         Receive a message from the server, timing out after 
         pollTimeout milliseconds.
-        Returns string on success, None on failure
+        Returns bytes on success, None on failure
         """
         # Check backlog 
         with self.lock:
+            self.updateTopics()
             if not self.backlog.empty():
                 msg = self.backlog.get()
             else:
@@ -46,11 +61,47 @@ class Subscription(Loggable):
                     return msg
                 # Process the oldest messages in the backlog first
                 for i in range(nmsg):
-                    self.backlog.put(self.sock.recv_string())
+                    self.backlog.put(self.sock.recv())
                 msg = self.backlog.get()
 
         return msg
 
+    def setTopic(self, topic):
+        """
+        Subscription.setTopic(self, topic)
+        Receive broadcasts starting with topic instead of the current one.
+        """
+        self.setTopics([topic])
+
+    def setTopics(self, topics):
+        """
+        Subscription.setTopics(self, topics)
+        Receive broadcasts starting with any of topics instead of the
+        current ones. The change is made before the next poll, so this never
+        waits on a receive in progress.
+        """
+        with self.topicLock:
+            self.wanted = list(dict.fromkeys(asBytes(topic) for topic in topics))
+
+    def updateTopics(self):
+        """
+        Subscription.updateTopics(self)
+        Apply the topics last asked for. The caller must hold self.lock.
+        New topics are subscribed before old ones are dropped, so broadcasts
+        matching both are never missed.
+        """
+        with self.topicLock:
+            wanted, self.wanted = self.wanted, None
+        if wanted == None:
+            return
+        for topic in wanted:
+            if topic not in self.topics:
+                self.sock.setsockopt(zmq.SUBSCRIBE, topic)
+        for topic in self.topics:
+            if topic not in wanted:
+                self.sock.setsockopt(zmq.UNSUBSCRIBE, topic)
+        self.topics = wanted
+
     def stop(self):
         """
         Subscription.stop(self)
@@ -63,22 +114,25 @@ class Subscription(Loggable):
 # For legacy reasons, broadcast handler is separate: Subscription.
 class Client(Loggable):
     cxt = zmq.Context()
-    def __init__(self, remoteAddress, broadcastAddress, logger):
+    interactiveType = zmq.REQ
+    def __init__(self, remoteAddress, broadcastAddress, logger, topic = b""):
         """
-        Client.__init__(self, remoteAddress, broadcastAddress, logger)
+        Client.__init__(self, remoteAddress, broadcastAddress, logger,
+                topic = b"")
         Opens both an interactive connection and a subscription to the server.
+        The subscription receives broadcasts starting with topic.
         logger must support at least the methods of base.loggable.Loggable
         """
         super(Client, self).__init__(logger)
         # Interact with remote server
         self.raddr = remoteAddress
-        self.isock = self.cxt.socket(zmq.REQ)
+        self.isock = self.cxt.socket(self.interactiveType)
         self.isock.connect(self.raddr)
 
         # Receive broadcasts
         self.done = False
         self.background = None
-        self.listener = Subscription(broadcastAddress, self.cxt, logger)
+        self.listener = Subscription(broadcastAddress, self.cxt, logger, topic)
 
         self.lock = Lock()
         self.backgroundLock = Lock()
@@ -88,16 +142,16 @@ class Client(Loggable):
         Client.send(self, message, preprocess = lambda msg: msg)
         Send a message down the interactive socket, blocking until a reply is
         received.
-        The reply is fed through preprocess before being returned
+        The reply is fed through preprocess as bytes before being returned
         """
         with self.lock:
-            self.isock.send_string(message)
-            msg = self.isock.recv_string()
+            self.isock.send(asBytes(message))
+            msg = self.isock.recv()
 
             try:
                 msg = preprocess(msg)
             except GenericError as e:
-                self.error("Failed to preprocess message {}".format(message))
+                self.error("Failed to preprocess message {}", message)
                 raise e
             return msg
 
@@ -128,13 +182,13 @@ class Client(Loggable):
                 try:
                     msg = preprocess(msg)
                 except GenericError as e:
-                    self.error("Failed to preprocess {}".format(msg))
+                    self.error("Failed to preprocess {}", msg)
                     continue
 
                 try:
                     handler(msg)
                 except GenericError as e:
-                    self.error("Failure when handling {}".format(msg))
+                    self.error("Failure when handling {}", msg)
                     continue
 
         self.listener.stop()
@@ -174,6 +228,154 @@ class Client(Loggable):
 
         self.info("Client stopped")
 
+class PipelinedClient(Client):
+    interactiveType = zmq.DEALER
+    # Numbers the inproc request pipes, one per client
+    pipes = count()
+    def __init__(self, remoteAddress, broadcastAddress, logger, window = 64,
+            pollTimeout = 100, topic = b""):
+        """
+        PipelinedClient.__init__(self, remoteAddress, broadcastAddress,
+                logger, window = 64, pollTimeout = 100, topic = b"")
+        A client that does not wait for a reply before sending the next
+        request. Up to window requests may be awaiting replies at once;
+        submitting beyond that blocks until a reply comes back.
+        A background thread owns the interactive socket, sending queued
+        requests and matching replies to them as they arrive.
+        """
+        super(PipelinedClient, self).__init__(remoteAddress, broadcastAddress,
+                logger, topic)
+
+        self.window = Semaphore(window)
+        self.pending = {}
+        self.nextId = 0
+        self.submitLock = Lock()
+
+        # Requests are queued for the I/O thread over an inproc pipe
+        self.qaddr = "inproc://requests-{}".format(next(self.pipes))
+        self.qsock = self.cxt.socket(zmq.PULL)
+        self.qsock.bind(self.qaddr)
+        self.submitter = self.cxt.socket(zmq.PUSH)
+        self.submitter.connect(self.qaddr)
+
+        self.io = Thread(target = self.pump, args = (pollTimeout,))
+        self.io.start()
+
+    def submit(self, message, preprocess = lambda x: x, callback = None):
+        """
+        PipelinedClient.submit(self, message, preprocess = lambda msg: msg,
+                callback = None)
+        Queue a message to be sent down the interactive socket without
+        waiting for the reply.
+        Returns a concurrent.futures.Future that resolves to the reply fed
+        through preprocess. callback, if given, is called with the future
+        once the reply has arrived.
+        """
+        self.window.acquire()
+        future = Future()
+        if callback != None:
+            future.add_done_callback(callback)
+
+        with self.submitLock:
+            if self.done:
+                self.window.release()
+                future.set_exception(GenericError("Client stopped"))
+                return future
+            rid = self.nextId
+            self.nextId += 1
+            self.pending[rid] = (future, preprocess, message)
+            # The empty frame delimits the envelope for REP and ROUTER peers
+            self.submitter.send_multipart([str(rid).encode(), b"",
+                asBytes(message)])
+        return future
+
+    def send(self, message, preprocess = lambda x: x):
+        """
+        PipelinedClient.send(self, message, preprocess = lambda msg: msg)
+        Send a message down the interactive socket, blocking until a reply is
+        received.
+        The reply is fed through preprocess before being returned
+        """
+        return self.submit(message, preprocess).result()
+
+    def pump(self, pollTimeout):
+        """
+        PipelinedClient.pump(self, pollTimeout)
+        Forward queued requests to the server and resolve replies until the
+        client is stopped
+        """
+        poller = zmq.Poller()
+        poller.register(self.isock, zmq.POLLIN)
+        poller.register(self.qsock, zmq.POLLIN)
+        while True:
+            with self.lock:
+                if self.done: break
+
+            events = dict(poller.poll(pollTimeout))
+            if self.qsock in events:
+                while True:
+                    try:
+                        frames = self.qsock.recv_multipart(zmq.NOBLOCK)
+                    except zmq.Again:
+                        break
+                    self.isock.send_multipart(frames)
+
+            if self.isock in events:
+                while True:
+                    try:
+                        frames = self.isock.recv_multipart(zmq.NOBLOCK)
+                    except zmq.Again:
+                        break
+                    self.resolve(int(frames[0]), frames[-1])
+
+        self.isock.disconnect(self.raddr)
+        self.isock.close()
+        self.qsock.close()
+
+        # Nothing else will be answered
+        with self.submitLock:
+            pending = list(self.pending.values())
+            self.pending.clear()
+        for future, preprocess, message in pending:
+            future.set_exception(GenericError("Client stopped"))
+            self.window.release()
+
+    def resolve(self, rid, reply):
+        """
+        PipelinedClient.resolve(self, rid, reply)
+        Complete the request with the given ID
+        """
+        with self.submitLock:
+            future, preprocess, message = self.pending.pop(rid)
+        self.window.release()
+
+        # Anything preprocess raises belongs to the caller, not the I/O thread
+        try:
+            reply = preprocess(reply)
+        except Exception as e:
+            self.error("Failed to preprocess message {}", message)
+            future.set_exception(e)
+            return
+        future.set_result(reply)
+
+    def stop(self):
+        """
+        PipelinedClient.stop(self)
+        Stop the client entirely.
+        """
+        self.info("Stopping client")
+        with self.submitLock:
+            with self.lock:
+                self.done = True
+            self.submitter.close()
+
+        self.io.join()
+        if self.background != None:
+            self.background.join()
+            self.background = None
+
+        self.info("Client stopped")
+
 def echo(server, message):
     return message
 
@@ -186,15 +388,15 @@ if __name__ == "__main__":
     s2 = Client("tcp://127.0.0.1:5000", "tcp://127.0.0.1:5001", BitBucket)
 
     # Start broadcast handlers
-    s1.startBackground(echo, lambda m: id("1: ", m), 500)
-    s2.startBackground(echo, lambda m: id("2: ", m), 500)
+    s1.startBackground(echo, lambda m: id("1: ", m.decode()), 500)
+    s2.startBackground(echo, lambda m: id("2: ", m.decode()), 500)
 
     # Poke the server
     for i in range(10):
-        rep = s1.send("Hello", lambda m: id("1: ", m))
+        rep = s1.send("Hello", lambda m: id("1: ", m.decode()))
         print("Reply: " + rep)
 
-        rep = s2.send("Hi", lambda m: id("2: ", m))
+        rep = s2.send("Hi", lambda m: id("2: ", m.decode()))
         print("Reply: " + rep)
 
     # Stop the clients
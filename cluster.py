@@ -0,0 +1,199 @@
+import os
+import json
+import time
+import signal
+import shutil
+import logging
+import tempfile
+import threading
+import multiprocessing
+import zmq
+import textbuffer
+import protocol
+from base.exceptions import GenericError
+import winfrey
+
+# Session IDs that one run of a worker may hand out. Each restart of a worker allocates from a range of its
+# own, so that keystrokes still tagged with the session IDs of the run before are refused rather than
+# applied to whoever was given the same ID since.
+SESSIONS_PER_RUN = 1 << 20
+
+def _work( index, workers, run, filenames, interact_address, broadcast_address, engine, compress_threshold,
+           compact_threshold, convergent ):
+    """ Entry point of a worker process: hosts its share of the documents until it is killed. run counts
+        how often the worker has been restarted. """
+    signal.signal( signal.SIGUSR1, signal.SIG_IGN )
+    host = winfrey.WinfreyHost( interact_address, broadcast_address, filenames, engine, router=True,
+                                compress_threshold=compress_threshold, compact_threshold=compact_threshold,
+                                sessions=protocol.Sessions( index + 1 + run * workers * SESSIONS_PER_RUN, workers ),
+                                convergent=convergent )
+    # The front end passes SIGUSR1 on to toggle profiling
+    signal.signal( signal.SIGUSR1, lambda sig, frame: host.toggle_profiling() )
+    host.endpoint.listenThread.join()
+
+class WinfreyFrontend:
+    """ A Winfrey host that spreads its documents over a pool of worker processes, so that it is not held to
+        one core by the interpreter lock.
+
+        Each worker is a WinfreyHost for the documents assigned to it, listening on IPC sockets of its own.
+        The front end owns the public ports. Requests are passed to the worker holding their document:
+        JSON requests name it, and binary keystrokes carry a session ID, which workers allocate from
+        disjoint sequences. Replies are passed straight back. Broadcasts from every worker are forwarded to
+        the public broadcast port, together with the subscriptions that filter them, so clients still only
+        receive traffic for the document they have open.
+
+        A supervisor thread restarts workers that exit. Their documents are recovered from the operation
+        log, but their clients have to subscribe again. Restarted workers never reissue the session IDs of
+        the clients they lost.
+    """
+    def __init__( self, interact_address, broadcast_address, filenames, workers=None, engine=textbuffer.DEFAULT_ENGINE,
+                  compress_threshold=1024, compact_threshold=1024 * 1024, convergent=False ):
+        """ interact_address: Port for clients to connect to
+            broadcast_address: Port to broadcast updates over
+            filenames: Files to host
+            workers: Number of worker processes, by default one per core
+            engine: Name of the text buffer engine to hold the files in
+            compress_threshold: Size in bytes from which frames to subscribers that negotiated compression are compressed
+            compact_threshold: Size in bytes an operation log may reach before it is compacted into its file
+            convergent: Merge concurrent edits by operational transformation instead of ordering them by time """
+        self.logger = logging.getLogger( "main" )
+        self.workers = workers or os.cpu_count() or 1
+        # Documents are dealt out in turn. A restarted worker is handed the same ones and recovers them from
+        # their operation logs.
+        self.assignments = {doc: i % self.workers for i, doc in enumerate( filenames )}
+        self.options = (engine, compress_threshold, compact_threshold, convergent)
+        self.runtime = tempfile.mkdtemp( prefix="winfrey-" )
+        self.worker_addresses = ["ipc://{}/worker-{}".format( self.runtime, i ) for i in range( self.workers )]
+        self.broadcast_addresses = ["ipc://{}/broadcast-{}".format( self.runtime, i ) for i in range( self.workers )]
+        # Workers are spawned rather than forked, since the parent already has ZeroMQ contexts and threads
+        self.context = multiprocessing.get_context( "spawn" )
+        self.processes = [None] * self.workers
+        self.restarts = [0] * self.workers
+        self.superviseInterval = 1
+        self.done = False
+
+        self.cxt = zmq.Context.instance()
+        self.clients = self.cxt.socket( zmq.ROUTER )
+        self.clients.bind( interact_address )
+        self.backends = []
+        for address in self.worker_addresses:
+            backend = self.cxt.socket( zmq.DEALER )
+            backend.connect( address )
+            self.backends.append( backend )
+        self.xpub = self.cxt.socket( zmq.XPUB )
+        self.xpub.bind( broadcast_address )
+        self.xsub = self.cxt.socket( zmq.XSUB )
+        for address in self.broadcast_addresses:
+            self.xsub.connect( address )
+
+        for i in range( self.workers ):
+            self._spawn( i )
+
+        self.rpc_funcs = {
+                "documents": self.list_documents,
+                "stats": self.stats
+        }
+
+        self.route_thread = threading.Thread( target=self._route_loop )
+        self.route_thread.start()
+        self.proxy_thread = threading.Thread( target=self._proxy_loop, daemon=True )
+        self.proxy_thread.start()
+        self.supervise_thread = threading.Thread( target=self._supervise, daemon=True )
+        self.supervise_thread.start()
+
+    def list_documents( self ):
+        """ Returns the IDs of the hosted documents """
+        return {"status": "ok", "other": sorted( self.assignments )}
+
+    def stats( self ):
+        """ Returns which worker holds each document and how often each worker has been restarted """
+        return {"status": "ok", "other": {"workers": self.workers, "assignments": dict( self.assignments ),
+                                          "restarts": list( self.restarts )}}
+
+    def toggle_profiling( self ):
+        """ Starts or stops profiling every worker. Each writes its own profile to logs/ when stopped. """
+        for process in self.processes:
+            if process.is_alive():
+                os.kill( process.pid, signal.SIGUSR1 )
+
+    def stop( self ):
+        """ Stops routing and kills the workers """
+        self.done = True
+        self.route_thread.join()
+        for process in self.processes:
+            process.terminate()
+            process.join()
+        shutil.rmtree( self.runtime, ignore_errors=True )
+
+    def _spawn( self, index ):
+        filenames = [doc for doc, worker in self.assignments.items() if worker == index]
+        process = self.context.Process( target=_work, daemon=True,
+                                        args=(index, self.workers, self.restarts[index], filenames,
+                                              self.worker_addresses[index],
+                                              self.broadcast_addresses[index]) + self.options )
+        process.start()
+        self.processes[index] = process
+
+    def _supervise( self ):
+        """ Restarts workers that have exited """
+        while not self.done:
+            time.sleep( self.superviseInterval )
+            for i, process in enumerate( self.processes ):
+                if not process.is_alive() and not self.done:
+                    self.logger.error( "Worker %s exited with code %s, restarting", i, process.exitcode )
+                    self.restarts[i] += 1
+                    self._spawn( i )
+
+    def _proxy_loop( self ):
+        """ Forwards broadcasts from the workers to clients, and subscriptions from clients to the workers """
+        try:
+            zmq.proxy( self.xsub, self.xpub )
+        except zmq.ContextTerminated:
+            pass
+
+    def _route_loop( self, pollTimeout=500 ):
+        """ Passes requests to the workers holding their documents and replies back to the clients """
+        poller = zmq.Poller()
+        poller.register( self.clients, zmq.POLLIN )
+        for backend in self.backends:
+            poller.register( backend, zmq.POLLIN )
+        while not self.done:
+            events = dict( poller.poll( pollTimeout ) )
+            for backend in self.backends:
+                if backend in events:
+                    while True:
+                        try:
+                            frames = backend.recv_multipart( zmq.NOBLOCK )
+                        except zmq.Again:
+                            break
+                        self.clients.send_multipart( frames )
+            if self.clients in events:
+                while True:
+                    try:
+                        frames = self.clients.recv_multipart( zmq.NOBLOCK )
+                    except zmq.Again:
+                        break
+                    worker, reply = self._route( frames[-1] )
+                    if worker is None:
+                        self.clients.send_multipart( frames[:-1] + [json.dumps( reply ).encode()] )
+                    else:
+                        self.backends[worker].send_multipart( frames )
+
+    def _route( self, message ):
+        """ Returns the worker a request should be passed to, or None and the front end's own reply """
+        if protocol.is_binary( message ):
+            try:
+                return (protocol.request_sid( message ) - 1) % self.workers, None
+            except GenericError:
+                return None, {"status": "fail", "other": "malformed_message"}
+        try:
+            procedure = winfrey.deserialize( message )
+        except (ValueError, GenericError):
+            return None, {"status": "fail", "other": "malformed_message"}
+        if "doc" in procedure:
+            worker = self.assignments.get( procedure["doc"] )
+            if worker is None:
+                return None, {"status": "fail", "other": "no_such_document"}
+            return worker, None
+        function = self.rpc_funcs.get( procedure.get( "name" ), winfrey.WinfreyDocument.no_such_function )
+        return None, function( *procedure.get( "args", [] ) )
@@ -0,0 +1,168 @@
+import random
+
+class _Row:
+    """ A treap node holding every cursor on one row.
+
+        key is only exact once the pending shifts of all ancestors have been
+        pushed down; lazy is the shift still owed to this node's children.
+    """
+    __slots__ = ('key', 'lazy', 'prio', 'cids', 'left', 'right', 'parent')
+
+    def __init__( self, key ):
+        self.key = key
+        self.lazy = 0
+        self.prio = random.random()
+        self.cids = set()
+        self.left = None
+        self.right = None
+        self.parent = None
+
+def _push( n ):
+    if n.lazy:
+        for child in (n.left, n.right):
+            if child:
+                child.key += n.lazy
+                child.lazy += n.lazy
+        n.lazy = 0
+
+def _split( n, key ):
+    """ Splits a treap into rows before key and rows from key onwards """
+    if n is None:
+        return (None, None)
+    _push( n )
+    if n.key < key:
+        a, b = _split( n.right, key )
+        n.right = a
+        if a:
+            a.parent = n
+        return (n, b)
+    a, b = _split( n.left, key )
+    n.left = b
+    if b:
+        b.parent = n
+    return (a, n)
+
+def _merge( a, b ):
+    """ Concatenates two treaps where every row of a comes before every row of b """
+    if a is None:
+        return b
+    if b is None:
+        return a
+    if a.prio > b.prio:
+        _push( a )
+        a.right = _merge( a.right, b )
+        a.right.parent = a
+        return a
+    _push( b )
+    b.left = _merge( a, b.left )
+    b.left.parent = b
+    return b
+
+class CursorIndex:
+    """ Every cursor in a document, indexed by the row it sits on.
+
+        Rows holding cursors live in a treap whose subtrees can be shifted by
+        a lazy offset, so moving every cursor below a line, finding a cursor's
+        row and listing the cursors on a row all take O(log n) in the number
+        of occupied rows.
+    """
+    def __init__( self ):
+        self.root = None
+        self.nodes = {}
+        self.cols = {}
+
+    def __len__( self ):
+        return len( self.cols )
+
+    def __contains__( self, cid ):
+        return cid in self.cols
+
+    def __iter__( self ):
+        return iter( list( self.cols ) )
+
+    def add( self, cid, cx, cy ):
+        """ Adds a cursor, replacing any existing cursor with the same ID """
+        if cid in self.cols:
+            self.remove( cid )
+        node = self._find( cy )
+        if node is None:
+            node = _Row( cy )
+            left, right = _split( self.root, cy )
+            self._set_root( _merge( _merge( left, node ), right ) )
+        node.cids.add( cid )
+        self.nodes[cid] = node
+        self.cols[cid] = cx
+
+    def remove( self, cid ):
+        node = self.nodes.pop( cid )
+        del self.cols[cid]
+        node.cids.discard( cid )
+        if not node.cids:
+            key = self._key( node )
+            left, rest = _split( self.root, key )
+            middle, right = _split( rest, key + 1 )
+            self._set_root( _merge( left, right ) )
+
+    def get( self, cid ):
+        """ Returns the (column, row) position of a cursor """
+        return (self.cols[cid], self._key( self.nodes[cid] ))
+
+    def row( self, cid ):
+        return self._key( self.nodes[cid] )
+
+    def col( self, cid ):
+        return self.cols[cid]
+
+    def move( self, cid, cx, cy ):
+        """ Places a cursor at an absolute position """
+        if self._key( self.nodes[cid] ) == cy:
+            self.cols[cid] = cx
+        else:
+            self.add( cid, cx, cy )
+
+    def on_row( self, row ):
+        """ Returns a list of (cursor ID, column) pairs for the cursors on a row """
+        node = self._find( row )
+        if node is None:
+            return []
+        return [(cid, self.cols[cid]) for cid in node.cids]
+
+    def columns( self, row ):
+        """ Returns the columns of all cursors on a row """
+        return [col for cid, col in self.on_row( row )]
+
+    def shift( self, row, delta ):
+        """ Moves every cursor on the given row or below it down by delta rows.
+            When delta is negative the rows being moved into must be empty. """
+        left, right = _split( self.root, row )
+        if right:
+            right.key += delta
+            right.lazy += delta
+        self._set_root( _merge( left, right ) )
+
+    def to_dict( self ):
+        """ Returns a {cid: {"cx": ..., "cy": ...}} snapshot of every cursor """
+        return {cid: {"cx": self.cols[cid], "cy": self._key( node )} for cid, node in self.nodes.items()}
+
+    def _find( self, row ):
+        n = self.root
+        while n:
+            _push( n )
+            if row == n.key:
+                return n
+            n = n.left if row < n.key else n.right
+        return None
+
+    def _key( self, node ):
+        """ Returns the exact row of a node by adding up the shifts still pending above it """
+        key = node.key
+        p = node.parent
+        while p:
+            key += p.lazy
+            p = p.parent
+        return key
+
+    def _set_root( self, root ):
+        if root:
+            root.parent = None
+        self.root = root
@@ -1,14 +1,28 @@
+import os
+import time
+import threading
 import urwid
+from collections import OrderedDict
 
 CURSOR = u"\u2588";
+# Number of line widgets kept around, which must cover the visible window with a margin to spare
+CACHED_WIDGETS = 256;
+# Shortest time between two redraws
+FRAME = 1 / 60;
 
 class MultiCursorGui:
 
-    def __init__( self, lines=[], on_key=None, on_cursor=None, on_interrupt=None ):
-        """ Create a new MultiCursorGui
+    def __init__( self, count, fetch, on_key=None, on_cursor=None, on_interrupt=None, on_view=None ):
+        """ Create a new MultiCursorGui. Lines are read from the document as they come into view.
         
         Args:
-            lines (str array): Initial list of line contents. Must not contain newlines.
+            count (function): Returns the number of lines in the document. Format is:
+                count()
+            fetch (function): Returns the contents of a line and its cursor positions. Format is:
+                fetch( line ) -> (text, cursors)
+                    line (int): Index of line (from 0)
+                    text (str): Line contents. Must not contain newlines.
+                    cursors (int array): List of cursor positions within the line
             on_key (function): Callback for when user presses a character key. Format is:
                 on_key( key )
                     key (str): Single character representing character key
@@ -16,36 +30,54 @@ class MultiCursorGui:
                 on_cursor( mvmt )
                     mvmt (str): String representing cursor movement. Valid values are:
                                 'left', 'right', 'up', 'down', 'backspace', 'delete', 'enter'
+            on_view (function): Callback for when a different range of lines comes into view. Format is:
+                on_view( first, last )
+                    first (int): Index of the first visible line
+                    last (int): Index of the last visible line
         """
         self.started = False;
-        self.walker = MultiCursorListWalker();
-        self.lines = MultiCursorListBox( self.walker, lines, on_key, on_cursor, on_interrupt );
+        self.walker = MultiCursorListWalker( count, fetch );
+        self.lines = MultiCursorListBox( self.walker, on_key, on_cursor, on_interrupt, on_view );
         self.loop = urwid.MainLoop( self.lines );
 
+        # Changes may come from any thread, but only the UI thread touches widgets or the screen. Other
+        # threads note what changed and wake it through a pipe, and it redraws at most once per FRAME.
+        self.pending_lock = threading.Lock();
+        self.pending = set();
+        self.reshaped = False;
+        self.scheduled = False;
+        self.last_draw = 0;
+        self.wake = self.loop.watch_pipe( self._on_wake );
+
     def launch( self ):
-        self.started = True;
+        with self.pending_lock:
+            self.started = True;
+            self.pending.clear();
+            self.reshaped = False;
+        self.walker.refresh();
         self.loop.run();
 
-    def change_line( self, line, text, cursors ):
-        """ Sets text and cursor positions for a single line.
+    def change_line( self, line ):
+        """ Notes that the text or cursors of a single line have changed. The screen is redrawn shortly
+            after, reading the line back with fetch, so nothing about it is built until then.
 
             Args:
-                line (int): Index of line to be changed (from 0)
-                text (str): Text to overwrite line with
-                cursors (int array): List of cursor positions within the line
+                line (int): Index of line that changed (from 0)
         """
-        loop = self.loop if self.started else None
-        self.walker.change_line( line, text, cursors, loop );
+        self._invalidate( line );
+
+    def refresh( self ):
+        """ Rereads every line, for when the whole document has been replaced """
+        self._invalidate( None );
 
-    def add_line( self, prev_pos, text, cursors ):
-        """ Adds a line beneath the given position.
+    def add_line( self, prev_pos ):
+        """ Adds a line beneath the given position. Its text is read back with fetch when the screen is
+            redrawn.
 
             Args:
                 prev_pos (int): Index of line which will come immediately before the new line
-                text (str): Text for the new line to inherit
-                cursors (int array): List of cursor positions within the new line
         """
-        self.walker.add_line( prev_pos, text, cursors );
+        self._invalidate( None );
 
     def delete_line( self, line ):
         """ Deletes the given line.
@@ -53,7 +85,46 @@ class MultiCursorGui:
             Args:
                 line (int): Index of line to be deleted
         """
-        self.walker.delete_line( line );
+        self._invalidate( None );
+
+    def _invalidate( self, line ):
+        """ Notes that a line, or with None the line numbering, has changed and schedules a redraw """
+        with self.pending_lock:
+            if line is None:
+                self.reshaped = True;
+            else:
+                self.pending.add( line );
+            if self.scheduled or not self.started:
+                return;
+            self.scheduled = True;
+        os.write( self.wake, b"!" );
+
+    def _on_wake( self, data ):
+        """ Runs on the UI thread once something has changed """
+        wait = self.last_draw + FRAME - time.monotonic();
+        if wait > 0:
+            self.loop.set_alarm_in( wait, self._redraw );
+        else:
+            self._redraw();
+        return True;
+
+    def _redraw( self, loop=None, user_data=None ):
+        """ Brings every changed line up to date in a single redraw """
+        with self.pending_lock:
+            lines, self.pending = self.pending, set();
+            reshaped, self.reshaped = self.reshaped, False;
+            self.scheduled = False;
+        if reshaped:
+            self.walker.refresh();
+        else:
+            self.walker.reload( lines );
+        self.last_draw = time.monotonic();
+        self.loop.draw_screen();
+
+def attach( editor ):
+    """ Returns a MultiCursorGui showing the document of a backend.editor_state, for passing to it as its view """
+    return MultiCursorGui( editor.line_count, editor.line_view, editor.insert_my_char, editor.move_my_cursor,
+                           editor.interrupt, editor.view );
 
 class MultiCursorText( urwid.Text ):
     def __init__( self, text="" ):
@@ -71,15 +142,23 @@ class MultiCursorText( urwid.Text ):
         self.set_text( text );
 
 class MultiCursorListWalker( urwid.ListWalker ):
-    def __init__( self ):
+    """ A list walker over a document that only holds widgets for the lines urwid has asked for lately.
+
+        Widgets are created from the document on demand and kept by position, the least recently used
+        being dropped once there are more than CACHED_WIDGETS. When lines are added or deleted the cache
+        is simply dropped, so only the visible window is read again whatever the size of the document.
+    """
+    def __init__( self, count, fetch ):
         self.focus = 0;
-        self.lines = [];
+        self.count = count;
+        self.fetch = fetch;
+        self.widgets = OrderedDict();
 
     def get_focus( self ):
         return self._get_widget_at( self.focus );
 
     def set_focus( self, focus ):
-        if focus < len( self.lines ):
+        if focus < self.count():
             self.focus = focus;
             self._modified();
         else:
@@ -91,41 +170,54 @@ class MultiCursorListWalker( urwid.ListWalker ):
     def get_prev( self, pos ):
         return self._get_widget_at( pos - 1 );
 
-    def add_line( self, prev_pos, text, cursors ):
-        nwidget = MultiCursorText();
-        self.lines.insert( prev_pos + 1, nwidget );
-        nwidget.set_line( text, cursors );
-
-    def delete_line( self, pos ):
-        widget, ignore = self._get_widget_at( pos );
-        self.lines.remove( widget );
+    def refresh( self ):
+        """ Drops every widget, for when lines have been added, deleted or replaced """
+        self.widgets.clear();
+        self.focus = max( 0, min( self.focus, self.count() - 1 ) );
+        self._modified();
 
-    def change_line( self, pos, text, cursors, loop ):
-        widget, ignore = self._get_widget_at( pos );
-        widget.set_line( text, cursors );
-        if loop:
-            loop.draw_screen()
-        self._modified()
+    def reload( self, lines ):
+        """ Rereads the given lines from the document, if they have widgets """
+        for pos in lines:
+            widget = self.widgets.get( pos );
+            if widget:
+                widget.set_line( *self.fetch( pos ) );
+        self._modified();
 
     def _get_widget_at( self, pos ):
-        if pos < 0 or pos >= len( self.lines ):
+        if pos < 0 or pos >= self.count():
             return (None, None);
+        widget = self.widgets.get( pos );
+        if widget is None:
+            widget = MultiCursorText();
+            widget.set_line( *self.fetch( pos ) );
+            self.widgets[pos] = widget;
+            if len( self.widgets ) > CACHED_WIDGETS:
+                self.widgets.popitem( last=False );
         else:
-            return (self.lines[pos], pos);
+            self.widgets.move_to_end( pos );
+        return (widget, pos);
 
 class MultiCursorListBox( urwid.ListBox ):
-    def __init__( self, walker, lines, on_key=None, on_cursor=None, on_interrupt=None ):
+    def __init__( self, walker, on_key=None, on_cursor=None, on_interrupt=None, on_view=None ):
         self.on_key = on_key;
         self.on_cursor = on_cursor;
         self.on_interrupt = on_interrupt;
+        self.on_view = on_view;
+        self.view = None;
         super().__init__( walker );
-        self.set_all_lines( lines );
 
-    def set_all_lines( self, lines ):
-        pos = 0;
-        for line in lines:
-            self.body.add_line( pos - 1, line, [0] if pos == 0 else [] );
-            pos += 1;
+    def render( self, size, focus=False ):
+        canvas = super().render( size, focus );
+        if self.on_view:
+            middle, top, bottom = self.calculate_visible( size, focus );
+            if middle:
+                lines = [middle[2]] + [pos for widget, pos, rows in top[1] + bottom[1]];
+                view = (min( lines ), max( lines ));
+                if view != self.view:
+                    self.view = view;
+                    self.on_view( *view );
+        return canvas;
 
     def keypress( self, size, key ):
         if (key == 'right'):
@@ -0,0 +1,164 @@
+import os
+import time
+import bisect
+import threading
+
+# Bucket bounds, in seconds, for histograms of how long something took
+LATENCY_BUCKETS = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5)
+# Bucket bounds for histograms of how many things there were
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512)
+
+def _labels( label, key, extra="" ):
+    pairs = []
+    if label is not None:
+        value = str( key ).replace( '\\', '\\\\' ).replace( '"', '\\"' ).replace( '\n', '\\n' )
+        pairs.append( '{}="{}"'.format( label, value ) )
+    if extra:
+        pairs.append( extra )
+    return "{" + ",".join( pairs ) + "}" if pairs else ""
+
+def _number( value ):
+    return repr( float( value ) ) if isinstance( value, float ) else str( value )
+
+class Counter:
+    """ A count that only goes up, kept separately for each value of its label if it has one """
+    kind = "counter"
+
+    def __init__( self, name, help, label=None ):
+        self.name = name
+        self.help = help
+        self.label = label
+        # Without a label there is a single count, reported even while it is still zero
+        self.values = {} if label else {None: 0}
+        self.lock = threading.Lock()
+
+    def inc( self, key=None, amount=1 ):
+        with self.lock:
+            self.values[key] = self.values.get( key, 0 ) + amount
+
+    def collect( self ):
+        with self.lock:
+            return dict( self.values )
+
+    def samples( self ):
+        return [(self.name + _labels( self.label, key ), value) for key, value in self.collect().items()]
+
+class Gauge:
+    """ A value that goes up and down. It is either set, or read from function when collected, which may
+        return a dictionary of values by label. """
+    kind = "gauge"
+
+    def __init__( self, name, help, function=None, label=None ):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.function = function
+        self.value = 0
+
+    def set( self, value ):
+        self.value = value
+
+    def collect( self ):
+        value = self.function() if self.function else self.value
+        return dict( value ) if isinstance( value, dict ) else {None: value}
+
+    def samples( self ):
+        return [(self.name + _labels( self.label, key ), value) for key, value in self.collect().items()]
+
+class Histogram:
+    """ Counts observations into buckets by the upper bounds given, with their sum, kept separately for each
+        value of its label if it has one """
+    kind = "histogram"
+
+    def __init__( self, name, help, buckets=LATENCY_BUCKETS, label=None ):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = tuple( buckets )
+        # Per label value: a count for every bucket plus one past the last, the sum and the total count
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe( self, value, key=None ):
+        i = bisect.bisect_left( self.buckets, value )
+        with self.lock:
+            counts = self.values.get( key )
+            if counts is None:
+                counts = self.values[key] = [[0] * (len( self.buckets ) + 1), 0.0, 0]
+            counts[0][i] += 1
+            counts[1] += value
+            counts[2] += 1
+
+    def collect( self ):
+        """ Returns the cumulative count up to every bucket bound, the sum and the count of each label value """
+        with self.lock:
+            values = {key: (list( counts ), total, n) for key, (counts, total, n) in self.values.items()}
+        collected = {}
+        for key, (counts, total, n) in values.items():
+            running = 0
+            buckets = {}
+            for bound, count in zip( self.buckets + ("+Inf",), counts ):
+                running += count
+                buckets[str( bound )] = running
+            collected[key] = {"buckets": buckets, "sum": total, "count": n}
+        return collected
+
+    def samples( self ):
+        samples = []
+        for key, value in self.collect().items():
+            for bound, count in value["buckets"].items():
+                samples.append( (self.name + "_bucket" + _labels( self.label, key, 'le="{}"'.format( bound ) ), count) )
+            samples.append( (self.name + "_sum" + _labels( self.label, key ), value["sum"]) )
+            samples.append( (self.name + "_count" + _labels( self.label, key ), value["count"]) )
+        return samples
+
+class Registry:
+    """ The metrics of one server or client. Updating one takes a single uncontended lock at most, and
+        nothing is formatted until the metrics are collected. """
+    def __init__( self ):
+        self.metrics = []
+
+    def counter( self, name, help, label=None ):
+        return self._add( Counter( name, help, label ) )
+
+    def gauge( self, name, help, function=None, label=None ):
+        return self._add( Gauge( name, help, function, label ) )
+
+    def histogram( self, name, help, buckets=LATENCY_BUCKETS, label=None ):
+        return self._add( Histogram( name, help, buckets, label ) )
+
+    def collect( self ):
+        """ Returns every metric as a dictionary, for the stats RPC. Values are keyed by label value, or by
+            "" for metrics without a label. """
+        return {metric.name: {("" if key is None else str( key )): value for key, value in metric.collect().items()}
+                for metric in self.metrics}
+
+    def prometheus( self ):
+        """ Returns every metric in the Prometheus text exposition format """
+        lines = []
+        for metric in self.metrics:
+            lines.append( "# HELP {} {}".format( metric.name, metric.help ) )
+            lines.append( "# TYPE {} {}".format( metric.name, metric.kind ) )
+            lines.extend( "{} {}".format( name, _number( value ) ) for name, value in metric.samples() )
+        return "\n".join( lines ) + "\n"
+
+    def write( self, path ):
+        """ Writes every metric to a file in the Prometheus text format, replacing it whole so that a
+            scraper never reads half of it """
+        with open( path + ".tmp", 'w' ) as f:
+            f.write( self.prometheus() )
+        os.replace( path + ".tmp", path )
+
+    def export( self, path, interval=5 ):
+        """ Writes the metrics to a file every interval seconds from a background thread """
+        def loop():
+            while True:
+                self.write( path )
+                time.sleep( interval )
+        thread = threading.Thread( target=loop, daemon=True )
+        thread.start()
+        return thread
+
+    def _add( self, metric ):
+        self.metrics.append( metric )
+        return metric
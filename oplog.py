@@ -0,0 +1,214 @@
+import os
+import json
+import logging
+import time
+import threading
+
+def identify( path ):
+    """ Returns what checkpoints use to recognise a version of the base file, its size and modification
+        time, or None if there is no such file. Unlike a digest this does not read the file. """
+    try:
+        st = os.stat( path )
+    except FileNotFoundError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
+
+def _read( path ):
+    """ Returns the records in a log, or [] if there is no log or it does not start with a checkpoint.
+        A record cut short by a crash ends the log. """
+    records = []
+    try:
+        with open( path ) as f:
+            for line in f:
+                try:
+                    records.append( json.loads( line ) )
+                except ValueError:
+                    break
+    except FileNotFoundError:
+        return []
+    if not records or records[0].get( "type" ) != "checkpoint":
+        return []
+    return records
+
+def _last_seq( records ):
+    return records[-1]["seq"] if len( records ) > 1 else records[0]["version"]
+
+def replay( records, functions, logger=None ):
+    """ Applies the batches in records, as returned by OpLog.recover, by calling the function in functions
+        named by each procedure with its arguments. Returns the version the last batch brought the document
+        to. Procedures that no function is named for or that have the wrong arguments are skipped with an
+        error, so that one bad record cannot keep the document from being hosted again. """
+    logger = logger or logging.getLogger( "main" )
+    for batch in records[1:]:
+        for procedure in batch["ops"]:
+            function = functions.get( procedure.get( "name" ) )
+            if function is None:
+                logger.error( "Skipped unknown procedure %r in batch %s of the operation log",
+                              procedure.get( "name" ), batch["seq"] )
+                continue
+            try:
+                function( *procedure["args"] )
+            except (KeyError, IndexError, TypeError, ValueError) as e:
+                logger.error( "Skipped procedure %r in batch %s of the operation log: %r",
+                              procedure.get( "name" ), batch["seq"], e )
+    return _last_seq( records )
+
+def _fsync_dir( path ):
+    fd = os.open( os.path.dirname( os.path.abspath( path ) ), os.O_RDONLY )
+    try:
+        os.fsync( fd )
+    finally:
+        os.close( fd )
+
+class OpLog:
+    """ A write-ahead log of the batches applied to a document since its base file was last written.
+
+        Every log starts with a checkpoint record identifying the base file it applies to, the broadcast
+        version the base was written at and the cursors that existed then. One record follows per applied
+        batch. Records are written by a background thread, which fsyncs whatever has queued up since its last
+        fsync, so batches arriving close together share one fsync and nobody waits on it.
+
+        Compaction writes the new base file to one side while batches keep going to the old log, starts a
+        new log with the batches applied since the document was captured, replaces the base file, then
+        renames the new log into place. A crash at any point leaves a base file and logs that recover
+        replays correctly.
+    """
+    def __init__( self, base, path=None, sync_delay=0.05 ):
+        """ base: Path of the document the log applies to
+            path: Path of the log, by default next to the document
+            sync_delay: Seconds to let records gather after each fsync """
+        self.base = base
+        self.path = path or base + ".oplog"
+        self.next_path = self.path + ".next"
+        self.sync_delay = sync_delay
+
+        self.cond = threading.Condition()
+        self.pending = []
+        self.queued = 0
+        self.synced = 0
+        self.written = 0
+        # Batches written since a rotation began, which the new log must repeat
+        self.held = None
+        self.closed = False
+        self.file = None
+        self.writer = threading.Thread( target=self._write_loop, daemon=True )
+        self.writer.start()
+
+    def recover( self ):
+        """ Returns the records to replay on top of the base file: the checkpoint the log was started from
+            followed by every batch logged since. Logs that were not started from the base file as it is,
+            for instance because it was edited elsewhere, are set aside with a .stale suffix. """
+        base = identify( self.base )
+        current = _read( self.path )
+        following = _read( self.next_path )
+        if following and following[0]["base"] == base:
+            # Compaction replaced the base file but did not get to rename its log into place
+            return following
+        if current and current[0]["base"] == base:
+            # Compaction had started a new log but not replaced the base file
+            last = _last_seq( current )
+            return current + [record for record in following[1:] if record["seq"] > last]
+        for path in (self.path, self.next_path):
+            if os.path.exists( path ):
+                os.replace( path, path + ".stale" )
+        return []
+
+    def start( self, version, cursors ):
+        """ Starts the log afresh from the base file as it is on disk """
+        self._switch( self.path, identify( self.base ), version, cursors )
+
+    def rotate( self ):
+        """ Begins compaction. Must be called while the document is captured, under whatever lock keeps
+            batches from being appended meanwhile. """
+        self._queue( ("rotate", None) )
+
+    def commit( self, chunks, version, cursors ):
+        """ Finishes compaction by writing the captured document, given as a sequence of pieces, as the new
+            base file, and starting a new log from it """
+        tmp = self.base + ".tmp"
+        with open( tmp, 'w' ) as f:
+            for chunk in chunks:
+                f.write( chunk )
+            f.flush()
+            os.fsync( f.fileno() )
+        self._switch( self.next_path, identify( tmp ), version, cursors )
+        # The new log's checkpoint must be on disk before the base file it names
+        self.flush()
+        os.replace( tmp, self.base )
+        os.replace( self.next_path, self.path )
+        _fsync_dir( self.base )
+
+    def append( self, seq, procedures ):
+        """ Queues an applied batch to be logged. The batch is serialized straight away, since the caller
+            is free to reuse it. """
+        self._queue( ("record", json.dumps( {"type": "batch", "seq": seq, "ops": procedures} ) + "\n") )
+
+    def flush( self ):
+        """ Blocks until every record queued so far is on disk """
+        with self.cond:
+            target = self.queued
+            while self.synced < target and not self.closed:
+                self.cond.wait()
+
+    def size( self ):
+        """ Returns the number of bytes in the current log """
+        return self.written
+
+    def close( self ):
+        self.flush()
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.writer.join()
+
+    def _switch( self, path, base, version, cursors ):
+        self._queue( ("switch", (path, {"type": "checkpoint", "base": base, "version": version,
+                                        "cursors": cursors})) )
+
+    def _queue( self, *items ):
+        with self.cond:
+            self.pending.extend( items )
+            self.queued += len( items )
+            self.cond.notify_all()
+
+    def _write_loop( self ):
+        while True:
+            with self.cond:
+                while not self.pending and not self.closed:
+                    self.cond.wait()
+                if not self.pending:
+                    break
+                pending, self.pending = self.pending, []
+            for kind, item in pending:
+                if kind == "rotate":
+                    self.held = []
+                elif kind == "switch":
+                    # Later records go to a new log, after its checkpoint and anything held for it
+                    path, checkpoint = item
+                    if self.file:
+                        self.file.flush()
+                        os.fsync( self.file.fileno() )
+                        self.file.close()
+                    self.file = open( path, 'w' )
+                    self.written = 0
+                    self._write( json.dumps( checkpoint ) + "\n" )
+                    for line in self.held or ():
+                        self._write( line )
+                    self.held = None
+                else:
+                    self._write( item )
+                    if self.held is not None:
+                        self.held.append( item )
+            if self.file:
+                self.file.flush()
+                os.fsync( self.file.fileno() )
+            with self.cond:
+                self.synced += len( pending )
+                self.cond.notify_all()
+            time.sleep( self.sync_delay )
+        if self.file:
+            self.file.close()
+
+    def _write( self, line ):
+        self.file.write( line )
+        self.written += len( line )
@@ -0,0 +1,204 @@
+from base.exceptions import GenericError
+
+# Operational transformation over plain text, for documents whose clients edit optimistically.
+#
+# An operation is a list of components that together span the whole document it applies to: a positive int
+# keeps that many characters, a negative int deletes that many, and a string is inserted. Operations are
+# kept in a canonical form in which adjacent components of the same kind are merged and an insert always
+# comes before a delete at the same place, so that they are JSON as they stand and compare equal when they
+# do the same thing.
+
+class OperationError(GenericError): pass
+
+def is_retain( component ):
+    return isinstance( component, int ) and component > 0
+
+def is_insert( component ):
+    return isinstance( component, str )
+
+def is_delete( component ):
+    return isinstance( component, int ) and component < 0
+
+def retain( operation, n ):
+    """ Appends a component keeping n characters """
+    if n <= 0:
+        return
+    if operation and is_retain( operation[-1] ):
+        operation[-1] += n
+    else:
+        operation.append( n )
+
+def insert( operation, text ):
+    """ Appends a component inserting text, ahead of any delete it follows """
+    if not text:
+        return
+    if operation and is_insert( operation[-1] ):
+        operation[-1] += text
+    elif operation and is_delete( operation[-1] ):
+        if len( operation ) > 1 and is_insert( operation[-2] ):
+            operation[-2] += text
+        else:
+            operation.insert( len( operation ) - 1, text )
+    else:
+        operation.append( text )
+
+def delete( operation, n ):
+    """ Appends a component deleting n characters """
+    if n <= 0:
+        return
+    if operation and is_delete( operation[-1] ):
+        operation[-1] -= n
+    else:
+        operation.append( -n )
+
+def splice( length, offset, text="", count=0 ):
+    """ Returns the operation on a document of length characters that deletes count characters at offset and
+        inserts text there """
+    if offset < 0 or count < 0 or offset + count > length:
+        raise OperationError( "Splice of {} at {} is outside a document of {}".format( count, offset, length ) )
+    operation = []
+    retain( operation, offset )
+    insert( operation, text )
+    delete( operation, count )
+    retain( operation, length - offset - count )
+    return operation
+
+def base_length( operation ):
+    """ Returns the length of the documents the operation applies to """
+    return sum( abs( component ) for component in operation if not is_insert( component ) )
+
+def target_length( operation ):
+    """ Returns the length of the document the operation leaves behind """
+    return sum( len( component ) if is_insert( component ) else component
+                for component in operation if not is_delete( component ) )
+
+def apply( text, operation ):
+    """ Returns the text an operation leaves behind when applied to text """
+    if base_length( operation ) != len( text ):
+        raise OperationError( "Operation on {} characters applied to {}".format( base_length( operation ),
+                                                                                 len( text ) ) )
+    pieces, index = [], 0
+    for component in operation:
+        if is_insert( component ):
+            pieces.append( component )
+        elif is_retain( component ):
+            pieces.append( text[index:index + component] )
+            index += component
+        else:
+            index -= component
+    return "".join( pieces )
+
+def is_noop( operation ):
+    return all( is_retain( component ) for component in operation )
+
+def edits( operation ):
+    """ Yields the edits an operation makes as (offset, text, count) in the order they apply: count characters
+        deleted and text inserted at offset, which is into the document as the edits before it left it """
+    offset = 0
+    for component in operation:
+        if is_insert( component ):
+            yield offset, component, 0
+            offset += len( component )
+        elif is_retain( component ):
+            offset += component
+        else:
+            yield offset, "", -component
+
+def compose( a, b ):
+    """ Returns a single operation with the effect of applying a and then b """
+    if target_length( a ) != base_length( b ):
+        raise OperationError( "Operations of {} and {} characters do not compose".format( target_length( a ),
+                                                                                           base_length( b ) ) )
+    composed = []
+    ia, ib = iter( a ), iter( b )
+    x, y = next( ia, None ), next( ib, None )
+    while x is not None or y is not None:
+        if x is not None and is_delete( x ):
+            delete( composed, -x )
+            x = next( ia, None )
+        elif y is not None and is_insert( y ):
+            insert( composed, y )
+            y = next( ib, None )
+        elif x is None or y is None:
+            raise OperationError( "Operations do not compose" )
+        elif is_retain( x ) and is_retain( y ):
+            n = min( x, y )
+            retain( composed, n )
+            x = x - n or next( ia, None )
+            y = y - n or next( ib, None )
+        elif is_insert( x ) and is_delete( y ):
+            # Text inserted by a and deleted by b was never there
+            n = min( len( x ), -y )
+            x = x[n:] or next( ia, None )
+            y = y + n or next( ib, None )
+        elif is_insert( x ):
+            n = min( len( x ), y )
+            insert( composed, x[:n] )
+            x = x[n:] or next( ia, None )
+            y = y - n or next( ib, None )
+        else:
+            n = min( x, -y )
+            delete( composed, n )
+            x = x - n or next( ia, None )
+            y = y + n or next( ib, None )
+    return composed
+
+def transform( a, b ):
+    """ Takes two operations made concurrently on the same document and returns (a', b'), where applying a
+        then b' has the same effect as applying b then a'. Where both insert at the same place, a's text
+        comes first. """
+    if base_length( a ) != base_length( b ):
+        raise OperationError( "Operations on {} and {} characters are not concurrent".format( base_length( a ),
+                                                                                               base_length( b ) ) )
+    a_prime, b_prime = [], []
+    ia, ib = iter( a ), iter( b )
+    x, y = next( ia, None ), next( ib, None )
+    while x is not None or y is not None:
+        if x is not None and is_insert( x ):
+            insert( a_prime, x )
+            retain( b_prime, len( x ) )
+            x = next( ia, None )
+        elif y is not None and is_insert( y ):
+            retain( a_prime, len( y ) )
+            insert( b_prime, y )
+            y = next( ib, None )
+        elif x is None or y is None:
+            raise OperationError( "Operations are not concurrent" )
+        elif is_retain( x ) and is_retain( y ):
+            n = min( x, y )
+            retain( a_prime, n )
+            retain( b_prime, n )
+            x = x - n or next( ia, None )
+            y = y - n or next( ib, None )
+        elif is_delete( x ) and is_delete( y ):
+            # Both deleted the same characters, so neither has to any more
+            n = min( -x, -y )
+            x = x + n or next( ia, None )
+            y = y + n or next( ib, None )
+        elif is_delete( x ):
+            n = min( -x, y )
+            delete( a_prime, n )
+            x = x + n or next( ia, None )
+            y = y - n or next( ib, None )
+        else:
+            n = min( x, -y )
+            delete( b_prime, n )
+            x = x - n or next( ia, None )
+            y = y + n or next( ib, None )
+    return a_prime, b_prime
+
+def transform_index( index, operation ):
+    """ Returns where an offset into a document ends up once the operation is applied. Text inserted at the
+        offset pushes it along. """
+    moved = index
+    for component in operation:
+        if is_retain( component ):
+            index -= component
+        elif is_insert( component ):
+            moved += len( component )
+        else:
+            moved -= min( index, -component )
+            index += component
+        if index < 0:
+            break
+    return moved
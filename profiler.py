@@ -0,0 +1,112 @@
+import os
+import sys
+import time
+import threading
+import collections
+from metrics import Histogram, LATENCY_BUCKETS
+
+# Finer bounds than LATENCY_BUCKETS, since most stages of a request take microseconds
+STAGE_BUCKETS = (.000005, .00001, .000025, .00005) + LATENCY_BUCKETS
+
+class Profiler:
+    """ Times the stages of a server's request pipeline and batch flushes, and samples the stacks of every
+        thread, while it is enabled. Stopping it writes what it gathered to a directory: the stacks in the
+        folded format that flamegraph.pl and speedscope read, and a table of the time spent in each stage.
+
+        Code being profiled reads the clock through lap, which does nothing but return None while the
+        profiler is disabled, so that leaving the hooks in costs next to nothing. """
+    def __init__( self, directory="logs", interval=.005, name="profile" ):
+        """ interval is how many seconds apart the stacks are sampled. Files are named after name. """
+        self.directory = directory
+        self.interval = interval
+        self.name = name
+        self.enabled = False
+        self.started = None
+        self.stages = None
+        self.stacks = collections.Counter()
+        self.sampler = None
+        self.lock = threading.Lock()
+
+    def start( self ):
+        """ Starts profiling, discarding whatever an earlier run gathered """
+        with self.lock:
+            if self.enabled:
+                return
+            self.stages = Histogram( "stage_seconds", "Time spent in each stage", STAGE_BUCKETS, label="stage" )
+            self.stacks = collections.Counter()
+            self.started = time.time()
+            self.enabled = True
+            self.sampler = threading.Thread( target=self._sample, daemon=True )
+            self.sampler.start()
+
+    def stop( self ):
+        """ Stops profiling and returns the paths of the files written, or an empty list if it was not
+            running """
+        with self.lock:
+            if not self.enabled:
+                return []
+            self.enabled = False
+            self.sampler.join()
+            return self._dump()
+
+    def toggle( self ):
+        """ Starts profiling if it is stopped, or stops it and returns the paths of the files written """
+        if self.enabled:
+            return self.stop()
+        self.start()
+        return []
+
+    def clock( self ):
+        """ Returns the time to time a stage from, or None while the profiler is disabled """
+        return time.perf_counter() if self.enabled else None
+
+    def lap( self, stage, start ):
+        """ Records the time since start, as returned by clock or by an earlier lap, against a stage, and
+            returns the time now for timing the next stage from """
+        if start is None or not self.enabled:
+            return None
+        now = time.perf_counter()
+        self.stages.observe( now - start, stage )
+        return now
+
+    def _sample( self ):
+        me = threading.get_ident()
+        while self.enabled:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append( "{}:{}".format( os.path.basename( code.co_filename ), code.co_name ) )
+                    frame = frame.f_back
+                stack.append( names.get( ident, str( ident ) ) )
+                self.stacks[";".join( reversed( stack ) )] += 1
+            time.sleep( self.interval )
+
+    def _dump( self ):
+        os.makedirs( self.directory, exist_ok=True )
+        base = os.path.join( self.directory, "{}-{}-{}".format( self.name, os.getpid(),
+                                                                time.strftime( "%Y%m%d-%H%M%S" ) ) )
+        with open( base + ".folded", 'w' ) as f:
+            for stack, count in sorted( self.stacks.items() ):
+                f.write( "{} {}\n".format( stack, count ) )
+        with open( base + ".stages.txt", 'w' ) as f:
+            f.write( "Profiled for {:.1f} s, {} stack samples\n".format( time.time() - self.started,
+                                                                         sum( self.stacks.values() ) ) )
+            f.write( "{:<16} {:>9} {:>10} {:>10} {:>10} {:>10}\n".format( "stage", "calls", "total ms", "mean us",
+                                                                         "p50 us <=", "p99 us <=" ) )
+            for stage, value in sorted( self.stages.collect().items() ):
+                f.write( "{:<16} {:>9} {:>10.1f} {:>10.1f} {:>10} {:>10}\n".format(
+                    stage, value["count"], value["sum"] * 1000, value["sum"] / value["count"] * 1e6,
+                    _bound( value, .5 ), _bound( value, .99 ) ) )
+        return [base + ".folded", base + ".stages.txt"]
+
+def _bound( histogram, fraction ):
+    """ Returns the upper bound, in microseconds, of the bucket that the given fraction of observations
+        fall within """
+    for bound, count in histogram["buckets"].items():
+        if count >= fraction * histogram["count"]:
+            return bound if bound == "+Inf" else "{:g}".format( float( bound ) * 1e6 )
+    return "+Inf"
@@ -0,0 +1,461 @@
+import json
+import itertools
+import struct
+import threading
+import time
+import zlib
+
+from base.exceptions import GenericError
+
+# First byte of every binary frame. JSON frames always start with '{', '[' or 'n'.
+MAGIC = 0xB1
+# First byte of every frame sent to a peer that negotiated compression. It is
+# followed by the topic of the wrapped frame's encoding and a codec flag.
+ZMAGIC = 0xB2
+# First byte of every broadcast from a server hosting several documents. It is
+# followed by the length of the document's ID and the ID itself, so that no ID
+# is a prefix of another, and then the frame as a single document would send it.
+DMAGIC = 0xB3
+
+# Codec flags. Frames below the compression threshold are sent RAW.
+RAW = 0
+ZLIB = 1
+CODECS = {
+        "zlib": ZLIB
+}
+
+ENCODINGS = ("binary", "json")
+
+# Prefixes clients subscribe to so that they only receive broadcasts in their
+# own encoding. Binary batches start with MAGIC and JSON batches are objects.
+TOPICS = {
+        "binary": bytes([MAGIC]),
+        "json": b"{"
+}
+
+# Opcodes. GENERIC carries a whole procedure as JSON, for anything that has no
+# compact form of its own.
+GENERIC = 0
+INSERT_CHAR = 1
+MOVE_CURSOR = 2
+CREATE_CURSOR = 3
+REMOVE_CURSOR = 4
+PLACE_CURSOR = 5
+WALK_CURSOR = 6
+INSERT_TEXT = 7
+DELETE_RANGE = 8
+
+OPCODES = {
+        "insert_char": INSERT_CHAR,
+        "move_cursor": MOVE_CURSOR,
+        "create_cursor": CREATE_CURSOR,
+        "remove_cursor": REMOVE_CURSOR,
+        "place_cursor": PLACE_CURSOR,
+        "walk_cursor": WALK_CURSOR,
+        "insert_text": INSERT_TEXT,
+        "delete_range": DELETE_RANGE
+}
+NAMES = {op: name for name, op in OPCODES.items()}
+# Set on the opcode of a broadcast edit that carries the position its cursor started from
+POSITIONED = 0x80
+
+DIRECTIONS = ('left', 'right', 'up', 'down', 'backspace', 'delete', 'enter')
+# Directions that move a cursor without changing any text
+MOVES = ('left', 'right', 'up', 'down')
+
+# Broadcast classes. Every broadcast starts with a channel header: the topic of
+# its encoding and codec, its class and, for cursor moves, the region of rows it
+# concerns. Clients subscribe to the channels they need and drop the rest unread.
+EDITS = b"E"
+CURSORS = b"C"
+# Rows per region
+REGION = 64
+_REGION = struct.Struct('>H')
+
+_TIME = struct.Struct('<d')
+
+class ProtocolError(GenericError): pass
+
+class Sessions:
+    """Maps cursor IDs to the small integer session IDs that stand in for them on the wire. Documents
+    hosted behind one endpoint share a Sessions, so that a session ID alone tells which document a
+    request is for. Worker processes allocate every step'th ID from their own start, so that a session ID
+    also tells which worker it belongs to."""
+    def __init__( self, start=1, step=1 ):
+        self.sids = {}
+        self.cids = {}
+        # next() on a count is atomic, so documents can allocate IDs without a shared lock
+        self.ids = itertools.count( start, step )
+
+    def add( self, cid, sid=None ):
+        """Registers a cursor ID, allocating a session ID unless one is given, and returns it"""
+        if sid is None:
+            sid = next( self.ids )
+        self.sids[cid] = sid
+        self.cids[sid] = cid
+        return sid
+
+    def remove( self, cid ):
+        sid = self.sids.pop( cid, None )
+        self.cids.pop( sid, None )
+
+    def sid( self, cid ):
+        return self.sids.get( cid )
+
+    def cid( self, sid ):
+        try:
+            return self.cids[sid]
+        except KeyError:
+            raise ProtocolError( "Unknown session {}".format( sid ) )
+
+    def to_dict( self, cids=None ):
+        """Returns the session IDs of the given cursors, or of every cursor"""
+        if cids is None:
+            return dict( self.sids )
+        return {cid: self.sids[cid] for cid in cids if cid in self.sids}
+
+class Compressor:
+    """Compresses frames at or above a size threshold for peers that negotiated a codec, keeping count of
+    the bytes saved and the CPU time spent doing so."""
+    def __init__( self, threshold=1024, level=6 ):
+        self.threshold = threshold
+        self.level = level
+        self.lock = threading.Lock()
+        self.frames = 0
+        self.compressed = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.cpu = 0.0
+
+    def pack( self, frame, topic ):
+        """Wraps a frame, compressing it if it is large enough. topic is the prefix of the wrapped frame's
+        encoding, which is repeated so that subscribers can still filter on it."""
+        compress = len( frame ) >= self.threshold
+        spent = 0.0
+        if compress:
+            start = time.process_time()
+            packed = bytes( (ZMAGIC,) ) + topic + bytes( (ZLIB,) ) + zlib.compress( frame, self.level )
+            spent = time.process_time() - start
+        else:
+            packed = bytes( (ZMAGIC,) ) + topic + bytes( (RAW,) ) + frame
+        with self.lock:
+            self.frames += 1
+            self.compressed += compress
+            self.bytes_in += len( frame )
+            self.bytes_out += len( packed )
+            self.cpu += spent
+        return packed
+
+    def stats( self ):
+        with self.lock:
+            return {"threshold": self.threshold, "frames": self.frames, "compressed": self.compressed,
+                    "bytes_in": self.bytes_in, "bytes_out": self.bytes_out,
+                    "bytes_saved": self.bytes_in - self.bytes_out, "cpu_seconds": self.cpu}
+
+def unpack( frame ):
+    """Undoes Compressor.pack. Frames that were never wrapped are returned untouched."""
+    if len( frame ) < 3 or frame[0] != ZMAGIC:
+        return frame
+    flag = frame[2]
+    if flag == RAW:
+        return frame[3:]
+    if flag == ZLIB:
+        try:
+            return zlib.decompress( frame[3:] )
+        except zlib.error as e:
+            raise ProtocolError( "Corrupt compressed frame: {}".format( e ) )
+    raise ProtocolError( "Unknown codec {}".format( flag ) )
+
+def topic( encoding, codec=None ):
+    """Returns the prefix of broadcasts for subscribers with the given encoding and codec"""
+    if codec is None:
+        return TOPICS[encoding]
+    return bytes( (ZMAGIC,) ) + TOPICS[encoding]
+
+def document_topic( doc ):
+    """Returns the prefix of broadcasts about the document with the given ID, for servers hosting several"""
+    out = bytearray( (DMAGIC,) )
+    _string( out, doc )
+    return bytes( out )
+
+def is_cursor_move( procedure ):
+    """Returns whether a procedure only moves a cursor, changing no text"""
+    if procedure["name"] == "walk_cursor":
+        return True
+    return procedure["name"] == "move_cursor" and procedure["args"][1] in MOVES
+
+def _is_count( arg ):
+    return isinstance( arg, int ) and not isinstance( arg, bool ) and arg != 0
+
+# The keystroke RPCs that clients send to be queued for the next batch, with a check of the argument each
+# takes after the UUID of its cursor
+KEYSTROKES = {
+        "move_cursor": lambda arg: arg in DIRECTIONS,
+        "walk_cursor": lambda arg: isinstance( arg, list ) and all( step in MOVES for step in arg ),
+        "insert_char": lambda arg: isinstance( arg, str ) and len( arg ) == 1,
+        "insert_text": lambda arg: isinstance( arg, str ),
+        "delete_range": _is_count
+}
+
+def is_keystroke( procedure ):
+    """Returns whether a procedure is a keystroke RPC with a timestamp and the arguments its RPC takes, so
+    that it can be queued, applied and logged safely"""
+    check = KEYSTROKES.get( procedure.get( "name" ) )
+    args = procedure.get( "args" )
+    if check is None or "uuid" not in procedure or not isinstance( args, list ) or len( args ) != 2:
+        return False
+    try:
+        float( procedure.get( "time" ) )
+    except (TypeError, ValueError):
+        return False
+    return check( args[1] )
+
+def steps( procedure ):
+    """Returns the directions a cursor move takes, in order"""
+    if procedure["name"] == "walk_cursor":
+        return list( procedure["args"][1] )
+    return [procedure["args"][1]]
+
+def region_of( row ):
+    """Returns the region a row falls in"""
+    return min( row // REGION, 0xFFFF )
+
+def channel( encoding, codec, kind, region=None ):
+    """Returns the channel header of broadcasts of the given class, or with no region the prefix of every
+    region's"""
+    header = topic( encoding, codec ) + kind
+    if region is not None:
+        header += _REGION.pack( region )
+    return header
+
+def strip_channel( message ):
+    """Splits a broadcast into its class, its region or None, and the frame after its channel header"""
+    pos = 2 if message[:1] == bytes( (ZMAGIC,) ) else 1
+    kind = message[pos:pos + 1]
+    pos += 1
+    region = None
+    if kind == CURSORS:
+        if pos + _REGION.size > len( message ):
+            raise ProtocolError( "Truncated channel header" )
+        region, = _REGION.unpack_from( message, pos )
+        pos += _REGION.size
+    elif kind != EDITS:
+        raise ProtocolError( "Unknown broadcast class {}".format( kind ) )
+    return kind, region, message[pos:]
+
+def is_binary( frame ):
+    return len( frame ) > 0 and frame[0] == MAGIC
+
+def choose( offered ):
+    """Picks the first encoding a client offered that this side understands, falling back to JSON"""
+    for encoding in offered:
+        if encoding in ENCODINGS:
+            return encoding
+    return "json"
+
+def choose_codec( offered ):
+    """Picks the first compression codec a client offered that this side understands, or None"""
+    for codec in offered:
+        if codec in CODECS:
+            return codec
+    return None
+
+def _varint( out, n ):
+    while n >= 0x80:
+        out.append( (n & 0x7f) | 0x80 )
+        n >>= 7
+    out.append( n )
+
+def _signed( out, n ):
+    # Zigzag encoding, so that small negative numbers stay short too
+    _varint( out, -2 * n - 1 if n < 0 else 2 * n )
+
+def _read_signed( frame, pos ):
+    n, pos = _read_varint( frame, pos )
+    return (n >> 1) ^ -(n & 1), pos
+
+def _read_varint( frame, pos ):
+    # Session IDs and short strings fit in one byte
+    if pos < len( frame ) and frame[pos] < 0x80:
+        return frame[pos], pos + 1
+    n = 0
+    shift = 0
+    while True:
+        try:
+            b = frame[pos]
+        except IndexError:
+            raise ProtocolError( "Truncated frame" )
+        pos += 1
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            return n, pos
+        shift += 7
+
+def _string( out, s ):
+    data = s.encode()
+    _varint( out, len( data ) )
+    out += data
+
+def _read_string( frame, pos ):
+    n, pos = _read_varint( frame, pos )
+    if pos + n > len( frame ):
+        raise ProtocolError( "Truncated frame" )
+    return str( frame[pos:pos + n], 'utf-8' ), pos + n
+
+def _encode_op( out, procedure, sessions ):
+    """Appends one procedure to out, in its compact form if it has one"""
+    op = OPCODES.get( procedure["name"], GENERIC )
+    args = procedure["args"]
+    sid = sessions.sid( str( args[0] ) ) if args else None
+    if op == MOVE_CURSOR and args[1] not in DIRECTIONS:
+        op = GENERIC
+    if op == GENERIC or sid is None:
+        out.append( GENERIC )
+        _string( out, json.dumps( procedure ) )
+        return
+
+    position = procedure.get( "pos" )
+    out.append( op | POSITIONED if position else op )
+    _varint( out, sid )
+    if position:
+        _varint( out, position[0] )
+        _varint( out, position[1] )
+    if op in (INSERT_CHAR, INSERT_TEXT):
+        _string( out, args[1] )
+    elif op == DELETE_RANGE:
+        _signed( out, int( args[1] ) )
+    elif op == MOVE_CURSOR:
+        out.append( DIRECTIONS.index( args[1] ) )
+    elif op == CREATE_CURSOR:
+        _string( out, str( args[0] ) )
+    elif op == PLACE_CURSOR:
+        _varint( out, int( args[1] ) )
+        _varint( out, int( args[2] ) )
+    elif op == WALK_CURSOR:
+        _walk( out, args[1] )
+
+def _walk( out, directions ):
+    _varint( out, len( directions ) )
+    out += bytes( DIRECTIONS.index( direction ) for direction in directions )
+
+def _read_walk( frame, pos ):
+    n, pos = _read_varint( frame, pos )
+    if pos + n > len( frame ) or any( b >= len( DIRECTIONS ) for b in frame[pos:pos + n] ):
+        raise ProtocolError( "Bad direction" )
+    return [DIRECTIONS[b] for b in frame[pos:pos + n]], pos + n
+
+def _decode_op( frame, pos, sessions ):
+    """Reads one procedure from frame, returning it and the position after it"""
+    if pos >= len( frame ):
+        raise ProtocolError( "Truncated frame" )
+    op = frame[pos]
+    pos += 1
+    if op == GENERIC:
+        text, pos = _read_string( frame, pos )
+        return json.loads( text ), pos
+
+    positioned = op & POSITIONED
+    op &= ~POSITIONED
+    if op not in NAMES:
+        raise ProtocolError( "Unknown opcode {}".format( op ) )
+    sid, pos = _read_varint( frame, pos )
+    if positioned:
+        cx, pos = _read_varint( frame, pos )
+        cy, pos = _read_varint( frame, pos )
+    procedure, pos = _decode_args( op, sid, frame, pos, sessions )
+    if positioned:
+        procedure["pos"] = [cx, cy]
+    return procedure, pos
+
+def _decode_args( op, sid, frame, pos, sessions ):
+    """Reads the arguments of a compact procedure, returning it and the position after it"""
+    if op == CREATE_CURSOR:
+        cid, pos = _read_string( frame, pos )
+        sessions.add( cid, sid )
+        args = [cid]
+    else:
+        cid = sessions.cid( sid )
+        args = [cid]
+        if op in (INSERT_CHAR, INSERT_TEXT):
+            text, pos = _read_string( frame, pos )
+            args.append( text )
+        elif op == DELETE_RANGE:
+            count, pos = _read_signed( frame, pos )
+            args.append( count )
+        elif op == MOVE_CURSOR:
+            if pos >= len( frame ) or frame[pos] >= len( DIRECTIONS ):
+                raise ProtocolError( "Bad direction" )
+            args.append( DIRECTIONS[frame[pos]] )
+            pos += 1
+        elif op == PLACE_CURSOR:
+            cx, pos = _read_varint( frame, pos )
+            cy, pos = _read_varint( frame, pos )
+            args += [cx, cy]
+        elif op == WALK_CURSOR:
+            directions, pos = _read_walk( frame, pos )
+            args.append( directions )
+    return {"uuid": cid, "name": NAMES[op], "args": args}, pos
+
+def encode_request( name, sid, time, *args ):
+    """Packs a single keystroke-sized RPC from the client with the given session ID.
+       Raises ProtocolError for RPCs with no compact form, which must be sent as JSON."""
+    op = OPCODES.get( name )
+    if (op not in (INSERT_CHAR, MOVE_CURSOR, WALK_CURSOR, INSERT_TEXT, DELETE_RANGE)
+            or (op == MOVE_CURSOR and args[0] not in DIRECTIONS)):
+        raise ProtocolError( "{} has no binary form".format( name ) )
+    out = bytearray( (MAGIC, op) )
+    _varint( out, sid )
+    out += _TIME.pack( time )
+    if op in (INSERT_CHAR, INSERT_TEXT):
+        _string( out, args[0] )
+    elif op == DELETE_RANGE:
+        _signed( out, int( args[0] ) )
+    elif op == WALK_CURSOR:
+        _walk( out, args[0] )
+    else:
+        out.append( DIRECTIONS.index( args[0] ) )
+    return bytes( out )
+
+def request_sid( frame ):
+    """Returns the session ID a frame built by encode_request was sent from, without decoding the rest"""
+    if not is_binary( frame ) or len( frame ) < 2:
+        raise ProtocolError( "Not a binary frame" )
+    sid, pos = _read_varint( frame, 2 )
+    return sid
+
+def decode_request( frame, sessions ):
+    """Unpacks a frame built by encode_request into the same procedure dict the JSON form produces"""
+    if not is_binary( frame ) or len( frame ) < 2:
+        raise ProtocolError( "Not a binary frame" )
+    op = frame[1]
+    if op not in (INSERT_CHAR, MOVE_CURSOR, WALK_CURSOR, INSERT_TEXT, DELETE_RANGE):
+        raise ProtocolError( "Unknown opcode {}".format( op ) )
+    sid, pos = _read_varint( frame, 2 )
+    if pos + _TIME.size > len( frame ):
+        raise ProtocolError( "Truncated frame" )
+    time, = _TIME.unpack_from( frame, pos )
+    procedure, pos = _decode_args( op, sid, frame, pos + _TIME.size, sessions )
+    procedure["time"] = time
+    return procedure
+
+def encode_batch( seq, procedures, sessions ):
+    """Packs a list of procedures for broadcast as batch number seq"""
+    out = bytearray( (MAGIC,) )
+    _varint( out, seq )
+    _varint( out, len( procedures ) )
+    for procedure in procedures:
+        _encode_op( out, procedure, sessions )
+    return bytes( out )
+
+def decode_batch( frame, sessions ):
+    """Unpacks a broadcast built by encode_batch into the same {"seq": ..., "ops": [...]} form the JSON
+       broadcast takes"""
+    if not is_binary( frame ):
+        raise ProtocolError( "Not a binary frame" )
+    seq, pos = _read_varint( frame, 1 )
+    count, pos = _read_varint( frame, pos )
+    procedures = []
+    for i in range( count ):
+        procedure, pos = _decode_op( frame, pos, sessions )
+        procedures.append( procedure )
+    return {"seq": seq, "ops": procedures}
@@ -5,10 +5,12 @@ import zmq
 from base.exceptions import GenericError
 from base.loggable import Loggable, StdErr
 from conf import logging as log
+from profiler import Profiler
 
 import logging
-from threading import Lock, Thread
+from threading import Lock, Thread, local
 from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 
 # Need signal handlers to properly run as daemon
 import signal
@@ -17,10 +19,17 @@ import traceback
 
 DEBUG = False
 
+def asBytes(message):
+    """
+    Frames go out as bytes; text is encoded as UTF-8
+    """
+    return message.encode() if isinstance(message, str) else message
+
 # bsock -> Publish/Subscribe
 # isock -> Request/Reply
 class Server(Loggable):
     cxt = zmq.Context()
+    interactiveType = zmq.REP
     def __init__(self, interactiveAddress, broadcastAddress, logger):
         """
         Server.__init__(self, interactiveAddress, broadcastAddress, logger)
@@ -32,7 +41,7 @@ class Server(Loggable):
         super(Server, self).__init__(logger)
 
         self.iaddr = interactiveAddress
-        self.isock = self.cxt.socket(zmq.REP)
+        self.isock = self.cxt.socket(self.interactiveType)
         self.isock.bind(self.iaddr)
 
         self.baddr = broadcastAddress
@@ -47,21 +56,24 @@ class Server(Loggable):
 
         self.listenThread = None
 
+        # Times each stage of the pipeline while enabled
+        self.profiler = Profiler(name = "server")
+
     def broadcast(self, message):
         """
         Server.broadcast(self, message)
-        Broadcast a message to all subscribed clients
+        Broadcast a message, either text or bytes, to all subscribed clients
         """
-        self.info("Broadcasting {}".format(message))
+        self.info("Broadcasting {}", message)
         with self.block:
-            self.bsock.send_string(message)
+            self.bsock.send(asBytes(message))
 
     def fail(self, message, reason):
         """
         Server.fail(self, message, reason)
         Send a failure message to a client
         """
-        self.error("Failure ({}): {}".format(message, reason))
+        self.error("Failure ({}): {}", message, reason)
         self.isock.send_string("Failure ({}): {}".format(reason,
             message))
 
@@ -90,7 +102,8 @@ class Server(Loggable):
         stopped. A poll operation will wait pollTimeout milliseconds before
         failing.
         Messages pipelined preprocess -> handler -> postprocess
-        The tail end of the pipeline is sent back to the client
+        Messages reach preprocess as bytes; postprocess may return text or
+        bytes. The tail end of the pipeline is sent back to the client
         """
         try:
             while True:
@@ -101,7 +114,8 @@ class Server(Loggable):
                     nmsg = self.isock.poll(pollTimeout)
                     if nmsg == 0:
                         continue
-                    message =  self.isock.recv_string()
+                    message =  self.isock.recv()
+                    start = self.profiler.clock()
                     # Catch and ignore _all_ exceptions to keep server up
                     try:
                         try:
@@ -109,25 +123,29 @@ class Server(Loggable):
                         except GenericError as e:
                             self.fail(message, "Internal server error")
                             continue
+                        start = self.profiler.lap("preprocess", start)
 
                         try:
                             reply = handler(message)
                         except GenericError as e:
                             self.fail(message, "Internal server error")
                             continue
+                        start = self.profiler.lap("handler", start)
 
                         try:
                             reply = postprocess(reply)
                         except GenericError as e:
                             self.fail(message, "Internal server error")
                             continue
+                        start = self.profiler.lap("postprocess", start)
                     except:
                         self.fail(message, "Malformed message")
-                        self.error("Uncaught exception: {}"
-                                .format(traceback.format_exc()))
+                        self.error("Uncaught exception: {}",
+                                traceback.format_exc())
                         continue
 
-                    self.isock.send_string(reply)
+                    self.isock.send(asBytes(reply))
+                    self.profiler.lap("reply", start)
         except KeyboardInterrupt as e:
             self.stop()
 
@@ -143,18 +161,170 @@ class Server(Loggable):
 
         with self.ilock:
             iaddr = self.isock.last_endpoint.decode()
-            self.info("Unbinding isock from {}".format(iaddr))
+            self.info("Unbinding isock from {}", iaddr)
             self.isock.unbind(iaddr)
 
         with self.block:
             baddr = self.bsock.last_endpoint.decode()
-            self.info("Unbinding bsock from {}".format(baddr))
+            self.info("Unbinding bsock from {}", baddr)
             self.bsock.unbind(baddr)
 
         self.listenThread.join()
 
         self.info("Server shutdown complete")
 
+class RouterServer(Server):
+    interactiveType = zmq.ROUTER
+    def __init__(self, interactiveAddress, broadcastAddress, logger,
+            workers = 4, offload = lambda msg: False):
+        """
+        RouterServer.__init__(self, interactiveAddress, broadcastAddress,
+                logger, workers = 4, offload = lambda msg: False)
+        A network server that services many requests at once.
+        Requests arrive on a ROUTER socket and replies are sent as soon as
+        they are ready, in any order. Preprocessed messages for which
+        offload returns True are handled on a pool of worker threads;
+        everything else is handled in order on the listening thread.
+        """
+        super(RouterServer, self).__init__(interactiveAddress,
+                broadcastAddress, logger)
+
+        self.workers = workers
+        self.offload = offload
+        self.pool = None
+
+        # Workers hand finished replies back to the listening thread, which
+        # owns the ROUTER socket
+        self.raddr = "inproc://replies-{}".format(id(self))
+        self.rsock = self.cxt.socket(zmq.PULL)
+        self.rsock.bind(self.raddr)
+        self.local = local()
+
+    def process(self, message, handler, postprocess):
+        """
+        RouterServer.process(self, message, handler, postprocess)
+        Runs the tail of the pipeline on a preprocessed message
+        Returns the reply to send back to the client
+        """
+        start = self.profiler.clock()
+        try:
+            try:
+                reply = handler(message)
+            except GenericError as e:
+                return self.failure(message, "Internal server error")
+            start = self.profiler.lap("handler", start)
+
+            try:
+                reply = postprocess(reply)
+            except GenericError as e:
+                return self.failure(message, "Internal server error")
+            self.profiler.lap("postprocess", start)
+            return reply
+        except:
+            self.error("Uncaught exception: {}", traceback.format_exc())
+            return self.failure(message, "Malformed message")
+
+    def failure(self, message, reason):
+        """
+        RouterServer.failure(self, message, reason)
+        Log a failure and build the failure message for a client
+        """
+        self.error("Failure ({}): {}", message, reason)
+        return "Failure ({}): {}".format(reason, message)
+
+    def continuouslyListen(self, preprocess = lambda msg: msg,
+            handler = lambda x, n: x, postprocess = lambda msg: msg,
+            pollTimeout = 2000):
+        """
+        RouterServer.continuouslyListen(self, preprocess = lambda msg: msg,
+                handler = lambda msg: msg, postprocess = lambda msg: msg, 
+                poll_timeout = 2000)
+        Polls for messages on the interactive socket until the server is
+        stopped, draining every waiting request on each pass.
+        Messages pipelined preprocess -> handler -> postprocess, as with
+        Server.continuouslyListen
+        """
+        self.pool = ThreadPoolExecutor(self.workers)
+        poller = zmq.Poller()
+        poller.register(self.isock, zmq.POLLIN)
+        poller.register(self.rsock, zmq.POLLIN)
+        try:
+            while True:
+                with self.dlock:
+                    if self.done: 
+                        break
+                with self.ilock:
+                    events = dict(poller.poll(pollTimeout))
+
+                    # Replies finished by workers
+                    if self.rsock in events:
+                        while True:
+                            try:
+                                frames = self.rsock.recv_multipart(zmq.NOBLOCK)
+                            except zmq.Again:
+                                break
+                            self.isock.send_multipart(frames)
+
+                    if self.isock in events:
+                        while True:
+                            try:
+                                frames = self.isock.recv_multipart(zmq.NOBLOCK)
+                            except zmq.Again:
+                                break
+                            self.dispatch(frames[:-1], frames[-1],
+                                    preprocess, handler, postprocess)
+        except KeyboardInterrupt as e:
+            self.stop()
+        finally:
+            self.pool.shutdown(wait = False)
+
+    def dispatch(self, envelope, message, preprocess, handler, postprocess):
+        """
+        RouterServer.dispatch(self, envelope, message, preprocess, handler,
+                postprocess)
+        Preprocess a message, then either handle it on the spot or hand it
+        to the worker pool. envelope holds the routing frames for the reply
+        """
+        start = self.profiler.clock()
+        try:
+            message = preprocess(message)
+        except GenericError as e:
+            self.respond(envelope, self.failure(message,
+                "Internal server error"))
+            return
+        except:
+            self.error("Uncaught exception: {}", traceback.format_exc())
+            self.respond(envelope, self.failure(message, "Malformed message"))
+            return
+        self.profiler.lap("preprocess", start)
+
+        if self.offload(message):
+            self.pool.submit(self.finish, envelope, message, handler,
+                    postprocess)
+        else:
+            self.respond(envelope, self.process(message, handler, postprocess))
+
+    def finish(self, envelope, message, handler, postprocess):
+        """
+        RouterServer.finish(self, envelope, message, handler, postprocess)
+        Runs on a worker thread: process the message and pass the reply
+        back to the listening thread
+        """
+        reply = self.process(message, handler, postprocess)
+        sock = getattr(self.local, "sock", None)
+        if sock == None:
+            sock = self.cxt.socket(zmq.PUSH)
+            sock.connect(self.raddr)
+            self.local.sock = sock
+        sock.send_multipart(envelope + [asBytes(reply)])
+
+    def respond(self, envelope, reply):
+        """
+        RouterServer.respond(self, envelope, reply)
+        Send a reply from the listening thread
+        """
+        self.isock.send_multipart(envelope + [asBytes(reply)])
+
 def echo(server, message):
     """
     Echo the message back to the client
@@ -0,0 +1,55 @@
+import random
+import time
+import sys
+import os
+import tempfile
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import textbuffer
+
+def edit(buf, rng):
+    """Applies one random keystroke-sized edit to buf"""
+    row = rng.randrange(len(buf) - 1)
+    length = len(buf[row]) - 1
+    action = rng.random()
+    if action < 0.5:
+        buf.insert(row, rng.randint(0, length), 'x')
+    elif action < 0.7:
+        if length > 0:
+            buf.delete(row, rng.randrange(length))
+    elif action < 0.85:
+        buf.insert(row, rng.randint(0, length), '\n')
+    else:
+        # Join with the next row
+        buf.delete(row, length)
+
+def bench(engine, path, edits, seed):
+    rng = random.Random(seed)
+    start = time.perf_counter()
+    buf = engine.open(path)
+    loaded = time.perf_counter()
+    for i in range(edits):
+        edit(buf, rng)
+    done = time.perf_counter()
+    return buf, loaded - start, (done - loaded) / edits
+
+if __name__ == "__main__":
+    copies = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    edits = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+
+    with open(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "test.txt")) as f:
+        text = f.read() * copies
+
+    print("Document: {} characters, {} rows, {} edits".format(len(text), text.count('\n') + 1, edits))
+    with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as f:
+        f.write(text)
+    results = {}
+    for name, engine in sorted(textbuffer.ENGINES.items()):
+        buf, load, per_edit = bench(engine, f.name, edits, 0)
+        results[name] = buf.text()
+        print("{:>6}: load {:8.3f} ms, {:8.2f} us/edit".format(name, load * 1e3, per_edit * 1e6))
+    os.remove(f.name)
+
+    if len(set(results.values())) != 1:
+        print("Engines disagree on the final document!")
+        sys.exit(1)
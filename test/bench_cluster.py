@@ -0,0 +1,118 @@
+import multiprocessing
+import random
+import shutil
+import tempfile
+import time
+import json
+import sys
+import os
+
+import zmq
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import protocol
+import winfrey
+import cluster
+
+def load(port, doc, edits, window, ready, go, results):
+    """Runs in a process of its own: opens doc, then sends edits keystrokes with at most window of them
+    unacknowledged, and reports how many of them were broadcast back and when the last one was"""
+    cxt = zmq.Context()
+    isock = cxt.socket(zmq.DEALER)
+    isock.connect("tcp://127.0.0.1:%d" % port)
+    isock.send_multipart([b"", winfrey.serialize(0, "subscribe", "json", doc=doc).encode()])
+    reply = json.loads(isock.recv_multipart()[-1])["other"]
+    me = str(reply["uuid"])
+    bsock = cxt.socket(zmq.SUB)
+    # Cursor moves are of no interest, so only edits are subscribed to
+    bsock.setsockopt(zmq.SUBSCRIBE, protocol.document_topic(doc) + protocol.channel("json", None, protocol.EDITS))
+    bsock.connect("tcp://127.0.0.1:%d" % (port + 1))
+    time.sleep(0.5)
+    ready.release()
+    go.wait()
+
+    prefix = len(protocol.document_topic(doc))
+    poller = zmq.Poller()
+    poller.register(isock, zmq.POLLIN)
+    poller.register(bsock, zmq.POLLIN)
+    sent = acked = dropped = seen = 0
+    last = time.time()
+    while acked < edits or seen < acked - dropped:
+        while sent < edits and sent - acked < window:
+            isock.send_multipart([b"", protocol.encode_request("insert_char", reply["sid"], time.time(), "x")])
+            sent += 1
+        events = dict(poller.poll(5000))
+        if not events:
+            break
+        if isock in events:
+            while True:
+                try:
+                    ack = isock.recv_multipart(zmq.NOBLOCK)[-1]
+                except zmq.Again:
+                    break
+                acked += 1
+                if ack != b"null" and json.loads(ack)["status"] == "dropped":
+                    dropped += 1
+        if bsock in events:
+            while True:
+                try:
+                    kind, region, frame = protocol.strip_channel(bsock.recv(zmq.NOBLOCK)[prefix:])
+                    batch = json.loads(frame)
+                except zmq.Again:
+                    break
+                mine = sum(1 for op in batch["ops"] if op["uuid"] == me and op["name"] == "insert_char")
+                if mine:
+                    seen += mine
+                    last = time.time()
+    isock.send_multipart([b"", winfrey.serialize(me, "unsubscribe", me, doc=doc).encode()])
+    isock.recv_multipart()
+    results.put((seen, dropped, last))
+
+def bench(workers, docs, clients, edits, window):
+    """Hosts docs copies of test.txt on the given number of workers and loads every one of them with
+    clients clients. Returns edits broadcast per second and the number dropped."""
+    runtime = tempfile.mkdtemp(prefix="winfrey-bench-")
+    with open(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "test.txt")) as f:
+        text = f.read()
+    names = []
+    for i in range(docs):
+        names.append(os.path.join(runtime, "doc%d.txt" % i))
+        with open(names[-1], 'w') as f:
+            f.write(text)
+    port = random.randint(20000, 30000)
+    front = cluster.WinfreyFrontend("tcp://127.0.0.1:%d" % port, "tcp://127.0.0.1:%d" % (port + 1), names, workers)
+
+    context = multiprocessing.get_context("spawn")
+    ready = context.Semaphore(0)
+    go = context.Event()
+    results = context.Queue()
+    loaders = [context.Process(target=load, args=(port, doc, edits, window, ready, go, results))
+               for doc in names for i in range(clients)]
+    for p in loaders:
+        p.start()
+    for p in loaders:
+        ready.acquire()
+    start = time.time()
+    go.set()
+    outcomes = [results.get() for p in loaders]
+    for p in loaders:
+        p.join()
+    front.stop()
+    shutil.rmtree(runtime, ignore_errors=True)
+
+    seen = sum(s for s, d, l in outcomes)
+    dropped = sum(d for s, d, l in outcomes)
+    return seen / (max(l for s, d, l in outcomes) - start), dropped
+
+if __name__ == "__main__":
+    docs = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    clients = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+    edits = int(sys.argv[3]) if len(sys.argv) > 3 else 2000
+    window = int(sys.argv[4]) if len(sys.argv) > 4 else 32
+    cores = os.cpu_count() or 1
+    counts = sorted({1, cores} | {n for n in (2, 4, 8, 16) if n < cores})
+
+    print("{} documents x {} clients x {} edits, {} cores".format(docs, clients, edits, cores))
+    for workers in counts:
+        rate, dropped = bench(workers, docs, clients, edits, window)
+        print("{:>3} workers: {:10.0f} edits/s broadcast, {} dropped".format(workers, rate, dropped))
@@ -0,0 +1,85 @@
+import queue
+import threading
+import time
+import sys
+import os
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from batching import BatchScheduler, IngestBuffer
+
+class DoubleBuffer:
+    """The ingest path the server used before IngestBuffer: two queues, a lock around every put and a
+    swap of the active queue on every flush"""
+    def __init__(self):
+        self.Q1 = queue.Queue()
+        self.Q2 = queue.Queue()
+        self.activeQ = self.Q1
+        self.activeLock = threading.Lock()
+
+    def put(self, item):
+        self.activeLock.acquire()
+        self.activeQ.put(item)
+        self.activeLock.release()
+
+    def __len__(self):
+        return self.activeQ.qsize()
+
+    def drain(self):
+        ps = []
+        self.activeLock.acquire()
+        if self.activeQ is self.Q1:
+            while not self.Q1.empty():
+                ps.append(self.Q1.get())
+            self.activeQ = self.Q2
+        else:
+            while not self.Q2.empty():
+                ps.append(self.Q2.get())
+            self.activeQ = self.Q1
+        self.activeLock.release()
+        return ps
+
+def bench(buffer, producers, puts, delay):
+    """Runs producers threads that each queue puts items while one flusher drains them in batches.
+    Returns how long the producers took, the mean cost of one put and the number of batches."""
+    scheduler = BatchScheduler(initial_delay=delay)
+    total = producers * puts
+    taken = []
+    batches = [0]
+
+    def produce():
+        for i in range(puts):
+            buffer.put(i)
+            scheduler.arrived(len(buffer))
+
+    def flush():
+        while len(taken) < total:
+            scheduler.wait(buffer.__len__, getattr(buffer, "oldest", None))
+            ps = buffer.drain()
+            scheduler.flushed(len(ps))
+            taken.extend(ps)
+            batches[0] += 1
+
+    flusher = threading.Thread(target=flush, daemon=True)
+    flusher.start()
+    threads = [threading.Thread(target=produce) for i in range(producers)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    produced = time.perf_counter() - start
+    flusher.join()
+    if len(taken) != total:
+        print("Lost {} items!".format(total - len(taken)))
+        sys.exit(1)
+    return produced, produced / total, batches[0]
+
+if __name__ == "__main__":
+    producers = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+    puts = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+    delay = float(sys.argv[3]) if len(sys.argv) > 3 else 0.01
+
+    print("{} producers x {} puts, {} s flush delay".format(producers, puts, delay))
+    for name, buffer in (("double", DoubleBuffer()), ("ingest", IngestBuffer())):
+        produced, per_put, batches = bench(buffer, producers, puts, delay)
+        print("{:>6}: {:8.3f} s, {:6.2f} us/put, {} batches".format(name, produced, per_put * 1e6, batches))
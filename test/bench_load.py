@@ -0,0 +1,211 @@
+import collections
+import resource
+import random
+import shutil
+import tempfile
+import threading
+import time
+import sys
+import os
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import protocol
+import winfrey
+from base.exceptions import GenericError
+
+# RPCs whose round trip to the broadcast is timed. Cursor moves come back merged, so they are not.
+TIMED = ("insert_char", "insert_text", "delete_range", "apply_operation")
+LETTERS = "abcdefghijklmnopqrstuvwxyz "
+
+class TimedServer(winfrey.WinfreyServer):
+    """A WinfreyServer that times how long every batch takes to be sent to all subscribers"""
+    def __init__(self, *args, **kwargs):
+        self.fanouts = []
+        self.fanout = 0.0
+        super().__init__(*args, **kwargs)
+
+    def _broadcast_procedures(self, procedures, moved={}):
+        self.fanout = 0.0
+        super()._broadcast_procedures(procedures, moved)
+        self.fanouts.append(self.fanout)
+
+    def _broadcast_frame(self, kind, region, procedures):
+        start = time.perf_counter()
+        super()._broadcast_frame(kind, region, procedures)
+        self.fanout += time.perf_counter() - start
+
+class LoadClient(winfrey.WinfreyClient):
+    """A headless WinfreyClient that times how long each of its edits takes to come back in a broadcast"""
+    def __init__(self, port, encoding):
+        self.sent = collections.deque()
+        self.latencies = []
+        super().__init__("tcp://127.0.0.1:%d" % port, "tcp://127.0.0.1:%d" % (port + 1), encoding=encoding,
+                         headless=True)
+
+    def get_time(self):
+        """Reports round trips for the batch delay as WinfreyClient.get_time does, without asking an NTP server"""
+        while not self.stopped:
+            try:
+                self.echo()
+            except GenericError:
+                # Left while the echo was under way
+                return
+            for i in range(30):
+                if self.stopped:
+                    return
+                time.sleep(0.1)
+
+    def _send_keystroke(self, name, arg):
+        if name in TIMED:
+            self.sent.append(time.perf_counter())
+        super()._send_keystroke(name, arg)
+
+    def _send_operation(self, operation):
+        self.sent.append(time.perf_counter())
+        super()._send_operation(operation)
+
+    def _handle(self, procedures):
+        now = time.perf_counter()
+        for procedure in procedures:
+            if procedure["uuid"] == self.my_cursor and procedure["name"] in TIMED and self.sent:
+                self.latencies.append(now - self.sent.popleft())
+        super()._handle(procedures)
+
+def press(client, key):
+    if len(key) == 1:
+        client.insert_my_char(key)
+    else:
+        client.move_my_cursor(key)
+
+def typing(rng, keys):
+    """Types at about 8 keys a second, with the odd line break and backspace"""
+    for i in range(keys):
+        action = rng.random()
+        key = "enter" if action < 0.05 else "backspace" if action < 0.15 else rng.choice(LETTERS)
+        yield key, rng.expovariate(8)
+
+def cursor(rng, keys):
+    """Holds arrow keys down at the keyboard's repeat rate, typing a character between runs"""
+    sent = 0
+    while sent < keys:
+        direction = rng.choice(protocol.MOVES)
+        for i in range(rng.randint(5, 30)):
+            yield direction, 1 / 30
+        yield rng.choice(LETTERS), 0.2
+        sent += 1
+
+def paste(rng, keys):
+    """Types, and every so often pastes a block of a couple of kilobytes"""
+    block = "".join(rng.choice(LETTERS) for i in range(60)) + "\n"
+    for i in range(keys):
+        if i % 20 == 0:
+            for line in range(32):
+                for char in block:
+                    yield ("enter" if char == "\n" else char), 0
+            yield "backspace", 0.2
+        else:
+            yield rng.choice(LETTERS), rng.expovariate(8)
+
+def churn(rng, keys):
+    """Types while leaving and joining again every quarter of the way through"""
+    for i in range(keys):
+        if i and i % max(1, keys // 4) == 0:
+            yield None, 0.1
+        yield rng.choice(LETTERS), rng.expovariate(8)
+
+WORKLOADS = {"typing": typing, "cursor": cursor, "paste": paste, "churn": churn}
+
+def drive(port, encoding, script, done):
+    """Runs one simulated user through a script. A None key makes them leave and join again."""
+    client = LoadClient(port, encoding)
+    client.load_thread.join()
+    for key, pause in script:
+        if key is None:
+            done.append(client)
+            client.interrupt()
+            client = LoadClient(port, encoding)
+            client.load_thread.join()
+        else:
+            press(client, key)
+        if pause:
+            time.sleep(pause)
+    done.append(client)
+
+def percentile(values, p):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+def bench(workload, clients, keys, encoding, settle=10, convergent=False):
+    """Hosts a copy of test.txt, runs clients simulated users through a workload of keys keystrokes
+    each and waits for their edits to come back. Returns the measurements and whether every client ended
+    up with the server's copy of the document. A convergent server has its clients send operations."""
+    runtime = tempfile.mkdtemp(prefix="winfrey-load-")
+    filename = os.path.join(runtime, "doc.txt")
+    shutil.copy(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "test.txt"), filename)
+    port = random.randint(20000, 30000)
+    server = TimedServer("tcp://127.0.0.1:%d" % port, "tcp://127.0.0.1:%d" % (port + 1), filename,
+                         convergent=convergent)
+    time.sleep(0.5)
+
+    done = []
+    threads = [threading.Thread(target=drive,
+                                args=(port, encoding, WORKLOADS[workload](random.Random(i), keys), done))
+               for i in range(clients)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    deadline = time.time() + settle
+    while any(client.sent for client in done if not client.stopped) and time.time() < deadline:
+        time.sleep(0.1)
+    elapsed = time.perf_counter() - start
+    time.sleep(1)
+
+    with server.lock:
+        text = server.rows.text()
+    live = [client for client in done if not client.stopped]
+    converged = True
+    for client in live:
+        with client.lock:
+            converged = converged and client.rows.text() == text
+    latencies = [latency for client in done for latency in client.latencies]
+    lost = sum(len(client.sent) for client in live)
+    stats = server.scheduler.stats()
+    # Operations are applied as they arrive rather than batched
+    operations = server.requestCount.collect().get("operate", 0)
+    for client in live:
+        client.interrupt()
+    shutil.rmtree(runtime, ignore_errors=True)
+    return {"latencies": latencies, "lost": lost, "ops": (stats["edits"] + operations) / elapsed,
+            "fanouts": server.fanouts, "batches": stats["batches"], "converged": converged}
+
+if __name__ == "__main__":
+    # -o anywhere benchmarks a convergent server
+    convergent = "-o" in sys.argv
+    argv = [arg for arg in sys.argv if arg != "-o"]
+    clients = int(argv[1]) if len(argv) > 1 else 8
+    keys = int(argv[2]) if len(argv) > 2 else 200
+    encoding = argv[3] if len(argv) > 3 else "binary"
+    workloads = argv[4:] or sorted(WORKLOADS)
+
+    print("{} clients x {} keys, {} encoding{}".format(clients, keys, encoding, ", convergent" if convergent else ""))
+    print("{:>8} {:>9} {:>9} {:>9} {:>8} {:>9} {:>10} {:>6}".format(
+        "workload", "p50 ms", "p90 ms", "p99 ms", "ops/s", "batches", "fanout ms", "lost"))
+    failed = False
+    for workload in workloads:
+        result = bench(workload, clients, keys, encoding, convergent=convergent)
+        latencies = [latency * 1000 for latency in result["latencies"]]
+        fanouts = result["fanouts"]
+        print("{:>8} {:9.1f} {:9.1f} {:9.1f} {:8.0f} {:9} {:10.3f} {:6}{}".format(
+            workload, percentile(latencies, 50), percentile(latencies, 90), percentile(latencies, 99),
+            result["ops"], result["batches"], 1000 * sum(fanouts) / len(fanouts) if fanouts else 0.0,
+            result["lost"], "" if result["converged"] else "  DIVERGED"))
+        failed = failed or not result["converged"]
+    # Servers and clients all share this process
+    print("Peak memory: {:.1f} MB".format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+    # The servers have no way to stop their threads, so the process is ended outright
+    sys.stdout.flush()
+    os._exit(1 if failed else 0)
@@ -0,0 +1,53 @@
+import json
+import time
+import sys
+import os
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import protocol
+
+def rate(f, n):
+    """Returns how many times per second f runs"""
+    start = time.perf_counter()
+    for i in range(n):
+        f()
+    return n / (time.perf_counter() - start)
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+    sessions = protocol.Sessions()
+    cid = str(340282366920938463463374607431768211455)
+    sid = sessions.add(cid)
+    now = time.time()
+
+    # A single keystroke, as the client sends it
+    request = {"uuid": cid, "name": "insert_char", "args": [cid, "x"], "time": str(now)}
+    json_request = json.dumps(request)
+    binary_request = protocol.encode_request("insert_char", sid, now, "x")
+
+    # A broadcast batch of keystrokes from many users
+    batch = []
+    for i in range(100):
+        user = str(10 ** 37 + i)
+        sessions.add(user)
+        if i % 2:
+            batch.append({"uuid": user, "name": "insert_char", "args": [user, "y"], "time": now})
+        else:
+            batch.append({"uuid": user, "name": "move_cursor", "args": [user, "down"], "time": now})
+    json_batch = json.dumps({"seq": 1, "ops": batch})
+    binary_batch = protocol.encode_batch(1, batch, sessions)
+
+    print("Keystroke: json {} bytes, binary {} bytes".format(len(json_request), len(binary_request)))
+    print("  json   encode {:>10.0f}/s decode {:>10.0f}/s".format(
+        rate(lambda: json.dumps(request), n), rate(lambda: json.loads(json_request), n)))
+    print("  binary encode {:>10.0f}/s decode {:>10.0f}/s".format(
+        rate(lambda: protocol.encode_request("insert_char", sid, now, "x"), n),
+        rate(lambda: protocol.decode_request(binary_request, sessions), n)))
+
+    print("Batch of {}: json {} bytes, binary {} bytes".format(len(batch), len(json_batch), len(binary_batch)))
+    print("  json   encode {:>10.0f}/s decode {:>10.0f}/s".format(
+        rate(lambda: json.dumps({"seq": 1, "ops": batch}), n // 100), rate(lambda: json.loads(json_batch), n // 100)))
+    print("  binary encode {:>10.0f}/s decode {:>10.0f}/s".format(
+        rate(lambda: protocol.encode_batch(1, batch, sessions), n // 100),
+        rate(lambda: protocol.decode_batch(binary_batch, sessions), n // 100)))
@@ -1,53 +1,54 @@
+import threading
 import time
-import json
 import sys
 import os
+from concurrent.futures import Future
+from queue import Queue
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import winfrey
 
+def relay(sent, reply):
+    """Passes the outcome of a request that was sent late on to the future its caller holds"""
+    if sent.exception() is not None:
+        reply.set_exception(sent.exception())
+    else:
+        reply.set_result(sent.result())
+
 class SlowWinfreyClient(winfrey.WinfreyClient):
-    def __init__(self, remote_address, broadcast_address, delay, echo_delay, load_delay):
+    """A WinfreyClient behind a slow link. Everything it sends goes through the usual client, coalescing and
+    all, and is then delivered delay seconds after it was made, in order. Echoes wait another echo_delay
+    seconds after they are timestamped, and broadcasts are only applied load_delay seconds after the
+    document has loaded."""
+    def __init__(self, remote_address, broadcast_address, delay, echo_delay, load_delay, doc=None):
         self.delay = delay;
         self.echo_delay = echo_delay
         self.load_delay = load_delay
-        super().__init__(remote_address, broadcast_address)
+        self.outgoing = Queue()
+        super().__init__(remote_address, broadcast_address, doc=doc)
+
+    def subscribe(self):
+        super().subscribe()
+        # Later requests are queued for the link rather than sent, so nobody waits on them but their replies
+        self.submitNow = self.endpoint.submit
+        self.endpoint.submit = self._submit_late
+        threading.Thread(target=self._deliver, daemon=True).start()
 
-    def subscribe( self ):
-        reply = self.endpoint.send( json.dumps({"uuid": 0, "name": "subscribe", "args": []}), preprocess=self._preprocess_indiv )
-        self.endpoint.startBackground( self._handleQueue, preprocess=self._preprocess )
-        if reply["status"] == "subscribed":
-            self.my_cursor = str(reply["other"]["uuid"])
-            self.rows = reply["other"]["file"]
-            self.numrows = len( self.rows )
-            for i in range( 0, len(self.rows) ):
-                self.G.add_line( i, self.rows[i][:-1], [] );
-            for cid in reply["other"]["cursors"]:
-                cursor = reply["other"]["cursors"][cid]
-                self.create_cursor( cid, cursor["cx"], cursor["cy"] )
-            time.sleep(self.load_delay)
-            self.fullyLoaded = True
-            while self.updateQueue: 
-                self.queueLock.acquire()
-                procedure = self.updateQueue.pop(0)
-                self._handle([procedure])
-                self.queueLock.release()
-        else:
-            return None
+    def _submit_late(self, message, preprocess=lambda x: x, callback=None):
+        reply = Future()
+        self.outgoing.put((time.monotonic() + self.delay, message, preprocess, callback, reply))
+        return reply
 
-    def move_my_cursor( self, direction ):
-        self.timelock.acquire()
-        ltime = time.time() - self.offset
-        self.timelock.release()
-        time.sleep(self.delay)
-        reply = self.endpoint.send( json.dumps({"uuid": str(self.my_cursor), "name": "move_cursor", "args": [str(self.my_cursor), str(direction)], "time": str(ltime)}))
+    def _deliver(self):
+        while True:
+            due, message, preprocess, callback, reply = self.outgoing.get()
+            time.sleep(max(0, due - time.monotonic()))
+            sent = self.submitNow(message, preprocess=preprocess, callback=callback)
+            sent.add_done_callback(lambda sent, reply=reply: relay(sent, reply))
 
-    def insert_my_char(self, char):
-        self.timelock.acquire()
-        ltime = time.time() - self.offset
-        self.timelock.release()
-        time.sleep(self.delay)
-        reply = self.endpoint.send( json.dumps({"uuid": str(self.my_cursor), "name": "insert_char", "args": [str(self.my_cursor), str(char)], "time": str(ltime)}))
+    def _replay_queued( self ):
+        time.sleep(self.load_delay)
+        super()._replay_queued()
 
     def echo( self ):
         i = 0
@@ -59,12 +60,11 @@ class SlowWinfreyClient(winfrey.WinfreyClient):
             i = i + 1
         if not self.stopped:
             time.sleep(self.echo_delay)
-            reply = self.endpoint.send( json.dumps({"uuid": str(self.my_cursor),
-                                                    "name": "echo_response",
-                                                    "args": message}))
+            reply = self.endpoint.send(winfrey.serialize(str(self.my_cursor), "echo_response", *message,
+                                                         doc=self.doc))
 
 
 
 
 if __name__ == "__main__":
-    winfrey = SlowWinfreyClient( "tcp://127.0.0.1:5000", "tcp://127.0.0.1:5001", float(sys.argv[1]), float(sys.argv[2]), float(sys.argv[3]))
+    winfrey = SlowWinfreyClient( "tcp://127.0.0.1:5000", "tcp://127.0.0.1:5001", float(sys.argv[1]), float(sys.argv[2]), float(sys.argv[3]), doc=sys.argv[4] if len(sys.argv) > 4 else None)
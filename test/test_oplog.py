@@ -0,0 +1,97 @@
+import logging
+import sys
+import os
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import backend
+from oplog import OpLog, replay
+
+def editor(path):
+    """An editor over the file at path, with the functions a replayed log may call"""
+    state = backend.editor_state(str(path))
+    functions = {"create_cursor": state.create_cursor, "remove_cursor": state.remove_cursor,
+                 "move_cursor": state.move_cursor, "walk_cursor": state.walk_cursor,
+                 "insert_char": state.insert_char, "insert_text": state.insert_text,
+                 "delete_range": state.delete_range}
+    return state, functions
+
+def typed(cid, text):
+    return [{"name": "insert_text", "args": [cid, text]}]
+
+def recover(path):
+    log = OpLog(str(path))
+    records = log.recover()
+    log.close()
+    state, functions = editor(path)
+    for cid, cursor in records[0]["cursors"].items() if records else ():
+        state.create_cursor(cid, cursor["cx"], cursor["cy"])
+    return state, records, replay(records, functions) if records else None
+
+def test_replays_logged_batches(tmp_path):
+    path = tmp_path / "doc.txt"
+    path.write_text("hello\n")
+    log = OpLog(str(path))
+    log.start(3, {"a": {"cx": 5, "cy": 0}})
+    log.append(4, typed("a", " world"))
+    log.append(5, [{"name": "move_cursor", "args": ["a", "left"]}, {"name": "insert_char", "args": ["a", "!"]}])
+    log.close()
+
+    state, records, version = recover(path)
+    assert len(records) == 3
+    assert version == 5
+    assert state.rows.text() == "hello worl!d\n"
+
+def test_skips_records_it_cannot_replay(tmp_path, caplog):
+    path = tmp_path / "doc.txt"
+    path.write_text("abc\n")
+    log = OpLog(str(path))
+    log.start(0, {"a": {"cx": 0, "cy": 0}})
+    log.append(1, [{"name": "bogus", "args": ["a", "x"]}, {"name": "insert_char", "args": []}])
+    log.append(2, typed("a", "z"))
+    log.close()
+
+    with caplog.at_level(logging.ERROR, logger="main"):
+        state, records, version = recover(path)
+    assert version == 2
+    assert state.rows.text() == "zabc\n"
+    assert len([record for record in caplog.records if "Skipped" in record.getMessage()]) == 2
+
+def test_compaction_keeps_batches_logged_meanwhile(tmp_path):
+    path = tmp_path / "doc.txt"
+    path.write_text("one\n")
+    state, functions = editor(path)
+    state.create_cursor("a")
+    log = OpLog(str(path))
+    log.start(0, state.cursors.to_dict())
+    state.insert_text("a", "two ")
+    log.append(1, typed("a", "two "))
+
+    # The document is captured at batch 1, and batch 2 is applied while it is written out
+    chunks = state.rows.freeze()
+    cursors = state.cursors.to_dict()
+    log.rotate()
+    log.append(2, typed("a", "three "))
+    log.commit(chunks, 1, cursors)
+    log.close()
+
+    assert path.read_text() == "two one\n"
+    assert not os.path.exists(str(path) + ".oplog.next")
+    state, records, version = recover(path)
+    assert records[0]["version"] == 1
+    assert [record["seq"] for record in records[1:]] == [2]
+    assert version == 2
+    assert state.rows.text() == "two three one\n"
+
+def test_log_of_another_base_is_set_aside(tmp_path):
+    path = tmp_path / "doc.txt"
+    path.write_text("abc\n")
+    log = OpLog(str(path))
+    log.start(0, {})
+    log.append(1, typed("a", "x"))
+    log.close()
+    path.write_text("edited elsewhere\n")
+
+    state, records, version = recover(path)
+    assert records == []
+    assert state.rows.text() == "edited elsewhere\n"
+    assert os.path.exists(str(path) + ".oplog.stale")
@@ -0,0 +1,101 @@
+import random
+import sys
+import os
+
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import backend
+import ot
+
+ALPHABET = "ab\n"
+
+def random_text(rng, length):
+    return "".join(rng.choice(ALPHABET) for _ in range(length))
+
+def random_operation(rng, length):
+    """A random operation in canonical form on a document of length characters"""
+    operation = []
+    left = length
+    while left:
+        n = rng.randint(1, min(left, 4))
+        kind = rng.random()
+        if kind < 0.3:
+            ot.insert(operation, random_text(rng, rng.randint(1, 3)))
+        if kind < 0.6:
+            ot.retain(operation, n)
+        else:
+            ot.delete(operation, n)
+        left -= n
+    if rng.random() < 0.3:
+        ot.insert(operation, random_text(rng, rng.randint(1, 3)))
+    return operation
+
+def test_apply_splices_text():
+    assert ot.apply("hello", ot.splice(5, 1, "EY", 3)) == "hEYo"
+    assert ot.apply("", ["abc"]) == "abc"
+
+def test_transformed_operations_converge():
+    rng = random.Random(25)
+    for _ in range(2000):
+        document = random_text(rng, rng.randint(0, 12))
+        a = random_operation(rng, len(document))
+        b = random_operation(rng, len(document))
+        a_prime, b_prime = ot.transform(a, b)
+        assert ot.apply(ot.apply(document, a), b_prime) == ot.apply(ot.apply(document, b), a_prime)
+        assert ot.compose(a, b_prime) == ot.compose(b, a_prime)
+
+def test_composed_operation_applies_both():
+    rng = random.Random(1)
+    for _ in range(2000):
+        document = random_text(rng, rng.randint(0, 12))
+        a = random_operation(rng, len(document))
+        b = random_operation(rng, ot.target_length(a))
+        assert ot.apply(document, ot.compose(a, b)) == ot.apply(ot.apply(document, a), b)
+
+def test_indices_follow_the_text_around_them():
+    rng = random.Random(7)
+    for _ in range(2000):
+        document = random_text(rng, rng.randint(0, 12))
+        operation = random_operation(rng, len(document))
+        index = rng.randint(0, len(document))
+        # A marker typed at the index lands where the index goes, behind anything inserted there
+        marker = ot.transform(operation, ot.splice(len(document), index, "*"))[1]
+        assert ot.apply(ot.apply(document, operation), marker).index("*") == ot.transform_index(index, operation)
+
+def test_refuses_operations_that_do_not_fit():
+    with pytest.raises(ot.OperationError):
+        ot.transform([3], [4])
+    with pytest.raises(ot.OperationError):
+        ot.compose([3], [4])
+    with pytest.raises(ot.OperationError):
+        ot.apply("ab", [3])
+
+def test_editor_applies_operations_as_written(tmp_path):
+    rng = random.Random(3)
+    path = tmp_path / "doc.txt"
+    for _ in range(500):
+        document = random_text(rng, rng.randint(0, 12))
+        path.write_text(document)
+        state = backend.editor_state(str(path))
+        state.create_cursor("b")
+        state.move_cursor_to_offset("b", rng.randint(0, len(document)))
+        before = state.cursor_offset("b")
+        operation = random_operation(rng, len(document))
+        in_full = state.applies_in_full(operation)
+        state.apply_operation("a", operation)
+        # Only operations that delete the newline before the last row are applied otherwise
+        assert in_full == (state.rows.text() == ot.apply(document, operation))
+        if in_full:
+            assert state.cursor_offset("b") == ot.transform_index(before, operation)
+
+def test_newline_before_the_last_row_is_kept(tmp_path):
+    path = tmp_path / "doc.txt"
+    path.write_text("ab\ncd")
+    state = backend.editor_state(str(path))
+    assert not state.applies_in_full(ot.splice(5, 2, "", 1))
+    assert not state.applies_in_full(ot.splice(5, 0, "", 5))
+    # Breaking the line again first still leaves the original newline as the last one
+    assert not state.applies_in_full([2, "x\ny", -1, 2])
+    assert state.applies_in_full(ot.splice(5, 3, "", 2))
+    assert state.applies_in_full([5, "\n"])
@@ -0,0 +1,711 @@
+import mmap
+import random
+from collections import OrderedDict
+
+# Target number of characters held by a single rope leaf
+CHUNK = 512
+# Number of bytes of a mapped file covered by one block of an MmapBuffer
+BLOCK = 16 * 1024
+# Number of unedited blocks an MmapBuffer keeps decoded
+CACHED = 64
+
+def _split_rows( text, last ):
+    """ Splits text into rows that keep their trailing newline.
+
+        Args:
+            text (str): Text to split
+            last (bool): Whether text runs to the end of the document. Only the
+                         final row of a document lacks a trailing newline.
+    """
+    parts = text.split('\n')
+    rows = [part + '\n' for part in parts[:-1]]
+    if last or parts[-1] != '':
+        rows.append(parts[-1])
+    return rows
+
+def _iter_rows( chunks ):
+    """ Yields the rows of a document given as a sequence of pieces """
+    row = []
+    for chunk in chunks:
+        start = 0
+        nl = chunk.find( '\n' )
+        while nl != -1:
+            row.append( chunk[start:nl + 1] )
+            yield ''.join( row )
+            row = []
+            start = nl + 1
+            nl = chunk.find( '\n', start )
+        row.append( chunk[start:] )
+    yield ''.join( row )
+
+def _decode( raw ):
+    """ Decodes part of a file the way reading it in text mode would """
+    text = str( raw, 'utf-8' )
+    if '\r' in text:
+        text = text.replace( '\r\n', '\n' ).replace( '\r', '\n' )
+    return text
+
+class LineIndex:
+    """ A Fenwick tree over row lengths, mapping rows to absolute offsets.
+
+        Changing the length of a row and translating between offsets and rows
+        both take O(log n). Inserting or removing rows shifts every entry, so
+        callers mark the index stale and it is rebuilt in O(n) on next use.
+    """
+    def __init__( self, lengths=() ):
+        self.rebuild( lengths )
+
+    def rebuild( self, lengths ):
+        tree = [0] + list( lengths )
+        n = len( tree )
+        for i in range( 1, n ):
+            parent = i + (i & -i)
+            if parent < n:
+                tree[parent] += tree[i]
+        self.tree = tree
+        self.stale = False
+
+    def add( self, row, delta ):
+        """ Adds delta to the length of the given row """
+        i = row + 1
+        while i < len( self.tree ):
+            self.tree[i] += delta
+            i += i & -i
+
+    def start( self, row ):
+        """ Returns the offset of the first character of the given row """
+        total = 0
+        i = row
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+    def find( self, offset ):
+        """ Returns the row holding the given offset, and the offset at which that row starts """
+        row = 0
+        start = 0
+        step = 1 << (len( self.tree ).bit_length())
+        while step:
+            nxt = row + step
+            if nxt < len( self.tree ) and start + self.tree[nxt] <= offset:
+                row = nxt
+                start += self.tree[nxt]
+            step >>= 1
+        return (row, start)
+
+class RowBuffer:
+    """ The original buffer: a Python list holding one string per row.
+
+        Every row keeps its trailing newline except for the last one. Editing
+        rebuilds the whole row and splitting or joining rows shifts the list,
+        so edits cost O(line length + line count).
+    """
+    def __init__( self, text='' ):
+        self.rows = _split_rows( text, True )
+        self.index = LineIndex()
+        self.index.stale = True
+
+    @classmethod
+    def open( cls, filename ):
+        """ Reads a file into a new buffer """
+        with open( filename ) as f:
+            return cls( f.read() )
+
+    def __len__( self ):
+        return len( self.rows )
+
+    def __getitem__( self, row ):
+        return self.rows[row]
+
+    def __iter__( self ):
+        return iter( self.rows )
+
+    def line( self, row ):
+        """ Returns the contents of a row without its trailing newline """
+        r = self.rows[row]
+        return r[:-1] if r.endswith('\n') else r
+
+    def insert( self, row, col, text ):
+        """ Inserts text, which may contain newlines, at the given row and column """
+        r = self.rows[row]
+        last = row == len( self.rows ) - 1
+        self._replace( row, row + 1, r[:col] + text + r[col:], last )
+
+    def delete( self, row, col, count=1 ):
+        """ Deletes count characters starting at the given row and column.
+            Deleting a newline joins the row with the one below it. """
+        end = row + 1
+        r = self.rows[row]
+        while len( r ) - col <= count and end < len( self.rows ):
+            r += self.rows[end]
+            end += 1
+        last = end == len( self.rows )
+        self._replace( row, end, r[:col] + r[col + count:], last )
+
+    def size( self ):
+        """ Returns the number of characters in the document """
+        return self._index().start( len( self.rows ) )
+
+    def offset( self, row, col ):
+        """ Converts a row and column into an absolute offset """
+        return self._index().start( row ) + col
+
+    def position( self, offset ):
+        """ Converts an absolute offset into a (row, column) pair """
+        row, start = self._index().find( offset )
+        row = min( row, len( self.rows ) - 1 )
+        return (row, offset - self._index().start( row ))
+
+    def chunks( self ):
+        """ Yields the document in pieces, in order """
+        return iter( self.rows )
+
+    def freeze( self ):
+        """ Returns the pieces of the document as it is now, which later edits leave alone """
+        return list( self.rows )
+
+    def text( self ):
+        return ''.join( self.rows )
+
+    def _replace( self, start, end, text, last ):
+        """ Replaces rows start up to end with the rows making up text """
+        rows = _split_rows( text, last )
+        if len( rows ) == 1 and end == start + 1 and not self.index.stale:
+            self.index.add( start, len( rows[0] ) - len( self.rows[start] ) )
+        else:
+            self.index.stale = True
+        self.rows[start:end] = rows
+
+    def _index( self ):
+        if self.index.stale:
+            self.index.rebuild( len( r ) for r in self.rows )
+        return self.index
+
+class _Node:
+    """ A rope leaf. Each node also carries totals for its whole subtree. """
+    __slots__ = ('text', 'nl', 'prio', 'left', 'right', 'size', 'lines')
+
+    def __init__( self, text, prio=None ):
+        self.text = text
+        self.nl = text.count('\n')
+        self.prio = random.random() if prio is None else prio
+        self.left = None
+        self.right = None
+        self.size = len( text )
+        self.lines = self.nl
+
+def _size( n ):
+    return n.size if n else 0
+
+def _lines( n ):
+    return n.lines if n else 0
+
+def _update( n ):
+    n.size = len( n.text ) + _size( n.left ) + _size( n.right )
+    n.lines = n.nl + _lines( n.left ) + _lines( n.right )
+
+def _merge( a, b ):
+    """ Concatenates two treaps """
+    if a is None:
+        return b
+    if b is None:
+        return a
+    if a.prio >= b.prio:
+        a.right = _merge( a.right, b )
+        _update( a )
+        return a
+    b.left = _merge( a, b.left )
+    _update( b )
+    return b
+
+def _split( n, k ):
+    """ Splits a treap into one holding the first k characters and one holding the rest """
+    if n is None:
+        return (None, None)
+    ls = _size( n.left )
+    if k <= ls:
+        a, b = _split( n.left, k )
+        n.left = b
+        _update( n )
+        return (a, n)
+    if k >= ls + len( n.text ):
+        a, b = _split( n.right, k - ls - len( n.text ) )
+        n.right = a
+        _update( n )
+        return (n, b)
+    # The split point falls inside this leaf. The tail inherits this node's
+    # priority so it stays above everything in the old right subtree.
+    j = k - ls
+    tail = _Node( n.text[j:], n.prio )
+    tail.right = n.right
+    _update( tail )
+    n.text = n.text[:j]
+    n.nl = n.text.count('\n')
+    n.right = None
+    _update( n )
+    return (n, tail)
+
+def _build( pieces ):
+    """ Builds a balanced treap out of a list of leaf strings in O(n) """
+    if not pieces:
+        return None
+    prios = sorted( (random.random() for _ in pieces), reverse=True )
+    nodes = [_Node( p ) for p in pieces]
+
+    def link( lo, hi ):
+        if lo >= hi:
+            return None
+        mid = (lo + hi) // 2
+        n = nodes[mid]
+        n.left = link( lo, mid )
+        n.right = link( mid + 1, hi )
+        _update( n )
+        return n
+
+    root = link( 0, len( nodes ) )
+    # Hand out priorities in level order so every parent outranks its children
+    level = [root]
+    i = 0
+    while level:
+        nxt = []
+        for n in level:
+            n.prio = prios[i]
+            i += 1
+            if n.left:
+                nxt.append( n.left )
+            if n.right:
+                nxt.append( n.right )
+        level = nxt
+    return root
+
+def _pieces( text, size=CHUNK ):
+    return [text[i:i + size] for i in range( 0, len( text ), size )]
+
+class RopeBuffer:
+    """ A rope of text chunks stored in a treap keyed by position.
+
+        Each node tracks the number of characters and newlines in its subtree,
+        which doubles as a line-start index. Finding a row, inserting, deleting,
+        splitting and joining rows all take O(log n) plus the size of one chunk.
+    """
+    def __init__( self, text='' ):
+        self.root = _build( _pieces( text ) )
+
+    @classmethod
+    def open( cls, filename ):
+        """ Reads a file into a new buffer """
+        with open( filename ) as f:
+            return cls( f.read() )
+
+    def __len__( self ):
+        return _lines( self.root ) + 1
+
+    def __getitem__( self, row ):
+        if row < 0:
+            row += len( self )
+        if row < 0 or row >= len( self ):
+            raise IndexError( "row index out of range" )
+        path, start, j = self._find_row( row )
+        if not path:
+            return ''
+        n = path[-1]
+        end = n.text.find( '\n', j )
+        if end != -1:
+            return n.text[j:end + 1]
+        # The row runs on into the leaves after this one, which are visited in order from here
+        out = [n.text[j:]]
+        stack = [p for p, child in zip( path, path[1:] ) if p.left is child]
+        n = n.right
+        while stack or n:
+            while n:
+                stack.append( n )
+                n = n.left
+            n = stack.pop()
+            end = n.text.find( '\n' )
+            if end != -1:
+                out.append( n.text[:end + 1] )
+                break
+            out.append( n.text )
+            n = n.right
+        return ''.join( out )
+
+    def __iter__( self ):
+        return _iter_rows( self.chunks() )
+
+    def line( self, row ):
+        """ Returns the contents of a row without its trailing newline """
+        r = self[row]
+        return r[:-1] if r.endswith('\n') else r
+
+    def insert( self, row, col, text ):
+        """ Inserts text, which may contain newlines, at the given row and column """
+        if not text:
+            return
+        path, start, j = self._find_row( row )
+        offset = start + j + col
+        if path and j + col > len( path[-1].text ):
+            path, j = self._path_to( offset, True )
+        else:
+            j += col
+        if len( text ) <= CHUNK and path:
+            self._insert_in_place( path, j, offset, text )
+        else:
+            left, right = _split( self.root, offset )
+            for piece in _pieces( text ):
+                left = _merge( left, _Node( piece ) )
+            self.root = _merge( left, right )
+
+    def delete( self, row, col, count=1 ):
+        """ Deletes count characters starting at the given row and column.
+            Deleting a newline joins the row with the one below it. """
+        path, start, j = self._find_row( row )
+        offset = start + j + col
+        count = min( count, _size( self.root ) - offset )
+        if count <= 0:
+            return
+        if j + col >= len( path[-1].text ):
+            path, j = self._path_to( offset, False )
+        else:
+            j += col
+        if self._delete_in_place( path, j, count ):
+            return
+        left, rest = _split( self.root, offset )
+        middle, right = _split( rest, count )
+        self.root = _merge( left, right )
+
+    def chunks( self ):
+        """ Yields the leaves of the rope, in order """
+        stack = []
+        n = self.root
+        while stack or n:
+            while n:
+                stack.append( n )
+                n = n.left
+            n = stack.pop()
+            if n.text:
+                yield n.text
+            n = n.right
+
+    def freeze( self ):
+        """ Returns the pieces of the document as it is now, which later edits leave alone """
+        return list( self.chunks() )
+
+    def text( self ):
+        return ''.join( self.chunks() )
+
+    def size( self ):
+        """ Returns the number of characters in the document """
+        return _size( self.root )
+
+    def offset( self, row, col ):
+        """ Converts a row and column into an absolute offset """
+        path, start, j = self._find_row( row )
+        return start + j + col
+
+    def position( self, offset ):
+        """ Converts an absolute offset into a (row, column) pair """
+        row = 0
+        rest = offset
+        n = self.root
+        while n:
+            ls = _size( n.left )
+            if rest < ls:
+                n = n.left
+            elif rest < ls + len( n.text ):
+                row += _lines( n.left ) + n.text.count( '\n', 0, rest - ls )
+                break
+            else:
+                row += _lines( n.left ) + n.nl
+                rest -= ls + len( n.text )
+                n = n.right
+        path, start, j = self._find_row( row )
+        return (row, offset - start - j)
+
+    def _find_row( self, row ):
+        """ Returns the root-to-leaf path to the leaf in which the given row
+            starts, the offset of that leaf and where in its text the row
+            starts. A row starting just past the end of a leaf may be found at
+            the end of it. An empty buffer has an empty path to its only row. """
+        path = []
+        n = self.root
+        offset = 0
+        while n:
+            path.append( n )
+            left = n.left
+            ll = left.lines if left else 0
+            if left and row <= ll:
+                n = left
+            elif row <= ll + n.nl:
+                if left:
+                    offset += left.size
+                j = 0
+                for _ in range( row - ll ):
+                    j = n.text.find( '\n', j ) + 1
+                return path, offset, j
+            else:
+                row -= ll + n.nl
+                offset += (left.size if left else 0) + len( n.text )
+                n = n.right
+        if row == 0 and not path:
+            return path, 0, 0
+        raise IndexError( "row index out of range" )
+
+    def _path_to( self, offset, inclusive ):
+        """ Returns the root-to-leaf path to the node holding offset, plus the
+            offset within that node. With inclusive set, an offset just past
+            the end of a node counts as inside it, so text can be appended. """
+        path = []
+        n = self.root
+        while n:
+            path.append( n )
+            ls = _size( n.left )
+            if offset < ls:
+                n = n.left
+            elif offset < ls + len( n.text ) or (inclusive and offset == ls + len( n.text )):
+                return path, offset - ls
+            else:
+                offset -= ls + len( n.text )
+                n = n.right
+        return None, 0
+
+    def _insert_in_place( self, path, j, offset, text ):
+        """ Splices short text into the leaf at the end of path, at j, without
+            reshaping the tree. offset is where j lies in the document. """
+        n = path[-1]
+        t = n.text[:j] + text + n.text[j:]
+        # An overgrown leaf keeps its first half and hands the rest to a new leaf
+        tail = ''
+        if len( t ) > 2 * CHUNK:
+            t, tail = t[:CHUNK], t[CHUNK:]
+        nl = t.count( '\n' )
+        grown, more = len( t ) - len( n.text ), nl - n.nl
+        n.text = t
+        n.nl = nl
+        for p in path:
+            p.size += grown
+            p.lines += more
+        if tail:
+            left, right = _split( self.root, offset - j + len( t ) )
+            self.root = _merge( _merge( left, _Node( tail ) ), right )
+
+    def _delete_in_place( self, path, j, count ):
+        """ Removes a span that lies inside the leaf at the end of path, from j,
+            without reshaping the tree """
+        if path is None:
+            return False
+        n = path[-1]
+        if j + count > len( n.text ) or count == len( n.text ):
+            return False
+        fewer = n.text.count( '\n', j, j + count )
+        n.text = n.text[:j] + n.text[j + count:]
+        n.nl -= fewer
+        for p in path:
+            p.size -= count
+            p.lines -= fewer
+        return True
+
+class MmapBuffer:
+    """ A document mapped into memory straight from its file.
+
+        The file is cut into blocks of about BLOCK bytes, and all that loading
+        keeps of each block is how many characters and newlines it holds, in a
+        pair of Fenwick trees. Blocks are decoded when they are read, with the
+        last CACHED of them kept, and a block moves into an overlay of edited
+        text the first time it changes. Memory therefore grows with what is
+        viewed and edited rather than with the size of the file. Edits pay
+        for it: each one rewrites the whole block it falls in, which makes
+        them several times slower than the rope's.
+
+        The file must only ever be replaced, never rewritten in place, while it
+        is mapped.
+    """
+    def __init__( self, text='' ):
+        self.map = None
+        self.cache = OrderedDict()
+        blocks = _pieces( text, BLOCK ) or ['']
+        self._reindex( blocks, [len( b ) for b in blocks], [b.count( '\n' ) for b in blocks] )
+
+    @classmethod
+    def open( cls, filename ):
+        """ Maps a file into a new buffer, indexing it without decoding it """
+        buf = cls()
+        with open( filename, 'rb' ) as f:
+            try:
+                buf.map = mmap.mmap( f.fileno(), 0, access=mmap.ACCESS_READ )
+            except ValueError:
+                # Empty files cannot be mapped
+                return buf
+        blocks, sizes, nls = [], [], []
+        n = len( buf.map )
+        start = 0
+        while start < n:
+            end = min( start + BLOCK, n )
+            # Never cut a UTF-8 sequence or a \r\n pair in two
+            while end < n and (buf.map[end] & 0xC0 == 0x80 or buf.map[end - 1] == 0x0D):
+                end += 1
+            raw = buf.map[start:end]
+            if raw.isascii() and b'\r' not in raw:
+                sizes.append( len( raw ) )
+                nls.append( raw.count( b'\n' ) )
+            else:
+                text = _decode( raw )
+                sizes.append( len( text ) )
+                nls.append( text.count( '\n' ) )
+            blocks.append( (start, end) )
+            start = end
+        if blocks:
+            buf._reindex( blocks, sizes, nls )
+        return buf
+
+    def __len__( self ):
+        return self.newlines.start( len( self.blocks ) ) + 1
+
+    def __getitem__( self, row ):
+        if row < 0:
+            row += len( self )
+        if row < 0 or row >= len( self ):
+            raise IndexError( "row index out of range" )
+        start = self._row_start( row )
+        end = self._row_start( row + 1 ) if row + 1 < len( self ) else self.size()
+        return self._substring( start, end )
+
+    def __iter__( self ):
+        return _iter_rows( self.chunks() )
+
+    def line( self, row ):
+        """ Returns the contents of a row without its trailing newline """
+        r = self[row]
+        return r[:-1] if r.endswith('\n') else r
+
+    def insert( self, row, col, text ):
+        """ Inserts text, which may contain newlines, at the given row and column """
+        if not text:
+            return
+        b, j = self._locate( self._row_start( row ) + col )
+        t = self._block( b )
+        self._replace( b, t[:j] + text + t[j:] )
+
+    def delete( self, row, col, count=1 ):
+        """ Deletes count characters starting at the given row and column.
+            Deleting a newline joins the row with the one below it. """
+        offset = self._row_start( row ) + col
+        count = min( count, self.size() - offset )
+        while count > 0:
+            b, j = self._locate( offset )
+            t = self._block( b )
+            n = min( count, len( t ) - j )
+            self._replace( b, t[:j] + t[j + n:] )
+            count -= n
+
+    def chunks( self ):
+        """ Yields the blocks of the document, in order. Unedited blocks are decoded without being cached. """
+        for block in self.blocks:
+            yield block if isinstance( block, str ) else _decode( self.map[block[0]:block[1]] )
+
+    def freeze( self ):
+        """ Returns the pieces of the document as it is now, which later edits leave alone.
+            They are decoded as they are iterated over. """
+        blocks = list( self.blocks )
+        return (block if isinstance( block, str ) else _decode( self.map[block[0]:block[1]] ) for block in blocks)
+
+    def text( self ):
+        return ''.join( self.chunks() )
+
+    def size( self ):
+        """ Returns the number of characters in the document """
+        return self.chars.start( len( self.blocks ) )
+
+    def offset( self, row, col ):
+        """ Converts a row and column into an absolute offset """
+        return self._row_start( row ) + col
+
+    def position( self, offset ):
+        """ Converts an absolute offset into a (row, column) pair """
+        b, j = self._locate( offset )
+        row = self.newlines.start( b ) + self._block( b ).count( '\n', 0, j )
+        return (row, offset - self._row_start( row ))
+
+    def _reindex( self, blocks, sizes, nls ):
+        self.blocks = blocks
+        self.sizes = sizes
+        self.nls = nls
+        self.chars = LineIndex( sizes )
+        self.newlines = LineIndex( nls )
+
+    def _block( self, b ):
+        """ Returns the text of a block, decoding it if it has not been edited """
+        block = self.blocks[b]
+        if isinstance( block, str ):
+            return block
+        text = self.cache.get( block )
+        if text is None:
+            text = _decode( self.map[block[0]:block[1]] )
+            self.cache[block] = text
+            if len( self.cache ) > CACHED:
+                self.cache.popitem( last=False )
+        else:
+            self.cache.move_to_end( block )
+        return text
+
+    def _locate( self, offset ):
+        """ Returns the block holding offset and the offset within it. The end of
+            the document counts as being inside the last block. """
+        b, start = self.chars.find( offset )
+        if b >= len( self.blocks ):
+            b = len( self.blocks ) - 1
+            start = self.chars.start( b )
+        return (b, offset - start)
+
+    def _row_start( self, row ):
+        """ Returns the offset of the first character of the given row """
+        if row <= 0:
+            return 0
+        # The block holding the newline that ends the previous row
+        b, before = self.newlines.find( row - 1 )
+        if b >= len( self.blocks ):
+            raise IndexError( "row index out of range" )
+        text = self._block( b )
+        idx = -1
+        for _ in range( row - before ):
+            idx = text.find( '\n', idx + 1 )
+        return self.chars.start( b ) + idx + 1
+
+    def _substring( self, start, end ):
+        out = []
+        b, j = self._locate( start )
+        while start < end and b < len( self.blocks ):
+            piece = self._block( b )[j:j + end - start]
+            out.append( piece )
+            start += len( piece )
+            b += 1
+            j = 0
+        return ''.join( out )
+
+    def _replace( self, b, text ):
+        """ Moves a block into the overlay with new contents """
+        block = self.blocks[b]
+        if not isinstance( block, str ):
+            self.cache.pop( block, None )
+        if len( text ) > 2 * BLOCK:
+            pieces = _pieces( text, BLOCK )
+            self.blocks[b:b + 1] = pieces
+            self.sizes[b:b + 1] = [len( p ) for p in pieces]
+            self.nls[b:b + 1] = [p.count( '\n' ) for p in pieces]
+            self.chars.rebuild( self.sizes )
+            self.newlines.rebuild( self.nls )
+            return
+        nl = text.count( '\n' )
+        self.chars.add( b, len( text ) - self.sizes[b] )
+        self.newlines.add( b, nl - self.nls[b] )
+        self.blocks[b] = text
+        self.sizes[b] = len( text )
+        self.nls[b] = nl
+
+ENGINES = {
+        "rows": RowBuffer,
+        "rope": RopeBuffer,
+        "mmap": MmapBuffer
+}
+
+DEFAULT_ENGINE = "rope"
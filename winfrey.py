@@ -1,102 +1,418 @@
 import sys
-import queue
 import time
 import uuid
 import json
 import logging
 import threading
 import argparse
+import functools
+import signal
+from collections import deque
 import ntplib
+import textbuffer
+import protocol
+import ot
+from oplog import OpLog, replay
+from batching import BatchScheduler, IngestBuffer
+from metrics import Registry, SIZE_BUCKETS
+from profiler import Profiler
+from base.exceptions import GenericError
 from backend import editor_state as WinfreyEditor
+from cursorindex import CursorIndex
 import client as clientpoint
 import server as serverpoint
 
-def serialize( uid, name, *args ):
-    """Creates a JSON string representation of an update message. Mostly legacy now"""
+def serialize( uid, name, *args, doc=None ):
+    """Creates a JSON string representation of an update message. Mostly legacy now. doc names the
+    document the message is for on a server hosting several."""
     message = {
             "uuid": uid,
             "name": name,
             "args": [str(arg) for arg in args]
     }
+    if doc is not None:
+        message["doc"] = doc
 
     return json.dumps( message )
 
+def profile( profiler, action ):
+    """Starts or stops a profiler, or toggles it if action is "toggle", and builds the reply to the profile RPC
+    with the files a stopped profiler wrote."""
+    if action == "start":
+        profiler.start()
+        files = []
+    elif action == "stop":
+        files = profiler.stop()
+    elif action == "toggle":
+        files = profiler.toggle()
+    else:
+        return {"status": "fail", "other": "no_such_action"}
+    return {"status": "ok", "other": {"enabled": profiler.enabled, "files": files}}
+
+class DeserializationError(GenericError): pass
+
 def deserialize( message ):
     """Unpacks a JSON string representation of an update message. Mostly legacy now"""
 
     nobject = json.loads( message )
     if type(nobject) != dict:
-        raise DeserializationError("Received malformed data: {}".format(msg))
+        raise DeserializationError("Received malformed data: {}".format(message))
     return nobject
 
 
-class WinfreyServer( WinfreyEditor ):
-    """A Winfrey file host. Listens for, receives and applies updates from, and broadcasts updates to,
-       connected Winfrey clients."""
-    def __init__( self, interact_address, broadcast_address, filename ):
-        """Creates a new instance of WinfreyServer
+class Snapshot:
+    """The document as a joining user froze it, cut into chunks of a fixed number of characters. It holds the
+    pieces returned by the buffer's freeze rather than a copy of the text, and only reads as far into them as
+    the chunks asked for so far. Chunks asked for ahead of those before them are held until those are sent."""
+    def __init__( self, pieces, length, size ):
+        self.pieces = iter( pieces )
+        self.size = size
+        self.count = max( 1, -(-length // size) )
+        # Index of the next chunk to read, text read past the end of it and chunks read but not sent yet
+        self.read = 0
+        self.rest = ""
+        self.held = {}
+        self.sent = 0
+        self.lock = threading.Lock()
 
-        interact_address: Port for clients to connect to
-        broadcast_address: Port to broadcast updates over
+    def chunk( self, index ):
+        """Returns a chunk, or None if there is no such chunk or it was sent already"""
+        with self.lock:
+            while self.read <= index and self.read < self.count:
+                self.held[self.read] = self._next()
+                self.read += 1
+            text = self.held.pop( index, None )
+            if text is not None:
+                self.sent += 1
+            return text
+
+    def finished( self ):
+        """Returns whether every chunk has been sent"""
+        return self.sent == self.count
+
+    def _next( self ):
+        parts = [self.rest]
+        length = len( self.rest )
+        while length < self.size:
+            piece = next( self.pieces, None )
+            if piece is None:
+                break
+            parts.append( piece )
+            length += len( piece )
+        text = "".join( parts )
+        self.rest = text[self.size:]
+        return text[:self.size]
+
+class WinfreyDocument( WinfreyEditor ):
+    """A document hosted by a Winfrey server. Receives and applies updates from, and broadcasts updates to,
+       the clients that have it open, over an endpoint that it may share with other documents."""
+    # RPCs that are slow enough to be worth running off the listening thread
+    slow_rpcs = {"subscribe", "snapshot", "resume"}
+
+    def __init__( self, endpoint, filename, engine=textbuffer.DEFAULT_ENGINE, doc=None, sessions=None, routes=None,
+                  compressor=None, compact_threshold=1024 * 1024, scheduler=None, convergent=False ):
+        """Creates a new instance of WinfreyDocument
+
+        endpoint: Server endpoint to broadcast updates over
         filename: File to host
+        engine: Name of the text buffer engine to hold the file in
+        doc: ID of the document on a server hosting several, which prefixes its broadcasts
+        sessions: Session IDs, shared with the other documents on the endpoint
+        routes: Dictionary shared with the other documents on the endpoint, mapping each subscriber to its document
+        compressor: Compresses frames to subscribers that negotiated compression
+        compact_threshold: Size in bytes the operation log may reach before it is compacted into the file
+        scheduler: Decides when queued edits are broadcast, by default a BatchScheduler
+        convergent: Have clients edit optimistically and send their edits as operations, which are
+                    transformed over those applied concurrently and broadcast as soon as they arrive
         """
         self.logger = logging.getLogger("main")
-        self.endpoint = serverpoint.Server( interact_address, broadcast_address, self.logger )
-        super().__init__( filename )                 
+        self.endpoint = endpoint
+        super().__init__( filename, engine )
+        self.doc = doc
+        self.prefix = protocol.document_topic( doc ) if doc is not None else b""
+        self.routes = routes
 
         self.rpc_funcs = {
                 "subscribe": self.subscribe,
                 "unsubscribe": self.unsubscribe,
                 "move_cursor": self.move_cursor,
+                "walk_cursor": self.walk_cursor,
                 "insert_char": self.insert_char,
-                "echo_response": self.echo_response
+                "insert_text": self.insert_text,
+                "delete_range": self.delete_range,
+                "echo_response": self.echo_response,
+                "snapshot": self.snapshot,
+                "resume": self.resume,
+                "stats": self.stats,
+                "profile": self.profile,
+                "operate": self.operate,
+                "place_at": self.place_at
         }
+        # RPCs that are applied as soon as they arrive rather than batched
+        self.immediate_rpcs = {"subscribe", "unsubscribe", "snapshot", "resume", "stats", "profile", "operate",
+                               "place_at"}
+        # RPCs queued for the next batch. Those that edit the text a convergent document takes as
+        # operations instead.
+        self.convergent = convergent
+        self.keystroke_rpcs = set( protocol.KEYSTROKES )
 
-        # Number of seconds between batches of updates
-        self.batchDelay = .25
+        # Procedures that the operation log can hold, applied when it is replayed
+        self.replay_funcs = {
+                "create_cursor": self.create_cursor,
+                "remove_cursor": self.remove_cursor,
+                "move_cursor": self.move_cursor,
+                "walk_cursor": self.walk_cursor,
+                "insert_char": self.insert_char,
+                "insert_text": self.insert_text,
+                "delete_range": self.delete_range,
+                "apply_operation": self.apply_operation
+        }
+        # Cursor moves merged into a single walk before they were applied
+        self.movesCollapsed = 0
+
+        # Decides when queued edits are flushed as a batch, based on the clients' latencies
+        self.scheduler = scheduler or BatchScheduler()
+        # Edits waiting for the next batch
+        self.ingest = IngestBuffer()
         save_thread = threading.Thread( target=self.save )
         self.subscribers = []
-        self.latencyAverages = {}
+        # Wire encoding negotiated by each subscriber, and the session IDs standing in for their UUIDs
+        self.encodings = {}
+        self.sessions = sessions or protocol.Sessions()
+        # Compression codec negotiated by each subscriber, or None
+        self.codecs = {}
+        self.compressor = compressor or protocol.Compressor()
+        # Every broadcast is numbered so that joining clients can tell which ones their snapshot already holds
+        self.version = 0
+        # Snapshots being streamed to joining clients, keyed by their UUID, and the characters sent per chunk
+        self.snapshots = {}
+        self.snapshotChunk = 64 * 1024
+        # The latest batches as they were broadcast, as (version, procedures), for clients that missed some
+        # to catch up on with resume rather than loading a snapshot
+        self.history = deque( maxlen=1024 )
+        self._instrument()
+        # Every applied batch is logged so that it survives a crash, and the file is only rewritten once the
+        # log grows past compactThreshold bytes
+        self.oplog = OpLog( filename )
+        self.compactThreshold = compact_threshold
+        self.compactInterval = 5
+        self._recover()
 
-        self.endpoint.startBackground( preprocess=self._preprocess, handler=self._handle, postprocess=self._postprocess, pollTimeout = 2000 )
         save_thread.start()
 
-        # Buffer Queues for incoming edits
-        self.Q1 = queue.Queue()
-        self.Q2 = queue.Queue()
-        self.activeQ = self.Q1
-        self.activeLock = threading.Lock()
         # bundle and broadcast messages in separate thread to preserve fairness
         self.buf_thread = threading.Thread(target=self._bundle_and_broadcast)
         self.buf_thread.start()
 
+    def _instrument( self ):
+        """Registers the document's metrics, which stats reports and a WinfreyServer can export"""
+        self.metrics = Registry()
+        self.requestCount = self.metrics.counter( "winfrey_requests_total", "Requests received, by RPC", label="rpc" )
+        self.handlerTime = self.metrics.histogram( "winfrey_handler_seconds",
+                                                   "Time taken to handle or queue a request, by RPC", label="rpc" )
+        self.droppedCount = self.metrics.counter( "winfrey_dropped_total", "Edits dropped for arriving too late" )
+        self.batchSize = self.metrics.histogram( "winfrey_batch_size", "Procedures per batch", SIZE_BUCKETS )
+        self.batchTime = self.metrics.histogram( "winfrey_batch_seconds", "Time taken to apply and broadcast a batch" )
+        self.frameCount = self.metrics.counter( "winfrey_broadcast_frames_total", "Frames broadcast" )
+        self.frameBytes = self.metrics.counter( "winfrey_broadcast_bytes_total", "Bytes broadcast" )
+        self.transformCount = self.metrics.counter( "winfrey_transforms_total",
+                                                    "Concurrent operations that incoming operations were transformed over" )
+        self.metrics.gauge( "winfrey_queue_depth", "Edits waiting for the next batch", self.ingest.__len__ )
+        self.metrics.gauge( "winfrey_batch_delay_seconds", "Current batch delay", self.scheduler.delay )
+        self.metrics.gauge( "winfrey_subscribers", "Subscribed clients", self.subscribers.__len__ )
+        self.metrics.gauge( "winfrey_client_rtt_seconds", "Average round trip of each client", self.scheduler.latencies,
+                            label="client" )
+        self.metrics.gauge( "winfrey_version", "Number of the latest batch", lambda: self.version )
+
     def save( self ):
-        """Saves the file every thirty seconds"""
+        """Saves the file whenever the operation log has grown past the compaction threshold"""
 
         while True:
-            time.sleep(30)
-            print( "Saving...." )
-            self.write( self.fname )
+            time.sleep( self.compactInterval )
+            if self.oplog.size() > self.compactThreshold:
+                self.logger.info( "Compacting the operation log of %s", self.fname )
+                self.compact()
 
-    def subscribe( self ):
-        """Creates and returns a new user with a unique UUID"""
+    def compact( self ):
+        """Writes the document to disk and starts a fresh operation log from it"""
+        with self.lock:
+            chunks = self.rows.freeze()
+            version = self.version
+            cursors = self.cursors.to_dict()
+            self.oplog.rotate()
+        self.oplog.commit( chunks, version, cursors )
+
+    def _recover( self ):
+        """Replays the operation log over the file loaded from disk, so that batches applied before a crash
+        are not lost, then compacts the result."""
+        records = self.oplog.recover()
+        if not records:
+            self.oplog.start( self.version, {} )
+            return
+        checkpoint = records[0]
+        self.version = checkpoint["version"]
+        for cid, cursor in checkpoint["cursors"].items():
+            super().create_cursor( cid, cursor["cx"], cursor["cy"] )
+        self.version = replay( records, self.replay_funcs, self.logger )
+        # Whoever those cursors belonged to has gone
+        for cid in self.cursors:
+            super().remove_cursor( cid )
+        self.logger.info( "Recovered %s batches from the operation log", len( records ) - 1 )
+        self.compact()
+
+    def subscribe( self, *options ):
+        """Creates and returns a new user with a unique UUID. The user is sent updates in the first of the
+        offered wire encodings that the server supports, or in JSON if none are offered. If a compression
+        codec is offered as well, large snapshot chunks and broadcasts are compressed with it.
+
+        Only the first chunk of the document comes with the reply. The rest is frozen at the returned version
+        and fetched with the snapshot RPC, while broadcasts after that version are replayed on top."""
 
         new_uuid = uuid.uuid4().int
-        self.subscribers.append(str(new_uuid))
-        print( "Created new user with UUID " + str(new_uuid) )
-        self.create_cursor(str(new_uuid))
-        self.endpoint.broadcast( '[' + serialize( new_uuid, "create_cursor", new_uuid ) + ']')
+        encoding = protocol.choose( options )
+        codec = protocol.choose_codec( options )
+        with self.lock:
+            self.subscribers.append(str(new_uuid))
+            self.encodings[str(new_uuid)] = encoding
+            self.codecs[str(new_uuid)] = codec
+            sid = self.sessions.add( str(new_uuid) )
+            if self.routes is not None:
+                self.routes[str(new_uuid)] = self
+            self.logger.info( "Created new user with UUID %s", new_uuid )
+            self.create_cursor(str(new_uuid))
+            self._broadcast_procedures( [{"uuid": new_uuid, "name": "create_cursor", "args": [str(new_uuid)]}] )
+            snapshot = self._freeze( str(new_uuid) )
+
+        return self._pack_reply( str(new_uuid),
+                {"status": "subscribed", "other": dict( snapshot, uuid=new_uuid, encoding=encoding,
+                                                        compression=codec, sid=sid, convergent=self.convergent )} )
+
+    def resume( self, uuid, last_seq ):
+        """Catches up a subscriber that missed the broadcasts after batch last_seq, keeping their UUID and
+        cursor. The reply holds the missed batches, or a snapshot to reload from if they are no longer all
+        held."""
+        last_seq = int( last_seq )
+        with self.lock:
+            if uuid not in self.subscribers:
+                return {"status": "fail", "other": "not_subscribed"}
+            oldest = self.history[0][0] if self.history else self.version + 1
+            if oldest - 1 <= last_seq <= self.version:
+                batches = [{"seq": seq, "ops": ops} for seq, ops in self.history if seq > last_seq]
+                reply = {"status": "resumed", "other": {"batches": batches,
+                                                        "sessions": self.sessions.to_dict( self.subscribers )}}
+            else:
+                reply = {"status": "reload", "other": self._freeze( uuid )}
+        return self._pack_reply( uuid, reply )
+
+    def _freeze( self, uuid ):
+        """Freezes the document for the user with the given UUID to load. Returns the first chunk with what
+        they need to fetch the rest with snapshot. Only the buffer's pieces are taken, so this costs no copy
+        of the text. The caller must hold self.lock."""
+        snapshot = Snapshot( self.rows.freeze(), self.rows.size(), self.snapshotChunk )
+        first = snapshot.chunk( 0 )
+        if not snapshot.finished():
+            self.snapshots[uuid] = snapshot
+        return {"version": self.version, "cursors": self.cursors.to_dict(), "chunk": first,
+                "chunks": snapshot.count, "sessions": self.sessions.to_dict( self.subscribers )}
+
+    def snapshot( self, uuid, index ):
+        """Returns one chunk of the document as it was when the user with the given UUID subscribed, read
+        from its frozen pieces without taking self.lock. The snapshot is released once every chunk has been
+        sent."""
+        snapshot = self.snapshots.get( uuid )
+        chunk = snapshot.chunk( int( index ) ) if snapshot is not None else None
+        if chunk is None:
+            return {"status": "fail", "other": "no_such_snapshot"}
+        if snapshot.finished():
+            self.snapshots.pop( uuid, None )
+        return self._pack_reply( uuid, {"status": "ok", "other": {"index": int( index ), "chunk": chunk}} )
+
+    def operate( self, uuid, revision, operation, cursor ):
+        """Applies an edit that the user with the given UUID made to a convergent document and has shown
+        already. The operation and the offset their cursor was left at were made on batch revision with none
+        of their own edits pending, so they are transformed over the operations applied since, which are
+        everyone else's. The result is applied and broadcast straight away. See ot.py."""
+        cursor = int( cursor )
+        with self.lock:
+            if uuid not in self.subscribers:
+                return {"status": "fail", "other": "not_subscribed"}
+            concurrent = self._operations_since( int( revision ) )
+            if concurrent is None:
+                return {"status": "fail", "other": "revision_too_old"}
+            try:
+                for other in concurrent:
+                    operation, other = ot.transform( operation, other )
+                    cursor = ot.transform_index( cursor, other )
+                if ot.base_length( operation ) != self.rows.size():
+                    raise ot.OperationError( "Operation does not span the document" )
+                if not self.applies_in_full( operation ):
+                    raise ot.OperationError( "Operation deletes the newline before the last row" )
+            except ot.OperationError:
+                return {"status": "fail", "other": "operation_mismatch"}
+            self.transformCount.inc( amount=len( concurrent ) )
+            self.apply_operation( uuid, operation, cursor )
+            self._broadcast_procedures( [{"uuid": uuid, "name": "apply_operation", "args": [uuid, operation, cursor]}] )
+            return {"status": "ok", "other": {"version": self.version}}
+
+    def place_at( self, uuid, revision, offset ):
+        """Moves the cursor of the user with the given UUID to an offset into a convergent document as it was
+        at batch revision, and broadcasts where it ends up"""
+        offset = int( offset )
+        with self.lock:
+            if uuid not in self.subscribers:
+                return {"status": "fail", "other": "not_subscribed"}
+            concurrent = self._operations_since( int( revision ) )
+            if concurrent is None:
+                return {"status": "fail", "other": "revision_too_old"}
+            for other in concurrent:
+                offset = ot.transform_index( offset, other )
+            row = self.cursors.row( uuid )
+            self.move_cursor_to_offset( uuid, offset )
+            self._broadcast_procedures( [], {uuid: row} )
+            return {"status": "ok", "other": {"version": self.version}}
+
+    def _operations_since( self, revision ):
+        """Returns the operations broadcast after batch revision in order, or None if they are no longer all
+        held. The caller must hold self.lock."""
+        oldest = self.history[0][0] if self.history else self.version + 1
+        if not oldest - 1 <= revision <= self.version:
+            return None
+        concurrent = []
+        for seq, procedures in reversed( self.history ):
+            if seq <= revision:
+                break
+            concurrent += [procedure["args"][1] for procedure in reversed( procedures )
+                           if procedure["name"] == "apply_operation"]
+        concurrent.reverse()
+        return concurrent
+
+    def stats( self ):
+        """Returns counters describing the server's traffic"""
+        return {"status": "ok", "other": {"compression": self.compressor.stats(), "batching": self.scheduler.stats(),
+                                          "moves_collapsed": self.movesCollapsed, "metrics": self.metrics.collect()}}
 
-        return {"status": "subscribed", "other": {"uuid": new_uuid, "file": self.rows, "cursors": self.cursors }}
+    def profile( self, action="toggle" ):
+        """Starts or stops profiling the server, or toggles it. A stopped profile is written to logs/."""
+        return profile( self.endpoint.profiler, action )
+
+    def toggle_profiling( self ):
+        self.endpoint.profiler.toggle()
 
     def unsubscribe( self, uuid ):
         """Removes the user with the given UUID"""
 
-        print( "User " + uuid + " left." )
-        self.subscribers.remove(uuid)
-        del self.latencyAverages[uuid]
-        self.remove_cursor( uuid );
-        self.endpoint.broadcast( '[' + serialize( uuid, "remove_cursor", uuid ) + ']' )
+        self.logger.info( "User %s left.", uuid )
+        with self.lock:
+            self.subscribers.remove(uuid)
+            self.scheduler.forget( uuid )
+            self.remove_cursor( uuid );
+            self._broadcast_procedures( [{"uuid": uuid, "name": "remove_cursor", "args": [uuid]}] )
+            del self.encodings[uuid]
+            del self.codecs[uuid]
+            self.sessions.remove( uuid )
+            self.snapshots.pop( uuid, None )
+            if self.routes is not None:
+                self.routes.pop( uuid, None )
 
     def create_cursor( self, cid ):
         """Creates a new cursor object with a given cursor ID. Extends WinfreyEditor.create_cursor"""
@@ -113,15 +429,33 @@ class WinfreyServer( WinfreyEditor ):
         super().move_cursor( cid, direction )
         return {"status": "ok", "other": ""}
 
+    def walk_cursor( self, cid, directions ):
+        """Moves the cursor with the given CID in each of the given directions in turn. Extends
+        WinfreyEditor.walk_cursor"""
+        # Anything but a move would change the text without being broadcast as an edit
+        super().walk_cursor( cid, [direction for direction in directions if direction in protocol.MOVES] )
+        return {"status": "ok", "other": ""}
+
     def insert_char( self, cid, char ):
         """Inserts a character at the cursor with the given CID. Extends WinfreyEditor.insert_char"""
         super().insert_char( cid, char )
         return {"status": "ok", "other": ""}
 
+    def insert_text( self, cid, text ):
+        """Inserts a string at the cursor with the given CID. Extends WinfreyEditor.insert_text"""
+        super().insert_text( cid, text )
+        return {"status": "ok", "other": ""}
+
+    def delete_range( self, cid, count ):
+        """Deletes count characters from the cursor with the given CID onwards. Extends
+        WinfreyEditor.delete_range"""
+        super().delete_range( cid, int( count ) )
+        return {"status": "ok", "other": ""}
+
     def echo_response( self, message ):
         """Action to be taken when the server receives a response from an "echo" message"""
         for m in message: 
-            print("ECHO " + m)
+            self.logger.debug( "ECHO %s", m )
         return {"status": "ok", "other": ""}
 
     def no_such_function(*args):
@@ -129,24 +463,41 @@ class WinfreyServer( WinfreyEditor ):
 
     def _handle( self, procedure ):
         """Callback function for when the server receives a new message."""
+        start = time.perf_counter()
+        reply = self._dispatch( procedure )
+        # Unknown names are counted together so that clients cannot add labels without end
+        name = procedure["name"] if procedure["name"] in self.rpc_funcs else "unknown"
+        self.requestCount.inc( name )
+        self.handlerTime.observe( time.perf_counter() - start, name )
+        return reply
+
+    def _dispatch( self, procedure ):
+        """Applies an RPC straight away, or queues it for the next batch if it is an edit"""
         f = procedure["name"]
 
-        if f == "subscribe" or f == "unsubscribe":
+        if f in self.immediate_rpcs:
             # Subscription message: apply immediately
             reply = self._apply_function( f, *procedure["args"] )
         elif f == "echo_response": 
             # Response to an echo message: apply immediately
             self.updateBatchDelay(procedure["uuid"], procedure["args"])
             reply = self._apply_function( f, procedure["args"] )
+        elif f not in self.keystroke_rpcs:
+            return self.no_such_function()
+        elif not protocol.is_keystroke( procedure ):
+            # Anything queued is applied, broadcast and logged, so it must be checked before it is
+            return {"status": "fail", "other": "malformed_keystroke"}
+        elif self.convergent and not protocol.is_cursor_move( procedure ):
+            return {"status": "fail", "other": "edits_must_be_operations"}
         else:
             # Delayable message: check for staleness and add to the update queue
-            is_too_old = (float(procedure["time"]) < time.time() - self.batchDelay)
+            is_too_old = (float(procedure["time"]) < time.time() - self.scheduler.tolerance( procedure["uuid"] ))
             if is_too_old:
+                self.droppedCount.inc()
                 return {"status": "dropped", "other": "message_too_old"}
 
-            self.activeLock.acquire()
-            self.activeQ.put(procedure)
-            self.activeLock.release()
+            self.ingest.put( procedure )
+            self.scheduler.arrived( len( self.ingest ) )
 
             reply = None
 
@@ -165,83 +516,378 @@ class WinfreyServer( WinfreyEditor ):
             avg_rtt = 0.0
             i = 0
             t = time.time()
-            print("Current time: " + str(t))
+            self.logger.debug( "Current time: %s", t )
             while i < 5: 
                 # The extra math is to adjust for the 0.01 second sleep delay
                 # between echo messages on the client side
                 avg_rtt += t - (float(message[i]) - (.01 * (4 - i)))
                 i += 1
             avg_rtt /= 5
-            self.latencyAverages[uuid] = avg_rtt
-            maxLatency = 0
-            for k, v in self.latencyAverages.items(): 
-                if maxLatency < v: 
-                    maxLatency = v
-            # To support all users and accomodate statistical anomalies, we base
-            # the batch update delay on the user with the longest latency plus a
-            # few extra hundredths of a second
-            self.batchDelay = maxLatency + .05
-            print("NEW BATCH DELAY: " + str(self.batchDelay))
+            # The scheduler bases the batch delay on a percentile of every
+            # user's latency rather than on the worst one
+            self.scheduler.observe( uuid, avg_rtt )
+            self.logger.debug( "NEW BATCH DELAY: %s", self.scheduler.delay() )
 
     def _bundle_and_broadcast( self ):
         """Bundles all messages currently in the update queue into a single message and
            broadcasts it to all clients."""
         while True:
-            time.sleep(self.batchDelay)
-            ps = []
-            
-            #### <CRITICAL SECTION - QUEUE CONTEXT SWITCHING> ####
-            self.activeLock.acquire()
-            # This conditional implies Q2 is empty
-            if self.activeQ is self.Q1: 
-                while not self.Q1.empty():
-                    ps.append(self.Q1.get())
-                self.activeQ = self.Q2
-            else: 
-                while not self.Q2.empty():
-                    ps.append(self.Q2.get())
-                self.activeQ = self.Q1
-            self.activeLock.release()
-            #### </CRITICAL SECTION - QUEUE CONTEXT SWITCHING> ####
-            # This section is not critical, so the active lock need not be owned
+            self.scheduler.wait( self.ingest.__len__, self.ingest.oldest )
+            ps = self.ingest.drain()
+            self.scheduler.flushed( len( ps ) )
+            if not ps:
+                continue
+            start = time.perf_counter()
+            stage = self.endpoint.profiler.clock()
+            self.batchSize.observe( len( ps ) )
             ps.sort(key=lambda k: float(k["time"]))
-            for procedure in ps:
-                self._apply_function( procedure["name"], *procedure["args"] )
-            self.endpoint.broadcast( json.dumps(ps) )
+            ps = self._collapse_moves( ps )
+            stage = self.endpoint.profiler.lap( "batch_sort", stage )
+            with self.lock:
+                applied = []
+                # Row each moved cursor started the batch on
+                moved = {}
+                for procedure in ps:
+                    cid = str( procedure["args"][0] )
+                    if cid not in self.cursors:
+                        # Its user left while the edit was queued
+                        continue
+                    if protocol.is_cursor_move( procedure ):
+                        moved.setdefault( cid, self.cursors.row( cid ) )
+                    else:
+                        # Edits are broadcast with where their cursor was, so clients that skip cursor
+                        # moves still apply them in the right place
+                        procedure["pos"] = list( self.cursors.get( cid ) )
+                    self._apply_function( procedure["name"], *procedure["args"] )
+                    applied.append( procedure )
+                self.endpoint.profiler.lap( "batch_apply", stage )
+                if applied:
+                    self._broadcast_procedures( applied, moved )
             ps.clear()
+            self.batchTime.observe( time.perf_counter() - start )
+
+    def _collapse_moves( self, procedures ):
+        """Merges the cursor moves each user made between two of their edits into a single walk_cursor, so
+        that a held arrow key costs one procedure per batch however often it repeats"""
+        collapsed = []
+        # Index in collapsed of the walk each user's latest moves are merged into
+        walks = {}
+        for procedure in procedures:
+            cid = str( procedure["args"][0] )
+            if not protocol.is_cursor_move( procedure ):
+                walks.pop( cid, None )
+                collapsed.append( procedure )
+            elif cid in walks:
+                walk = collapsed[walks[cid]]
+                if walk["name"] != "walk_cursor":
+                    walk = dict( walk, name="walk_cursor", args=[walk["args"][0], protocol.steps( walk )] )
+                    collapsed[walks[cid]] = walk
+                walk["args"][1] += protocol.steps( procedure )
+                self.movesCollapsed += 1
+            else:
+                walks[cid] = len( collapsed )
+                collapsed.append( procedure )
+        return collapsed
+
+    def _broadcast_procedures( self, procedures, moved={} ):
+        """Broadcasts a list of procedures as the next numbered batch. Edits go out on the edit channel. The
+        cursors that moved, given with the rows they started on, are sent as absolute positions on the
+        cursor channel of every region they left or entered. Every batch has an edit frame, sent first and
+        empty if only cursors moved, so that clients can tell when they have missed one. The caller must hold
+        self.lock."""
+        self.version += 1
+        stage = self.endpoint.profiler.clock()
+        # Only what can be replayed is logged, so that recovering the document never fails on a record
+        self.oplog.append( self.version, [procedure for procedure in procedures
+                                          if procedure["name"] in self.replay_funcs] )
+        self.endpoint.profiler.lap( "batch_log", stage )
+        edits = [procedure for procedure in procedures if not protocol.is_cursor_move( procedure )]
+        frames = [(protocol.EDITS, None, edits)]
+        places = []
+        regions = {}
+        for cid, row in moved.items():
+            if cid not in self.cursors:
+                continue
+            cx, cy = self.cursors.get( cid )
+            place = {"uuid": cid, "name": "place_cursor", "args": [cid, cx, cy]}
+            places.append( place )
+            for region in {protocol.region_of( row ), protocol.region_of( cy )}:
+                regions.setdefault( region, [] ).append( place )
+        self.history.append( (self.version, edits + places) )
+        for region in sorted( regions ):
+            frames.append( (protocol.CURSORS, region, regions[region]) )
+        for kind, region, ops in frames:
+            self._broadcast_frame( kind, region, ops )
+
+    def _broadcast_frame( self, kind, region, procedures ):
+        """Broadcasts procedures on a channel, once for every combination of wire encoding and compression
+        that a subscriber has negotiated"""
+        channels = {(self.encodings[uuid], self.codecs[uuid]) for uuid in self.encodings}
+        for encoding in protocol.ENCODINGS:
+            codecs = {codec for e, codec in channels if e == encoding}
+            if not codecs:
+                continue
+            stage = self.endpoint.profiler.clock()
+            if encoding == "json":
+                frame = json.dumps( {"seq": self.version, "ops": procedures} ).encode()
+            else:
+                frame = protocol.encode_batch( self.version, procedures, self.sessions )
+            stage = self.endpoint.profiler.lap( "batch_encode", stage )
+            for codec in codecs:
+                header = self.prefix + protocol.channel( encoding, codec, kind, region )
+                if codec is None:
+                    message = header + frame
+                else:
+                    message = header + self.compressor.pack( frame, protocol.TOPICS[encoding] )
+                    stage = self.endpoint.profiler.lap( "batch_compress", stage )
+                self.endpoint.broadcast( message )
+                stage = self.endpoint.profiler.lap( "batch_send", stage )
+                self.frameCount.inc()
+                self.frameBytes.inc( amount=len( message ) )
+
+    def _pack_reply( self, uuid, reply ):
+        """Serializes a reply to the user with the given UUID, compressing it if they negotiated a codec"""
+        if self.codecs.get( uuid ) is None:
+            return reply
+        return self.compressor.pack( json.dumps( reply ).encode(), protocol.TOPICS["json"] )
 
     def _preprocess( self, message ):
-        """Deserializes the json messages from the network into Python objects."""
+        """Deserializes the binary or json messages from the network into Python objects."""
+        if protocol.is_binary( message ):
+            return protocol.decode_request( message, self.sessions )
         return deserialize( message )
 
     def _postprocess( self, message ):
-        """Form json messages from Python objects to send across the network."""
+        """Form json messages from Python objects to send across the network. Replies that are already
+        packed are sent as they are."""
+        if isinstance( message, bytes ):
+            return message
+        return json.dumps( message )
+
+
+class WinfreyServer( WinfreyDocument ):
+    """A Winfrey file host. Listens for, receives and applies updates from, and broadcasts updates to,
+       connected Winfrey clients."""
+    def __init__( self, interact_address, broadcast_address, filename, engine=textbuffer.DEFAULT_ENGINE, router=False,
+                  compress_threshold=1024, compact_threshold=1024 * 1024, scheduler=None, metrics_file=None,
+                  convergent=False ):
+        """Creates a new instance of WinfreyServer
+
+        interact_address: Port for clients to connect to
+        broadcast_address: Port to broadcast updates over
+        filename: File to host
+        engine: Name of the text buffer engine to hold the file in
+        router: Serve requests concurrently, handing slow RPCs to worker threads
+        compress_threshold: Size in bytes from which frames to subscribers that negotiated compression are compressed
+        compact_threshold: Size in bytes the operation log may reach before it is compacted into the file
+        scheduler: Decides when queued edits are broadcast, by default a BatchScheduler
+        metrics_file: File to keep the server's metrics in, in the Prometheus text format
+        convergent: Merge concurrent edits by operational transformation instead of ordering them by time
+        """
+        logger = logging.getLogger("main")
+        if router:
+            endpoint = serverpoint.RouterServer( interact_address, broadcast_address, logger,
+                                                 offload=lambda procedure: procedure["name"] in self.slow_rpcs )
+        else:
+            endpoint = serverpoint.Server( interact_address, broadcast_address, logger )
+        super().__init__( endpoint, filename, engine, compressor=protocol.Compressor( compress_threshold ),
+                          compact_threshold=compact_threshold, scheduler=scheduler, convergent=convergent )
+        if metrics_file:
+            self.metrics.export( metrics_file )
+
+        self.endpoint.startBackground( preprocess=self._preprocess, handler=self._handle, postprocess=self._postprocess, pollTimeout = 2000 )
+
+
+class WinfreyHost:
+    """A Winfrey host for many files behind one pair of ports. Each file is a WinfreyDocument, registered
+       under its path, and its broadcasts carry a topic of their own so that clients only receive traffic
+       for the file they have open."""
+    def __init__( self, interact_address, broadcast_address, filenames=(), engine=textbuffer.DEFAULT_ENGINE,
+                  router=False, compress_threshold=1024, compact_threshold=1024 * 1024, sessions=None, convergent=False ):
+        """Creates a new instance of WinfreyHost
+
+        interact_address: Port for clients to connect to
+        broadcast_address: Port to broadcast updates over
+        filenames: Files to host. More can be added with open.
+        engine: Name of the text buffer engine to hold the files in
+        router: Serve requests concurrently, handing slow RPCs to worker threads
+        compress_threshold: Size in bytes from which frames to subscribers that negotiated compression are compressed
+        compact_threshold: Size in bytes an operation log may reach before it is compacted into its file
+        sessions: Allocates the session IDs of every document, by default from 1 upwards
+        convergent: Merge concurrent edits by operational transformation instead of ordering them by time
+        """
+        self.logger = logging.getLogger("main")
+        if router:
+            self.endpoint = serverpoint.RouterServer( interact_address, broadcast_address, self.logger,
+                                                      offload=lambda procedure: procedure["name"] in WinfreyDocument.slow_rpcs )
+        else:
+            self.endpoint = serverpoint.Server( interact_address, broadcast_address, self.logger )
+        self.engine = engine
+        self.compactThreshold = compact_threshold
+        self.convergent = convergent
+        self.compressor = protocol.Compressor( compress_threshold )
+        self.sessions = sessions or protocol.Sessions()
+        # Hosted documents keyed by path, and the document each subscriber has open
+        self.documents = {}
+        self.routes = {}
+        self.lock = threading.Lock()
+
+        self.rpc_funcs = {
+                "documents": self.list_documents,
+                "stats": self.stats,
+                "profile": self.profile
+        }
+
+        for filename in filenames:
+            self.open( filename )
+
+        self.endpoint.startBackground( preprocess=self._preprocess, handler=self._handle, postprocess=self._postprocess, pollTimeout = 2000 )
+
+    def open( self, filename ):
+        """Starts hosting a file, under its path as given, and returns its document"""
+        with self.lock:
+            if filename not in self.documents:
+                self.documents[filename] = WinfreyDocument( self.endpoint, filename, self.engine, doc=filename,
+                                                            sessions=self.sessions, routes=self.routes,
+                                                            compressor=self.compressor,
+                                                            compact_threshold=self.compactThreshold,
+                                                            convergent=self.convergent )
+            return self.documents[filename]
+
+    def list_documents( self ):
+        """Returns the IDs of the hosted documents"""
+        return {"status": "ok", "other": sorted( self.documents )}
+
+    def stats( self ):
+        """Returns counters describing the traffic of every document"""
+        return {"status": "ok", "other": {"compression": self.compressor.stats(),
+                                          "batching": {doc: document.scheduler.stats()
+                                                       for doc, document in self.documents.items()},
+                                          "metrics": {doc: document.metrics.collect()
+                                                      for doc, document in self.documents.items()}}}
+
+    def profile( self, action="toggle" ):
+        """Starts or stops profiling the host, or toggles it. A stopped profile is written to logs/."""
+        return profile( self.endpoint.profiler, action )
+
+    def toggle_profiling( self ):
+        self.endpoint.profiler.toggle()
+
+    def _handle( self, procedure ):
+        """Callback function for when the host receives a new message. Messages naming a document are
+        handed to it, as are messages from its subscribers that name none, like binary keystrokes."""
+        if "doc" in procedure:
+            document = self.documents.get( procedure["doc"] )
+            if document is None:
+                return {"status": "fail", "other": "no_such_document"}
+        else:
+            document = self.routes.get( str( procedure.get( "uuid" ) ) )
+            if document is None:
+                function = self.rpc_funcs.get( procedure["name"], WinfreyDocument.no_such_function )
+                return function( *procedure.get( "args", [] ) )
+        return document._handle( procedure )
+
+    def _preprocess( self, message ):
+        """Deserializes the binary or json messages from the network into Python objects."""
+        if protocol.is_binary( message ):
+            return protocol.decode_request( message, self.sessions )
+        return deserialize( message )
+
+    def _postprocess( self, message ):
+        """Form json messages from Python objects to send across the network. Replies that are already
+        packed are sent as they are."""
+        if isinstance( message, bytes ):
+            return message
         return json.dumps( message )
 
 
 class WinfreyClient( WinfreyEditor ):
     """A Winfrey file client. Connects to a file host and relays all changes made by the editor to the server
        and vice versa."""
-    def __init__( self, remote_address, broadcast_address ):
+    def __init__( self, remote_address, broadcast_address, engine=textbuffer.DEFAULT_ENGINE, encoding="binary",
+                  doc=None, regions=True, headless=False, metrics_file=None, profiler=None ):
         """Creates a new instance of a WinfreyClient.
 
         remote_address: Server port to specifically connect to
-        broadcast_address: Server port to passively listen for updates on"""
+        broadcast_address: Server port to passively listen for updates on
+        engine: Name of the text buffer engine to hold the file in
+        encoding: Preferred wire encoding, "binary" or "json". The server may fall back to json.
+        doc: Document to open on a server hosting several
+        regions: Only receive the moves of cursors near the lines on screen
+        headless: Do not take over the terminal, for clients driven by a script
+        metrics_file: File to keep the client's metrics in, in the Prometheus text format
+        profiler: Times how broadcasts are decoded and applied while it is enabled"""
 
         self.logger = logging.getLogger("main")
-        self.endpoint = clientpoint.Client( remote_address, broadcast_address, self.logger )
+        self.encoding = encoding
+        self.sessions = protocol.Sessions()
+        self.sid = None
+        # Broadcasts about the document start with its topic on a server hosting several
+        self.doc = doc
+        self.prefix = protocol.document_topic( doc ) if doc is not None else b""
+        self.codec = None
+        # Channels subscribed to, and the lines on screen that they follow
+        self.regions = regions
+        self.topics = None
+        self.viewport = None
+        self.topicLock = threading.Lock()
+        # Until the server answers, listen for compressed frames in this encoding. Once it has, the subscription
+        # follows what was negotiated, and batches missed in between are fetched with resume.
+        self.endpoint = clientpoint.PipelinedClient( remote_address, broadcast_address, self.logger,
+                                                     topic=self.prefix + protocol.topic( encoding, "zlib" ) )
    
-        super().__init__()
+        if headless:
+            view = None
+        else:
+            # Only clients with a terminal need urwid
+            import gui
+            view = gui.attach
+        super().__init__( engine=engine, view=view )
         # For update buffering
         self.updateQueue = []
         self.queueLock = threading.Lock()
         self.fullyLoaded = False
+        # Number of the last broadcast batch reflected in the local document
+        self.version = 0
+        # Keystrokes held back to be sent as one RPC: arrow keys pressed within moveWindow seconds of each
+        # other, and characters typed or deleted less than burstGap seconds apart, as when text is pasted
+        self.moveWindow = .05
+        self.burstGap = .03
+        self.held = None
+        self.lastKey = (None, 0)
+        self.holdTimer = None
+        self.keyLock = threading.Lock()
+        # On a convergent server, edits are shown straight away and sent as operations (see ot.py). One is
+        # outstanding until the server broadcasts it back, and those made meanwhile are composed into the buffer.
+        self.convergent = False
+        self.outstanding = None
+        self.buffer = None
+        self.cursorMoved = False
+
+        self.metrics = Registry()
+        self.keystrokeCount = self.metrics.counter( "winfrey_client_keystrokes_total", "Keystroke RPCs sent, by RPC",
+                                                    label="rpc" )
+        self.ackTime = self.metrics.histogram( "winfrey_client_ack_seconds", "Time for the server to acknowledge a keystroke RPC" )
+        self.droppedCount = self.metrics.counter( "winfrey_client_dropped_total", "Keystroke RPCs the server dropped" )
+        self.batchCount = self.metrics.counter( "winfrey_client_batches_total", "Broadcast frames applied, by kind",
+                                                label="kind" )
+        self.resumeCount = self.metrics.counter( "winfrey_client_resumes_total",
+                                                 "Times broadcasts were missed, by how they were caught up on",
+                                                 label="outcome" )
+        self.metrics.gauge( "winfrey_client_version", "Number of the last batch applied", lambda: self.version )
+        if metrics_file:
+            self.metrics.export( metrics_file )
+        self.profiler = profiler or Profiler( name="client" )
 
         self.rpc_funcs = {
                 "create_cursor": self.create_cursor,
                 "remove_cursor": self.remove_cursor,
                 "move_cursor": self.move_cursor,
-                "insert_char": self.insert_char
+                "insert_char": self.insert_char,
+                "insert_text": self.insert_text,
+                "delete_range": self.delete_range,
+                "place_cursor": self.place_cursor,
+                "apply_operation": self._receive_operation
         }
 
         # Time adjustment thread
@@ -275,11 +921,168 @@ class WinfreyClient( WinfreyEditor ):
 
     def move_my_cursor( self, direction ):
         """Callback function for when the local cursor is moved in the given direction. Sends this change
-        to the connected server."""
-        self.timelock.acquire()
-        ltime = time.time() - self.offset
-        self.timelock.release()
-        reply = self.endpoint.send( json.dumps({"uuid": str(self.my_cursor), "name": "move_cursor", "args": [str(self.my_cursor), str(direction)], "time": str(ltime)}) )
+        to the connected server, holding plain moves back until the send window closes."""
+        if direction == 'enter':
+            self.insert_my_char( '\n' )
+            return
+        if self.convergent:
+            if direction in protocol.MOVES:
+                self._move_locally( direction )
+            else:
+                self._local_operation( direction )
+            return
+        with self.keyLock:
+            if direction in protocol.MOVES:
+                self._hold( "move", direction, self.moveWindow )
+            elif direction in ('delete', 'backspace'):
+                self._burst( direction, direction )
+            else:
+                self._send_held()
+                self._send_keystroke( "move_cursor", direction )
+
+    def insert_my_char( self, char ):
+        """Callback function for when a character is inserted at the local cursor. Sends this change to the
+        connected server."""
+        if self.convergent:
+            self._local_operation( char )
+            return
+        with self.keyLock:
+            self._burst( "char", char )
+
+    def _move_locally( self, direction ):
+        """Moves the local cursor of a convergent document straight away. Where it ends up is sent once the
+        send window closes and no edit is outstanding."""
+        with self.lock:
+            self.move_cursor( self.my_cursor, direction )
+            self.cursorMoved = True
+        with self.keyLock:
+            self._hold( "place", direction, self.moveWindow )
+
+    def _local_operation( self, key ):
+        """Applies a typed character, backspace or delete to the local copy of a convergent document
+        straight away, and sends it to the server as an operation."""
+        if not self.fullyLoaded:
+            self.load_thread.join()
+        with self.lock:
+            size = self.rows.size()
+            offset = self.cursor_offset( self.my_cursor )
+            if key in ('backspace', 'delete'):
+                if key == 'backspace':
+                    offset -= 1
+                if offset < 0 or offset >= self.deletable_end( self.rows.position( offset )[0] ):
+                    return
+                operation = ot.splice( size, offset, count=1 )
+            else:
+                operation = ot.splice( size, offset, key )
+            self.apply_operation( self.my_cursor, operation )
+            if self.outstanding is None and self.buffer is None:
+                self._send_operation( operation )
+            else:
+                self.buffer = operation if self.buffer is None else ot.compose( self.buffer, operation )
+
+    def _send_operation( self, operation ):
+        """Sends an operation on the last batch applied, with the offset the local cursor was left at. It is
+        outstanding until the server broadcasts it back. The caller must hold self.lock."""
+        self.outstanding = operation
+        self.cursorMoved = False
+        message = {"uuid": self.my_cursor, "name": "operate",
+                   "args": [self.my_cursor, self.version, operation, self.cursor_offset( self.my_cursor )]}
+        if self.doc is not None:
+            message["doc"] = self.doc
+        self.keystrokeCount.inc( "operate" )
+        self.endpoint.submit( json.dumps( message ), preprocess=self._preprocess_indiv,
+                              callback=functools.partial( self._acknowledge, sent=time.perf_counter() ) )
+
+    def _send_place( self ):
+        """Sends where the local cursor was moved to, unless an operation is outstanding, in which case it
+        goes with the next one instead"""
+        with self.lock:
+            if not self.cursorMoved or self.outstanding is not None or self.buffer is not None:
+                return
+            self.cursorMoved = False
+            message = serialize( self.my_cursor, "place_at", self.my_cursor, self.version,
+                                 self.cursor_offset( self.my_cursor ), doc=self.doc )
+            self.keystrokeCount.inc( "place_at" )
+            self.endpoint.submit( message, preprocess=self._preprocess_indiv,
+                                  callback=functools.partial( self._acknowledge, sent=time.perf_counter() ) )
+
+    def _flush_operations( self ):
+        """Sends the buffered edits, or else where the local cursor was moved to, once no operation is
+        outstanding. The caller must hold self.lock."""
+        if self.outstanding is not None:
+            return
+        if self.buffer is not None:
+            buffer, self.buffer = self.buffer, None
+            self._send_operation( buffer )
+        elif self.cursorMoved:
+            self._send_place()
+
+    def _receive_operation( self, cid, operation, cursor ):
+        """Applies an operation broadcast by the server on top of the local edits it has not seen yet. The
+        local user's own operation coming back acknowledges the outstanding one, which is applied already.
+        The caller must hold self.lock."""
+        if cid == self.my_cursor and self.outstanding is not None:
+            self.outstanding = None
+            return
+        if self.outstanding is not None:
+            self.outstanding, operation = ot.transform( self.outstanding, operation )
+            cursor = ot.transform_index( cursor, self.outstanding )
+        if self.buffer is not None:
+            self.buffer, operation = ot.transform( self.buffer, operation )
+            cursor = ot.transform_index( cursor, self.buffer )
+        self.apply_operation( cid, operation, cursor )
+
+    def _burst( self, kind, key ):
+        """Sends a keystroke straight away, unless it follows one of the same kind so closely that it is
+        part of a burst, which is held back and sent in one go. The caller must hold self.keyLock."""
+        now = time.monotonic()
+        last, self.lastKey = self.lastKey, (kind, now)
+        if (self.held and self.held[0] == kind) or (last[0] == kind and now - last[1] < self.burstGap):
+            self._hold( kind, key, self.burstGap )
+        else:
+            self._send_held()
+            self._send_keystroke( "insert_char" if kind == "char" else "move_cursor", key )
+
+    def _hold( self, kind, key, window ):
+        """Holds a keystroke back for at most window seconds, first sending those held back already if they
+        are of another kind. The caller must hold self.keyLock."""
+        if self.held and self.held[0] != kind:
+            self._send_held()
+        if not self.held:
+            self.held = (kind, [])
+        self.held[1].append( key )
+        if self.holdTimer is None:
+            self.holdTimer = threading.Timer( window, self._flush_held )
+            self.holdTimer.daemon = True
+            self.holdTimer.start()
+
+    def _flush_held( self ):
+        """Sends the keystrokes held back so far"""
+        with self.keyLock:
+            self._send_held()
+
+    def _send_held( self ):
+        """Sends the held back keystrokes as a single RPC. The caller must hold self.keyLock."""
+        if self.holdTimer is not None:
+            self.holdTimer.cancel()
+            self.holdTimer = None
+        if not self.held:
+            return
+        kind, keys = self.held
+        self.held = None
+        if kind == "place":
+            self._send_place()
+        elif len( keys ) == 1:
+            self._send_keystroke( "insert_char" if kind == "char" else "move_cursor", keys[0] )
+        elif kind == "char":
+            self._send_keystroke( "insert_text", ''.join( keys ) )
+        elif kind == "delete":
+            self._send_keystroke( "delete_range", len( keys ) )
+        elif kind == "backspace":
+            # Deletes the run back from the cursor
+            self._send_keystroke( "delete_range", -len( keys ) )
+        else:
+            self._send_keystroke( "walk_cursor", keys )
 
     def echo( self ):
         """Sends a bundle of timestamps to the server"""
@@ -291,45 +1094,128 @@ class WinfreyClient( WinfreyEditor ):
             time.sleep(.01)
             i = i + 1
         if not self.stopped:
-            reply = self.endpoint.send( json.dumps({"uuid": str(self.my_cursor),
-                                                "name": "echo_response", 
-                                                "args": message} ))
+            reply = self.endpoint.send( serialize( str(self.my_cursor), "echo_response", *message, doc=self.doc ) )
 
-    def insert_my_char( self, char ):
-        """Callback function for when a character is inserted at the local cursor. Sends this change to the
-        connected server."""
+    def _send_keystroke( self, name, arg ):
+        """Timestamps a keystroke RPC and queues it for the server in the negotiated wire encoding. The
+        argument of a walk_cursor is its list of directions, and that of a delete_range its count."""
         self.timelock.acquire()
         ltime = time.time() - self.offset
         self.timelock.release()
-        reply = self.endpoint.send( json.dumps({"uuid": str(self.my_cursor), "name": "insert_char", "args": [str(self.my_cursor), str(char)], "time": str(ltime)}) )
+        if name not in ("walk_cursor", "delete_range"):
+            arg = str( arg )
+        if self.encoding == "binary":
+            message = protocol.encode_request( name, self.sid, ltime, arg )
+        else:
+            message = {"uuid": str(self.my_cursor), "name": name, "args": [str(self.my_cursor), arg], "time": str(ltime)}
+            if self.doc is not None:
+                message["doc"] = self.doc
+            message = json.dumps( message )
+        self.keystrokeCount.inc( name )
+        self.endpoint.submit( message, preprocess=self._preprocess_indiv,
+                              callback=functools.partial( self._acknowledge, sent=time.perf_counter() ) )
+
+    def _acknowledge( self, reply, sent=None ):
+        """Callback for when the server acknowledges a keystroke sent at the given perf_counter time. Runs on
+        the endpoint's I/O thread, so the UI never waits on the round trip."""
+        if reply.exception() is not None:
+            self.logger.error( "Keystroke was not delivered: %s", reply.exception() )
+            return
+        if sent is not None:
+            self.ackTime.observe( time.perf_counter() - sent )
+        ack = reply.result()
+        if ack and ack["status"] == "dropped":
+            self.droppedCount.inc()
+            self.logger.warning( "Server dropped a keystroke: %s", ack["other"] )
+        elif ack and ack["status"] == "fail" and self.convergent:
+            # The local copy can no longer be reconciled with the server's, so it is replaced
+            self.logger.warning( "Server refused an edit, reloading: %s", ack["other"] )
+            threading.Thread( target=self.resume, kwargs={"reload": True}, daemon=True ).start()
 
     def subscribe( self ):
         """Sends a subscription message to the connected server, then receives and loads the text file from the
         server's response. Buffers incoming changes during this time."""
-        reply = self.endpoint.send( serialize( 0, "subscribe" ), preprocess=self._preprocess_indiv )
+        offered = [self.encoding] + [e for e in protocol.ENCODINGS if e != self.encoding] + sorted( protocol.CODECS )
+        reply = self.endpoint.send( serialize( 0, "subscribe", *offered, doc=self.doc ), preprocess=self._preprocess_indiv )
+        if reply["status"] == "subscribed":
+            # Sessions must be known before any broadcast is decoded
+            self.encoding = reply["other"].get( "encoding", "json" )
+            self.codec = reply["other"].get( "compression" )
+            self.convergent = reply["other"].get( "convergent", False )
+            self._follow()
+            self.sid = reply["other"].get( "sid" )
+            for cid, sid in reply["other"].get( "sessions", {} ).items():
+                self.sessions.add( cid, sid )
         self.endpoint.startBackground( self._handleQueue, preprocess=self._preprocess )
         if reply["status"] == "subscribed":
             self.my_cursor = str(reply["other"]["uuid"])
-            self.rows = reply["other"]["file"]
+            self.version = reply["other"]["version"]
+            self.rows = self.engine( reply["other"]["chunk"] )
             self.numrows = len( self.rows )
-            for i in range( 0, len(self.rows) ):
-                self.G.add_line( i, self.rows[i][:-1], [] );
-            for cid in reply["other"]["cursors"]:
-                cursor = reply["other"]["cursors"][cid]
-                self.create_cursor( cid, cursor["cx"], cursor["cy"] )
-            self.fullyLoaded = True
-            # Dequeue all queued updates after file fully loads
-            while self.updateQueue: 
-                self.queueLock.acquire()
-                procedure = self.updateQueue.pop(0)
-                self._handle([procedure])
-                self.queueLock.release()
+            self.G.refresh()
+            # The first screen is ready; fetch the rest while the user looks at it
+            self.load_thread = threading.Thread( target=self._load_snapshot,
+                                                 args=(reply["other"]["chunks"], reply["other"]["cursors"]) )
+            self.load_thread.start()
         else:
             return None
 
+    def _load_snapshot( self, chunks, cursors ):
+        """Fetches the remaining chunks of the document, places the cursors that existed when it was frozen,
+        then replays the updates buffered in the meantime."""
+        # Every chunk is requested up front so that they arrive back to back
+        replies = [self.endpoint.submit( serialize( self.my_cursor, "snapshot", self.my_cursor, i, doc=self.doc ),
+                                         preprocess=self._preprocess_indiv ) for i in range( 1, chunks )]
+        for reply in replies:
+            chunk = reply.result()["other"]["chunk"]
+            with self.lock:
+                last = len( self.rows ) - 1
+                self.rows.insert( last, len( self.rows[last] ), chunk )
+                self.numrows = len( self.rows )
+                self.G.refresh()
+        for cid in cursors:
+            self.create_cursor( cid, cursors[cid]["cx"], cursors[cid]["cy"] )
+        self._replay_queued()
+
+    def _replay_queued( self ):
+        """Applies the updates that arrived while the document was loading, then lets new ones through."""
+        with self.queueLock:
+            while self.updateQueue:
+                self._apply_batch( self.updateQueue.pop(0) )
+            self.fullyLoaded = True
+
+    def view( self, first, last ):
+        """Callback for when a different range of lines comes into view. Extends WinfreyEditor.view"""
+        self.viewport = (first, last)
+        self._follow()
+
+    def _follow( self ):
+        """Subscribes to every edit, and to cursor moves in the regions on or next to the screen and the one
+        holding the local cursor. Until the screen has been drawn, every cursor move is received."""
+        with self.topicLock:
+            if not self.regions or self.viewport is None:
+                topics = [self.prefix + protocol.topic( self.encoding, self.codec )]
+            else:
+                first, last = self.viewport
+                regions = set( range( protocol.region_of( max( 0, first - protocol.REGION ) ),
+                                      protocol.region_of( last + protocol.REGION ) + 1 ) )
+                if self.my_cursor in self.cursors:
+                    regions.add( protocol.region_of( self.cursors.row( self.my_cursor ) ) )
+                topics = [self.prefix + protocol.channel( self.encoding, self.codec, protocol.EDITS )]
+                topics += [self.prefix + protocol.channel( self.encoding, self.codec, protocol.CURSORS, region )
+                           for region in sorted( regions )]
+            if topics != self.topics:
+                self.topics = topics
+                self.endpoint.listener.setTopics( topics )
+
     def unsubscribe( self ):
         """Unsubscribes and disconnects from the connected server."""
-        reply = self.endpoint.send( serialize( self.my_cursor, "unsubscribe", self.my_cursor ), preprocess=self._preprocess_indiv )
+        self._flush_held()
+        # Give the server a moment to take the edits not sent yet
+        deadline = time.monotonic() + 2
+        while (self.outstanding is not None or self.buffer is not None) and time.monotonic() < deadline:
+            time.sleep( .01 )
+        reply = self.endpoint.send( serialize( self.my_cursor, "unsubscribe", self.my_cursor, doc=self.doc ), preprocess=self._preprocess_indiv )
         
         self.endpoint.stop()
 
@@ -338,14 +1224,77 @@ class WinfreyClient( WinfreyEditor ):
         self.unsubscribe()
         self.stopped = True
 
-    def _handleQueue( self, procedures ): 
-        if not self.fullyLoaded or self.updateQueue: 
-            self.queueLock.acquire()
-            for procedure in procedures:
-                self.updateQueue.append(procedure)
-            self.queueLock.release()
-        else: 
-            self._handle(procedures) 
+    def _handleQueue( self, batch ): 
+        with self.queueLock:
+            if not self.fullyLoaded:
+                self.updateQueue.append( batch )
+                return
+        self._apply_batch( batch )
+
+    def resume( self, reload=False ):
+        """Asks the server for the broadcasts missed since the last batch applied, and applies them. If the
+        server no longer holds them all, or reload is set, the document is reloaded from a snapshot instead."""
+        last_seq = -1 if reload else self.version
+        reply = self.endpoint.send( serialize( self.my_cursor, "resume", self.my_cursor, last_seq, doc=self.doc ),
+                                    preprocess=self._preprocess_indiv )
+        if reply["status"] not in ("resumed", "reload"):
+            self.logger.error( "Could not resume: %s", reply["other"] )
+            return
+        self.resumeCount.inc( reply["status"] )
+        # Users who subscribed in the meantime must be known before their broadcasts are decoded
+        for cid, sid in reply["other"]["sessions"].items():
+            self.sessions.add( cid, sid )
+        if reply["status"] == "reload":
+            self._reload( reply["other"] )
+            return
+        with self.lock:
+            for batch in reply["other"]["batches"]:
+                if batch["seq"] > self.version:
+                    self._handle( batch["ops"] )
+                    self.version = batch["seq"]
+            self._flush_operations()
+
+    def _reload( self, snapshot ):
+        """Replaces the local document and its cursors with a snapshot, fetching every chunk of it first"""
+        replies = [self.endpoint.submit( serialize( self.my_cursor, "snapshot", self.my_cursor, i, doc=self.doc ),
+                                         preprocess=self._preprocess_indiv ) for i in range( 1, snapshot["chunks"] )]
+        text = snapshot["chunk"] + ''.join( reply.result()["other"]["chunk"] for reply in replies )
+        with self.lock:
+            self.rows = self.engine( text )
+            self.numrows = len( self.rows )
+            self.cursors = CursorIndex()
+            for cid, cursor in snapshot["cursors"].items():
+                self.cursors.add( cid, cursor["cx"], cursor["cy"] )
+            self.version = snapshot["version"]
+            # Local edits the server had not applied are lost with the rest of the local copy
+            self.outstanding = None
+            self.buffer = None
+            self.cursorMoved = False
+            self.G.refresh()
+
+    def _apply_batch( self, batch ):
+        """Applies a broadcast frame unless the local document already reflects it. Every batch has an edit
+        frame, sent before its cursor frames, so a frame numbered past the batch after the last one applied
+        means broadcasts were missed, and they are fetched with resume."""
+        edits = batch["kind"] == protocol.EDITS
+        expected = self.version + 1 if edits else self.version
+        if batch["seq"] > expected:
+            # The missed batches include this one
+            self.resume()
+            return
+        if batch["seq"] < expected:
+            return
+        stage = self.profiler.clock()
+        with self.lock:
+            self._handle( batch["ops"] )
+            if edits:
+                self.version = batch["seq"]
+                self._flush_operations()
+        self.profiler.lap( "apply", stage )
+        self.batchCount.inc( "edits" if edits else "cursors" )
+        if self.regions and self.viewport is not None:
+            # The local cursor may have moved into a region that is not followed yet
+            self._follow()
 
     def _handle( self, procedures ):
         """Callback function for when an update is received from the server."""
@@ -356,28 +1305,68 @@ class WinfreyClient( WinfreyEditor ):
                 f = procedure["name"]
                 function = self.rpc_funcs.get( f, None )
                 if function:
+                    if self.convergent and f == "place_cursor" and str( procedure["args"][0] ) == self.my_cursor:
+                        # The local cursor is moved locally, and the server only ever follows it
+                        continue
+                    if "pos" in procedure:
+                        # Put the cursor where the server had it, in case a move of it was not received
+                        self.place_cursor( str( procedure["args"][0] ), *procedure["pos"] )
                     function( *procedure["args"] )
         return
     
     def _preprocess( self, message ):
-        """Turns the json messages across the network into Python objects."""
-        return json.loads( message )
+        """Turns the binary or json messages across the network, compressed or not, into Python objects."""
+        stage = self.profiler.clock()
+        kind, region, message = protocol.strip_channel( message[len( self.prefix ):] )
+        message = protocol.unpack( message )
+        if protocol.is_binary( message ):
+            batch = protocol.decode_batch( message, self.sessions )
+        else:
+            batch = json.loads( message )
+        batch["kind"] = kind
+        self.profiler.lap( "preprocess", stage )
+        return batch
 
     def _preprocess_indiv( self, message ):
-        """Turns the json messages across the network into Python objects."""
-        return json.loads( message )
+        """Turns the json messages across the network, compressed or not, into Python objects."""
+        return json.loads( protocol.unpack( message ) )
 
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser( description='You get to edit! You get to edit! Everyone gets to edit!' )
     parser.add_argument('-c', metavar='SERVER_ADDR', help='Starts Winfrey as a client of the given address', action='store', dest='server_addr')
     parser.add_argument('-s', metavar='FILENAME', help='Starts Winfrey as server of the given file', action='store', dest='filename')
+    parser.add_argument('-m', metavar='FILENAME', help='Starts Winfrey as server of all the given files behind the same ports', action='store', dest='filenames', nargs='+')
+    parser.add_argument('-w', metavar='WORKERS', help='Spreads the files given with -m over this many worker processes', action='store', dest='workers', type=int)
+    parser.add_argument('-d', metavar='DOC', help='Document to open on a server of several files', action='store', dest='doc')
+    parser.add_argument('-b', metavar='ENGINE', help='Text buffer engine to use. mmap suits very large files but makes each edit about three times slower than rope', action='store', dest='engine', choices=sorted(textbuffer.ENGINES), default=textbuffer.DEFAULT_ENGINE)
+    parser.add_argument('-r', help='Serve requests concurrently on a ROUTER socket', action='store_true', dest='router')
+    parser.add_argument('-p', metavar='FILE', help='Keeps the metrics of a server of one file or of a client in this file, in the Prometheus text format', action='store', dest='metrics_file')
+    parser.add_argument('-o', help='Merge concurrent edits by operational transformation, with clients editing optimistically', action='store_true', dest='convergent')
     parser.add_argument('iport', help='Interactive port to server', action='store' )
     parser.add_argument('bport', help='Broadcast port from server', action='store' )
 
     args = parser.parse_args()
 
     if args.filename:
-        winfrey = WinfreyServer( "tcp://*:{}".format(args.iport), "tcp://*:{}".format( args.bport ), args.filename )
+        winfrey = WinfreyServer( "tcp://*:{}".format(args.iport), "tcp://*:{}".format( args.bport ), args.filename, args.engine, args.router, metrics_file=args.metrics_file, convergent=args.convergent )
+    elif args.filenames and args.workers:
+        import cluster
+        winfrey = cluster.WinfreyFrontend( "tcp://*:{}".format(args.iport), "tcp://*:{}".format( args.bport ), args.filenames, args.workers, args.engine, convergent=args.convergent )
+    elif args.filenames:
+        winfrey = WinfreyHost( "tcp://*:{}".format(args.iport), "tcp://*:{}".format( args.bport ), args.filenames, args.engine, args.router, convergent=args.convergent )
     else:
-        winfrey = WinfreyClient( "tcp://%s:%s" % (args.server_addr, args.iport), "tcp://%s:%s" % (args.server_addr, args.bport))
+        # The client only returns once the editor is closed, so its profiler is made first
+        profiler = Profiler( name="client" )
+        signal.signal( signal.SIGUSR1, lambda sig, frame: profiler.toggle() )
+        winfrey = WinfreyClient( "tcp://%s:%s" % (args.server_addr, args.iport), "tcp://%s:%s" % (args.server_addr, args.bport), args.engine, doc=args.doc, metrics_file=args.metrics_file, profiler=profiler)
+
+    if not args.server_addr:
+        # SIGUSR1 starts profiling, and stops it again writing the profile to logs/
+        signal.signal( signal.SIGUSR1, lambda sig, frame: winfrey.toggle_profiling() )
+        # Python only runs signal handlers on the main thread, and the ROUTER server's thread pool refuses
+        # work once the main thread has finished, so it waits on the server
+        if args.workers:
+            winfrey.route_thread.join()
+        else:
+            winfrey.endpoint.listenThread.join()